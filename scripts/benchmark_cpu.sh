@@ -0,0 +1,15 @@
+#!/bin/bash
+
+# CPU performance regression check at reduced model sizes; no GPU or pretrained weights needed.
+# Usage: bash scripts/benchmark_cpu.sh [--update_baseline] [--benchmarks "controlnet*"] ...
+
+cd "$(dirname "$0")/../src/force-prompting" || exit 1
+
+python benchmark.py \
+  --config tiny \
+  --num_threads 4 \
+  --repeats 5 \
+  --output bench_output.json \
+  --baseline benchmarks/baseline_cpu_tiny.json \
+  --tolerance 0.25 \
+  "$@"
@@ -58,6 +58,15 @@ while [[ $# -gt 0 ]]; do
       CSV_PATH_VAL="$2"
       shift 2
       ;;
+    --csv_paths_val)
+      # several CSVs, globs or a benchmark_details.csv, generated in one run with the models loaded once
+      shift
+      CSV_PATHS_VAL=()
+      while [[ $# -gt 0 && $1 != --* ]]; do
+        CSV_PATHS_VAL+=("$1")
+        shift
+      done
+      ;;
     --pretrained_controlnet_path)
       PRETRAINED_CONTROLNET_PATH="$2"
       shift 2
@@ -72,10 +81,17 @@ done
 # replaces csv fname with images dir
 IMAGE_ROOT_DIR_VAL=$(echo "$CSV_PATH_VAL" | sed 's|/[^/]*\.csv$|/images|')
 
+if [ ${#CSV_PATHS_VAL[@]} -gt 0 ]; then
+  VAL_DATA_ARGS=(--csv_paths_val "${CSV_PATHS_VAL[@]}")
+else
+  VAL_DATA_ARGS=(--csv_path_val "$CSV_PATH_VAL" --image_root_dir_val "$IMAGE_ROOT_DIR_VAL")
+fi
+
 # Display the values being used
 echo "Using force_type:                   $FORCE_TYPE"
 echo "Using num_validation_videos:        $NUM_VALIDATION_VIDEOS"
 echo "Using csv_path_val:                 $CSV_PATH_VAL"
+echo "Using csv_paths_val:                ${CSV_PATHS_VAL[*]}"
 echo "Using image_root_dir_val:           $IMAGE_ROOT_DIR_VAL"
 echo "Using pretrained_controlnet_path:   $PRETRAINED_CONTROLNET_PATH"
 echo "Using model_type:                   $MODEL_TYPE"
@@ -86,8 +102,7 @@ accelerate launch --config_file scripts/accelerate/accelerate_config_1_gpu.yaml
   --multi_gpu \
   src/force-prompting/train.py \
   --gradient_checkpointing \
-  --csv_path_val "$CSV_PATH_VAL" \
-  --image_root_dir_val "$IMAGE_ROOT_DIR_VAL" \
+  "${VAL_DATA_ARGS[@]}" \
   --csv_path "" \
   --video_root_dir "" \
   --model_type "$MODEL_TYPE" \
@@ -99,7 +99,77 @@ def get_args():
     parser.add_argument(
         "--low_memory_mode",
         action="store_true",
-        help="Whether or not to only use the first few transformer layers. Corrupts outputs visually, but allows you to run on smaller GPU.",
+        help=(
+            "Keep the transformer and controlnet block weights in host memory and stream them to the GPU block by block,"
+            " prefetching the next block while the current one runs. Same outputs, less GPU memory. Inference only."
+        ),
+    )
+    parser.add_argument(
+        "--weight_quantization",
+        type=str,
+        default=None,
+        choices=["int8", "int4"],
+        help=(
+            "Store the weights of the Linear layers in the transformer and controlnet blocks as int8 (per output"
+            " channel) or int4 (per group) integers, for CPU inference. Weight-only: the weights are dequantized for"
+            " the matmul, the activations are not quantized. Changes the outputs slightly. Inference only."
+        ),
+    )
+    parser.add_argument(
+        "--weight_quantization_int8_matmul",
+        action="store_true",
+        help=(
+            "With --weight_quantization int8 on CPU, run the Linear layers as int8 matmuls of the quantized CPU engine."
+            " This also quantizes the activations on every call (W8A8), which adds error on top of the weight"
+            " quantization and is only faster than the float matmul for large layers."
+        ),
+    )
+    parser.add_argument(
+        "--weight_quantization_group_size",
+        type=int,
+        default=64,
+        help="The number of input channels that share a scale with --weight_quantization int4.",
+    )
+    parser.add_argument(
+        "--quantized_weights_dir",
+        type=str,
+        default=None,
+        help=(
+            "Where the quantized weights of --weight_quantization are saved, and loaded from in later runs with the"
+            " same base model and controlnet checkpoint. By default they are recomputed every run."
+        ),
+    )
+    parser.add_argument(
+        "--attention_memory_budget_mb",
+        type=float,
+        default=None,
+        help=(
+            "Compute the attention of the transformer and controlnet blocks in query chunks (and key chunks with an"
+            " online softmax) whose attention scores take at most this many MiB, e.g. for higher resolutions or"
+            " longer videos on CPU. By default the scores of all tokens are computed at once."
+        ),
+    )
+    parser.add_argument(
+        "--sparse_control_encoding",
+        action="store_true",
+        help=(
+            "Whether or not to run the controlnet encoder only on the latent cells where the control signal is not"
+            " background (zero), e.g. around the point-force blob. Falls back to the dense encoder for dense signals."
+        ),
+    )
+    parser.add_argument(
+        "--uniform_control_encoding",
+        action="store_true",
+        help=(
+            "Whether or not to run the controlnet encoder at a single position for control signals that are constant"
+            " over space, e.g. the wind force, and broadcast the result. Inference only."
+        ),
+    )
+    parser.add_argument(
+        "--sparse_control_encoding_atol",
+        type=float,
+        default=1e-4,
+        help="Pixels within this distance of the background value are treated as background by `--sparse_control_encoding`.",
     )
     parser.add_argument(
         "--pretrained_controlnet_path",
@@ -131,6 +201,17 @@ def get_args():
         type=str,
         default=None,
     )
+    parser.add_argument(
+        "--csv_paths_val",
+        type=str,
+        nargs="+",
+        default=None,
+        help=(
+            "Several validation CSVs to generate in one run, instead of `--csv_path_val`: paths, globs, or a"
+            " `benchmark_details.csv`, which stands for all the CSVs in the subdirectories next to it. The images of"
+            " every CSV are read from the `images` directory next to it. The models are loaded once for all of them."
+        ),
+    )
     parser.add_argument(
         "--model_type",
         type=str,
@@ -174,6 +255,47 @@ def get_args():
         default=1,
         help="Number of videos that should be generated during validation per `validation_prompt`.",
     )
+    parser.add_argument(
+        "--inference_batch_size",
+        type=int,
+        default=1,
+        help=(
+            "Number of (sample, seed) pairs that `do_inference` generates in one batched pipeline call. Each pair has"
+            " its own generator, so the videos are the same as with a batch size of 1."
+        ),
+    )
+    parser.add_argument(
+        "--inference_memory_budget_gb",
+        type=float,
+        default=None,
+        help="If set, `--inference_batch_size` is lowered so that the estimated activation memory of a batch fits.",
+    )
+    parser.add_argument(
+        "--streaming_decode",
+        action="store_true",
+        help=(
+            "Decode the generated videos in temporal chunks and write them to disk while decoding, instead of decoding"
+            " the whole float video first. Bounds the decode memory to one chunk."
+        ),
+    )
+    parser.add_argument(
+        "--decode_worker",
+        action="store_true",
+        help=(
+            "Decode the generated videos in a background thread (on its own CUDA stream), so that the denoising of the"
+            " next batch overlaps with the decode and the encoding of the previous one. Needs memory for a decode on"
+            " top of the denoising."
+        ),
+    )
+    parser.add_argument(
+        "--regenerate_existing_results",
+        action="store_true",
+        help=(
+            "Generate every video, even those that the results index in `--output_dir` already has with the same image,"
+            " prompt, control parameters, seed, settings and checkpoints. By default they are skipped, so that an"
+            " interrupted run resumes where it stopped."
+        ),
+    )
     parser.add_argument(
         "--validation_steps",
         type=int,
@@ -194,6 +316,84 @@ def get_args():
         default=False,
         help="Whether or not to use the default cosine dynamic guidance schedule when sampling validation videos.",
     )
+    parser.add_argument(
+        "--cfg_guidance_start",
+        type=float,
+        default=0.0,
+        help="Fraction of the denoising steps after which classifier free guidance is applied.",
+    )
+    parser.add_argument(
+        "--cfg_guidance_end",
+        type=float,
+        default=1.0,
+        help=(
+            "Fraction of the denoising steps after which classifier free guidance is no longer applied; the remaining"
+            " steps only evaluate the conditional batch, at half the cost."
+        ),
+    )
+    parser.add_argument(
+        "--controlnet_cfg_mode",
+        type=str,
+        default="full",
+        choices=["full", "shared", "cond_only"],
+        help=(
+            "How the controlnet is run with classifier free guidance: on both halves of the batch (`full`), once on the"
+            " conditional half with the residuals reused for both halves (`shared`), or once with the residuals only"
+            " added to the conditional half (`cond_only`). The latter two halve the controlnet compute per step."
+        ),
+    )
+    parser.add_argument(
+        "--controlnet_cache_interval",
+        type=int,
+        default=1,
+        help="Evaluate the controlnet only every k-th denoising step and reuse its residuals in between. 1 disables the cache.",
+    )
+    parser.add_argument(
+        "--controlnet_cache_temb_threshold",
+        type=float,
+        default=None,
+        help=(
+            "Reuse the controlnet residuals until the accumulated relative change of the timestep embedding exceeds"
+            " this threshold. Replaces `--controlnet_cache_interval`."
+        ),
+    )
+    parser.add_argument(
+        "--controlnet_cache_residual_threshold",
+        type=float,
+        default=None,
+        help=(
+            "Reuse the controlnet residuals until the extrapolated relative change of their norm exceeds this threshold."
+            " Replaces `--controlnet_cache_interval`."
+        ),
+    )
+    parser.add_argument(
+        "--controlnet_cache_max_skip_steps",
+        type=int,
+        default=None,
+        help="Maximum number of consecutive steps that reuse the controlnet residuals with the adaptive thresholds.",
+    )
+    parser.add_argument(
+        "--transformer_cache_threshold",
+        type=float,
+        default=None,
+        help=(
+            "Skip the transformer blocks and reuse their residual from the previous step while the accumulated relative"
+            " change of `--transformer_cache_indicator` stays below this threshold. 0 reproduces the uncached output."
+        ),
+    )
+    parser.add_argument(
+        "--transformer_cache_indicator",
+        type=str,
+        default="hidden_states",
+        choices=["hidden_states", "modulated_input", "timestep_embedding"],
+        help="What is compared between consecutive steps by `--transformer_cache_threshold`.",
+    )
+    parser.add_argument(
+        "--transformer_cache_max_skip_steps",
+        type=int,
+        default=None,
+        help="Maximum number of consecutive steps on which the transformer blocks are skipped.",
+    )
 
     # Training information
     parser.add_argument("--seed", type=int, default=None, help="A seed for reproducible training.")
@@ -0,0 +1,127 @@
+"""
+CPU benchmark suite for the controlnet, the transformer and the img2vid pipeline at reduced model sizes.
+
+Runs without GPUs or pretrained weights, writes the timings to a JSON file and compares them against a stored
+baseline. Example, from `src/force-prompting`:
+
+    python benchmark.py --config tiny --output bench_output.json --baseline benchmarks/baseline_cpu_tiny.json
+"""
+import argparse
+import fnmatch
+import os
+import sys
+
+import torch
+
+from benchmarks.common import (
+    BENCHMARKS,
+    TINY_CONFIGS,
+    compare_to_baseline,
+    load_results,
+    parity_failures,
+    write_results,
+)
+import benchmarks.bench_models  # noqa: F401, registers the benchmarks
+import benchmarks.bench_pipeline  # noqa: F401
+import benchmarks.bench_video  # noqa: F401
+
+
+def get_args():
+    parser = argparse.ArgumentParser(description="Tiny-config CPU benchmarks for the force prompting models.")
+    parser.add_argument("--config", type=str, default="tiny", choices=list(TINY_CONFIGS.keys()), help="Model size preset.")
+    parser.add_argument(
+        "--override",
+        type=str,
+        nargs="*",
+        default=[],
+        help="Override entries of the config preset, e.g. `--override num_layers=4 latent_frames=5`.",
+    )
+    parser.add_argument(
+        "--benchmarks",
+        type=str,
+        nargs="*",
+        default=["*"],
+        help="Glob patterns over the registered benchmark names.",
+    )
+    parser.add_argument("--warmup", type=int, default=1, help="Untimed calls before measuring.")
+    parser.add_argument("--repeats", type=int, default=5, help="Timed calls per benchmark.")
+    parser.add_argument("--num_threads", type=int, default=None, help="torch intra-op threads; fixing it makes runs comparable.")
+    parser.add_argument("--output", type=str, default="bench_output.json", help="Where to write the JSON results.")
+    parser.add_argument("--baseline", type=str, default=None, help="JSON results to compare against.")
+    parser.add_argument(
+        "--tolerance",
+        type=float,
+        default=0.25,
+        help="Relative slowdown of the median time, compared to the baseline, that counts as a regression.",
+    )
+    parser.add_argument(
+        "--update_baseline",
+        action="store_true",
+        help="Write the results to `--baseline` instead of comparing against it.",
+    )
+    return parser.parse_args()
+
+
+def parse_overrides(overrides):
+    parsed = {}
+    for override in overrides:
+        key, value = override.split("=", 1)
+        parsed[key] = int(value)
+    return parsed
+
+
+def main(args):
+    if args.num_threads is not None:
+        torch.set_num_threads(args.num_threads)
+
+    cfg = dict(TINY_CONFIGS[args.config])
+    overrides = parse_overrides(args.override)
+    unknown = set(overrides) - set(cfg)
+    if unknown:
+        raise ValueError(f"Unknown config entries {sorted(unknown)}; expected some of {sorted(cfg)}.")
+    cfg.update(overrides)
+    config_name = args.config + "".join(f",{k}={v}" for k, v in sorted(overrides.items()))
+
+    names = [name for name in BENCHMARKS if any(fnmatch.fnmatch(name, pattern) for pattern in args.benchmarks)]
+    print(f"Running {len(names)} benchmarks with config {config_name}: {cfg}")
+
+    records = []
+    for name in names:
+        for record in BENCHMARKS[name](cfg, args.warmup, args.repeats):
+            line = f"{record['name']:<48}"
+            if "median_s" in record:
+                line += f" median {1000 * record['median_s']:9.2f} ms  min {1000 * record['min_s']:9.2f} ms"
+            if "max_abs_diff" in record:
+                line += f"  max_abs_diff {record['max_abs_diff']:.2e}"
+            print(line)
+            records.append(record)
+
+    results = write_results(args.output, config_name, records)
+    print(f"Results written to {args.output}")
+
+    failed = False
+    for record in parity_failures(records):
+        print(f"PARITY FAILURE: {record['name']} max_abs_diff={record['max_abs_diff']:.3e} > atol={record['atol']:.1e}")
+        failed = True
+
+    if args.baseline is not None:
+        if args.update_baseline:
+            write_results(args.baseline, config_name, records)
+            print(f"Baseline updated at {args.baseline}")
+        elif not os.path.isfile(args.baseline):
+            print(f"No baseline at {args.baseline}; run with --update_baseline to create it.")
+        else:
+            for row in compare_to_baseline(results, load_results(args.baseline), args.tolerance):
+                status = "REGRESSION" if row["regressed"] else "ok"
+                print(
+                    f"{row['name']:<48} baseline {1000 * row['baseline_s']:9.2f} ms  "
+                    f"current {1000 * row['current_s']:9.2f} ms  x{row['ratio']:.2f}  {status}"
+                )
+                failed = failed or row["regressed"]
+
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    args = get_args()
+    sys.exit(main(args))
@@ -0,0 +1,386 @@
+import os
+
+import torch
+import torch.nn.functional as F
+from einops import rearrange
+
+from benchmarks.common import (
+    build_controlnet,
+    build_transformer,
+    make_inputs,
+    make_point_force_frames,
+    make_wind_force_frames,
+    make_record,
+    max_abs_diff,
+    pixel_frames,
+    register_benchmark,
+    time_fn,
+)
+
+
+def _controlnet_kwargs(inputs):
+    return {
+        "hidden_states": inputs["hidden_states"],
+        "encoder_hidden_states": inputs["encoder_hidden_states"],
+        "controlnet_states": inputs["controlnet_states"],
+        "timestep": inputs["timestep"],
+        "image_rotary_emb": inputs["image_rotary_emb"],
+        "return_dict": False,
+    }
+
+
+def _transformer_kwargs(inputs, controlnet_states):
+    return {
+        "hidden_states": inputs["hidden_states"],
+        "encoder_hidden_states": inputs["encoder_hidden_states"],
+        "timestep": inputs["timestep"],
+        "image_rotary_emb": inputs["image_rotary_emb"],
+        "controlnet_states": controlnet_states,
+        "controlnet_weights": 1.0,
+        "return_dict": False,
+    }
+
+
+@register_benchmark("controlnet")
+def bench_controlnet(cfg, warmup, repeats):
+    controlnet = build_controlnet(cfg)
+    inputs = make_inputs(cfg)
+
+    def forward():
+        with torch.no_grad():
+            return controlnet(**_controlnet_kwargs(inputs))[0]
+
+    def forward_backward():
+        controlnet.zero_grad(set_to_none=True)
+        outputs = controlnet(**_controlnet_kwargs(inputs))[0]
+        sum(x.sum() for x in outputs).backward()
+
+    return [
+        make_record("controlnet/forward", time_fn(forward, warmup, repeats)),
+        make_record("controlnet/forward_backward", time_fn(forward_backward, warmup, repeats)),
+    ]
+
+
+@register_benchmark("controlnet_encoder")
+def bench_controlnet_encoder(cfg, warmup, repeats):
+    controlnet = build_controlnet(cfg)
+    controlnet_states = make_point_force_frames(cfg)
+
+    def encode():
+        with torch.no_grad():
+            return controlnet.encode_controlnet_states(controlnet_states)
+
+    controlnet.disable_sparse_control_encoding()
+    reference = encode()
+    records = [make_record("controlnet_encoder/dense", time_fn(encode, warmup, repeats))]
+
+    # atol=0 only leaves out cells that are exactly background, so it has to match the dense encoder; at the
+    # default atol the blob tails are dropped, which is allowed to cost some accuracy
+    for name, atol, parity_atol in [("sparse_exact", 0.0, 1e-4), ("sparse", 1e-4, 1e-2)]:
+        controlnet.enable_sparse_control_encoding(atol=atol, max_active_fraction=1.0)
+        records.append(make_record(
+            f"controlnet_encoder/{name}",
+            time_fn(encode, warmup, repeats),
+            max_abs_diff=max_abs_diff(encode(), reference),
+            atol=parity_atol,
+        ))
+    controlnet.disable_sparse_control_encoding()
+
+    # the wind-force signal is constant over space, so the encoder output is computed at a single position
+    controlnet_states = make_wind_force_frames(cfg)
+    controlnet.disable_uniform_control_encoding()
+    reference = encode()
+    records.append(make_record("controlnet_encoder/wind_dense", time_fn(encode, warmup, repeats)))
+    controlnet.enable_uniform_control_encoding()
+    records.append(make_record(
+        "controlnet_encoder/wind_uniform",
+        time_fn(encode, warmup, repeats),
+        max_abs_diff=max_abs_diff(encode(), reference),
+        atol=1e-5,
+    ))
+    return records
+
+
+def _reference_compress_time(x, num_frames):
+    # the original permute + avg_pool1d implementation of `CogVideoXControlnet.compress_time`
+    x = rearrange(x, '(b f) c h w -> b f c h w', f=num_frames)
+    batch_size, frames, channels, height, width = x.shape
+    x = rearrange(x, 'b f c h w -> (b h w) c f')
+    if x.shape[-1] % 2 == 1:
+        x_first, x_rest = x[..., 0], x[..., 1:]
+        if x_rest.shape[-1] > 0:
+            x_rest = F.avg_pool1d(x_rest, kernel_size=2, stride=2)
+        x = torch.cat([x_first[..., None], x_rest], dim=-1)
+    else:
+        x = F.avg_pool1d(x, kernel_size=2, stride=2)
+    return rearrange(x, '(b h w) c f -> (b f) c h w', b=batch_size, h=height, w=width)
+
+
+@register_benchmark("compress_time")
+def bench_compress_time(cfg, warmup, repeats):
+    controlnet = build_controlnet(cfg)
+    generator = torch.Generator().manual_seed(0)
+    records = []
+    # the activations after the first and the second encoder stage
+    num_frames = pixel_frames(cfg)
+    for stage, channels in [("first", controlnet.input_channels[1]), ("second", controlnet.input_channels[2])]:
+        x = torch.randn((num_frames, channels, cfg["latent_height"], cfg["latent_width"]), generator=generator)
+        reference = _reference_compress_time(x, num_frames)
+        records += [
+            make_record(
+                f"compress_time/{stage}_reference",
+                time_fn(lambda: _reference_compress_time(x, num_frames), warmup, repeats),
+            ),
+            make_record(
+                f"compress_time/{stage}",
+                time_fn(lambda: controlnet.compress_time(x, num_frames), warmup, repeats),
+                max_abs_diff=max_abs_diff(controlnet.compress_time(x, num_frames), reference),
+                atol=0.0,
+            ),
+        ]
+        num_frames = reference.shape[0]
+    return records
+
+
+def _reference_zero_convs(controlnet, controlnet_hidden_states):
+    # the original Conv3d implementation of the zero convs at the end of `CogVideoXControlnet.forward`
+    outputs = ()
+    for zero_conv, hidden_states in zip(controlnet.controlnet_zero_convs_after, controlnet_hidden_states):
+        hidden_states = rearrange(hidden_states[..., None, None], 'b s c h w -> b c s h w')
+        hidden_states = rearrange(zero_conv(hidden_states), 'b c s h w -> b s c h w')
+        outputs += (hidden_states.squeeze(-1).squeeze(-1),)
+    return outputs
+
+
+@register_benchmark("zero_convs")
+def bench_zero_convs(cfg, warmup, repeats):
+    controlnet = build_controlnet(cfg)
+    inputs = make_inputs(cfg)
+
+    # capture the block outputs that go into the zero convs
+    controlnet_hidden_states = []
+    hooks = [
+        block.register_forward_hook(lambda module, args, output: controlnet_hidden_states.append(output[0]))
+        for block in controlnet.transformer_blocks
+    ]
+    with torch.no_grad():
+        outputs = controlnet(**_controlnet_kwargs(inputs))[0]
+    for hook in hooks:
+        hook.remove()
+
+    def zero_convs():
+        with torch.no_grad():
+            return tuple(
+                F.linear(hidden_states, zero_conv.weight.flatten(1), zero_conv.bias)
+                for zero_conv, hidden_states in zip(controlnet.controlnet_zero_convs_after, controlnet_hidden_states)
+            )
+
+    def reference():
+        with torch.no_grad():
+            return _reference_zero_convs(controlnet, controlnet_hidden_states)
+
+    return [
+        make_record("zero_convs/reference", time_fn(reference, warmup, repeats)),
+        make_record(
+            "zero_convs/linear",
+            time_fn(zero_convs, warmup, repeats),
+            max_abs_diff=max_abs_diff(outputs, reference()),
+            atol=1e-5,
+        ),
+    ]
+
+
+@register_benchmark("transformer")
+def bench_transformer(cfg, warmup, repeats):
+    transformer = build_transformer(cfg)
+    inputs = make_inputs(cfg)
+    with torch.no_grad():
+        controlnet_states = build_controlnet(cfg)(**_controlnet_kwargs(inputs))[0]
+
+    def forward():
+        with torch.no_grad():
+            return transformer(**_transformer_kwargs(inputs, controlnet_states))[0]
+
+    # in training only the controlnet is trainable, but the gradient still flows back through the transformer
+    transformer.requires_grad_(False)
+    controlnet_states_with_grad = [x.clone().requires_grad_(True) for x in controlnet_states]
+
+    def forward_backward():
+        output = transformer(**_transformer_kwargs(inputs, controlnet_states_with_grad))[0]
+        output.sum().backward()
+
+    return [
+        make_record("transformer/forward", time_fn(forward, warmup, repeats)),
+        make_record("transformer/forward_backward", time_fn(forward_backward, warmup, repeats)),
+    ]
+
+
+@register_benchmark("weight_quantization")
+def bench_weight_quantization(cfg, warmup, repeats):
+    """
+    The controlnet and transformer forward with the Linear weights of their blocks quantized to int8 and int4
+    (`quantize_block_linears`), against the fp32 reference. The drift of the transformer output is only bounded
+    loosely, it depends on the weights; `weight_bytes` are the parameters and buffers of both models. The quantized
+    weights saved and loaded as an artifact have to give identical outputs. The quantization is weight-only;
+    `int8_matmul` runs the int8 matmul of the quantized CPU engine, which also quantizes the activations (W8A8) and
+    drifts more than int8 weights alone.
+    """
+    import tempfile
+
+    from models.quantization import (
+        QUANTIZATION_BITS,
+        QuantizedLinear,
+        load_quantized_weights,
+        module_weight_bytes,
+        quantize_block_linears,
+        save_quantized_weights,
+    )
+
+    inputs = make_inputs(cfg)
+
+    def build_models(quantization=None, int8_matmul=False):
+        controlnet, transformer = build_controlnet(cfg), build_transformer(cfg)
+        if quantization is not None:
+            quantize_block_linears(controlnet, quantization, int8_matmul=int8_matmul)
+            quantize_block_linears(transformer, quantization, int8_matmul=int8_matmul)
+        return controlnet, transformer
+
+    def make_forward(controlnet, transformer):
+        def forward():
+            with torch.no_grad():
+                controlnet_states = controlnet(**_controlnet_kwargs(inputs))[0]
+                return transformer(**_transformer_kwargs(inputs, controlnet_states))[0]
+        return forward
+
+    reference_models = build_models()
+    reference = make_forward(*reference_models)()
+    records = [
+        make_record(
+            "weight_quantization/fp32",
+            time_fn(make_forward(*reference_models), warmup, repeats),
+            weight_bytes=sum(module_weight_bytes(model) for model in reference_models),
+        )
+    ]
+    for name, quantization, int8_matmul, atol in [
+        ("int8", "int8", False, 0.05), ("int8_matmul", "int8", True, 0.05), ("int4", "int4", False, 0.5)
+    ]:
+        models = build_models(quantization, int8_matmul=int8_matmul)
+        forward = make_forward(*models)
+        output = forward()
+
+        with tempfile.TemporaryDirectory() as artifact_dir:
+            loaded_models = build_models()
+            for model_name, model, loaded_model in zip(["controlnet", "transformer"], models, loaded_models):
+                path = os.path.join(artifact_dir, f"{model_name}_{quantization}.pt")
+                save_quantized_weights(model, path, source={"seed": 0})
+                load_quantized_weights(loaded_model, path, source={"seed": 0}, int8_matmul=int8_matmul)
+            loaded_output = make_forward(*loaded_models)()
+
+        records += [
+            make_record(
+                f"weight_quantization/{name}",
+                time_fn(forward, warmup, repeats),
+                max_abs_diff=max_abs_diff(output, reference),
+                atol=atol,
+                relative_drift=((output - reference).norm() / reference.norm()).item(),
+                weight_bytes=sum(module_weight_bytes(model) for model in models),
+            ),
+            make_record(
+                f"weight_quantization/{name}_artifact",
+                max_abs_diff=max_abs_diff(loaded_output, output),
+                atol=0.0,
+            ),
+        ]
+
+    # a single linear of a realistic size, where the int8 matmul pays off; the tiny models are dominated by overhead
+    generator = torch.Generator().manual_seed(0)
+    linear = torch.nn.Linear(1024, 3072)
+    hidden_states = torch.randn((1, 1024, 1024), generator=generator)
+    with torch.no_grad():
+        reference_linear = linear(hidden_states)
+        records.append(make_record("weight_quantization/linear_fp32", time_fn(lambda: linear(hidden_states), warmup, repeats)))
+        for name, quantization, int8_matmul in [("int8", "int8", False), ("int8_matmul", "int8", True), ("int4", "int4", False)]:
+            quantized_linear = QuantizedLinear.from_linear(linear, bits=QUANTIZATION_BITS[quantization], int8_matmul=int8_matmul)
+            output = quantized_linear(hidden_states)
+            records.append(
+                make_record(
+                    f"weight_quantization/linear_{name}",
+                    time_fn(lambda: quantized_linear(hidden_states), warmup, repeats),
+                    relative_drift=((output - reference_linear).norm() / reference_linear.norm()).item(),
+                    weight_bytes=module_weight_bytes(quantized_linear),
+                )
+            )
+    return records
+
+
+@register_benchmark("chunked_attention")
+def bench_chunked_attention(cfg, warmup, repeats):
+    """
+    The controlnet and transformer forward with `ChunkedCogVideoXAttnProcessor` against the default attention
+    processor, with a budget that only splits the queries and one that also splits the keys (online softmax), and
+    the attention alone on a longer sequence. `max_chunk_bytes` is the largest score chunk against the
+    `full_score_bytes` of the unchunked attention.
+    """
+    from models.chunked_attention import attention_chunk_sizes, chunked_scaled_dot_product_attention, enable_chunked_attention
+
+    inputs = make_inputs(cfg)
+    controlnet, transformer = build_controlnet(cfg), build_transformer(cfg)
+
+    def forward():
+        with torch.no_grad():
+            controlnet_states = controlnet(**_controlnet_kwargs(inputs))[0]
+            return transformer(**_transformer_kwargs(inputs, controlnet_states))[0]
+
+    reference = forward()
+    records = [make_record("chunked_attention/default", time_fn(forward, warmup, repeats))]
+    batch_heads = inputs["hidden_states"].shape[0] * cfg["num_attention_heads"]
+    sequence_length = inputs["encoder_hidden_states"].shape[1] + (
+        cfg["latent_frames"] * cfg["latent_height"] * cfg["latent_width"] // 4
+    )
+    full_score_bytes = batch_heads * sequence_length ** 2 * 4
+    # 64 query rows with all keys, and 64 x 64 scores
+    for name, memory_budget, atol in [
+        ("query_chunks", 2 * batch_heads * 4 * sequence_length * 64, 0.0), ("key_chunks", 2 * batch_heads * 4 * 64 * 64, 1e-5)
+    ]:
+        processors = [enable_chunked_attention(model, memory_budget) for model in (controlnet, transformer)]
+        output = forward()
+        records.append(
+            make_record(
+                f"chunked_attention/{name}",
+                time_fn(forward, warmup, repeats),
+                max_abs_diff=max_abs_diff(output, reference),
+                atol=atol,
+                max_chunk_bytes=max(processor.max_chunk_bytes for processor in processors),
+                full_score_bytes=full_score_bytes,
+            )
+        )
+
+    # a longer sequence, e.g. more frames: a budget of 16 MiB instead of 256 MiB of scores at once
+    generator = torch.Generator().manual_seed(0)
+    query, key, value = [torch.randn((1, 4, 4096, 64), generator=generator) for _ in range(3)]
+    query_chunk_size, key_chunk_size = attention_chunk_sizes(4, 4096, 4096, 4, 16 * 2**20)
+    reference_attention = F.scaled_dot_product_attention(query, key, value)
+    records += [
+        make_record(
+            "chunked_attention/long_sequence_sdpa",
+            time_fn(lambda: F.scaled_dot_product_attention(query, key, value), warmup, repeats),
+            full_score_bytes=4 * 4096 ** 2 * 4,
+        ),
+        make_record(
+            "chunked_attention/long_sequence_chunked",
+            time_fn(lambda: chunked_scaled_dot_product_attention(query, key, value, query_chunk_size, key_chunk_size), warmup, repeats),
+            max_abs_diff=max_abs_diff(
+                chunked_scaled_dot_product_attention(query, key, value, query_chunk_size, key_chunk_size), reference_attention
+            ),
+            atol=0.0,
+            max_chunk_bytes=4 * query_chunk_size * key_chunk_size * 4,
+        ),
+        make_record(
+            "chunked_attention/long_sequence_online_softmax",
+            time_fn(lambda: chunked_scaled_dot_product_attention(query, key, value, 256, 512), warmup, repeats),
+            max_abs_diff=max_abs_diff(chunked_scaled_dot_product_attention(query, key, value, 256, 512), reference_attention),
+            atol=1e-5,
+            max_chunk_bytes=4 * 256 * 512 * 4,
+        ),
+    ]
+    return records
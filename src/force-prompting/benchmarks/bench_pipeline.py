@@ -0,0 +1,914 @@
+import os
+import statistics
+import time
+
+import torch
+
+from pipelines.controlnet_residual_cache import ControlnetResidualCache
+from benchmarks.common import (
+    LATENT_CHANNELS,
+    TEXT_EMBED_DIM,
+    TEXT_SEQ_LENGTH,
+    VAE_SCALE_FACTOR_SPATIAL,
+    build_pipeline,
+    make_point_force_frames,
+    make_record,
+    max_abs_diff,
+    pixel_frames,
+    register_benchmark,
+    time_fn,
+)
+
+
+def make_pipeline_inputs(cfg, batch_size=1, seed=0, guidance_scale=6.0):
+    generator = torch.Generator().manual_seed(seed)
+    height = cfg["latent_height"] * VAE_SCALE_FACTOR_SPATIAL
+    width = cfg["latent_width"] * VAE_SCALE_FACTOR_SPATIAL
+    controlnet_latents = make_point_force_frames(cfg, batch_size=batch_size)
+    if guidance_scale > 1.0:
+        controlnet_latents = torch.cat([controlnet_latents] * 2)
+    return {
+        "image": torch.rand((batch_size, 3, height, width), generator=generator),
+        "controlnet_latents": controlnet_latents,
+        "prompt_embeds": torch.randn((batch_size, TEXT_SEQ_LENGTH, TEXT_EMBED_DIM), generator=generator),
+        "negative_prompt_embeds": torch.randn((batch_size, TEXT_SEQ_LENGTH, TEXT_EMBED_DIM), generator=generator),
+        "latents": torch.randn(
+            (batch_size, cfg["latent_frames"], LATENT_CHANNELS, cfg["latent_height"], cfg["latent_width"]),
+            generator=generator,
+        ),
+        "height": height,
+        "width": width,
+        "num_frames": pixel_frames(cfg),
+        "num_inference_steps": cfg["num_inference_steps"],
+        "guidance_scale": guidance_scale,
+        "output_type": "latent",
+    }
+
+
+def run_pipeline(pipe, inputs, **kwargs):
+    # the VAE posterior is sampled while encoding the image, so the seed is reset for every call
+    return pipe(**inputs, **kwargs, generator=torch.Generator().manual_seed(0)).frames
+
+
+def time_denoise_steps(pipe, inputs, warmup=1, repeats=5, **kwargs):
+    """
+    Time the individual denoising steps of a pipeline call, from the end of one step to the end of the next, so
+    that the setup before the loop (VAE encode, rotary embeddings) is not included.
+    """
+    step_times = []
+
+    def callback_on_step_end(pipe, i, t, callback_kwargs):
+        step_ends.append(time.perf_counter())
+        return {}
+
+    for repeat in range(warmup + repeats):
+        step_ends = []
+        run_pipeline(pipe, inputs, callback_on_step_end=callback_on_step_end, **kwargs)
+        if repeat >= warmup:
+            step_times += [end - start for start, end in zip(step_ends[:-1], step_ends[1:])]
+    return {
+        "median_s": statistics.median(step_times),
+        "mean_s": statistics.mean(step_times),
+        "min_s": min(step_times),
+        "max_s": max(step_times),
+        "repeats": len(step_times),
+    }
+
+
+@register_benchmark("pipeline")
+def bench_pipeline(cfg, warmup, repeats):
+    pipe = build_pipeline(cfg)
+    records = []
+    for guidance_scale in [6.0, 1.0]:
+        inputs = make_pipeline_inputs(cfg, guidance_scale=guidance_scale)
+        suffix = "_cfg" if guidance_scale > 1.0 else ""
+        records += [
+            make_record(f"pipeline/call{suffix}", time_fn(lambda: run_pipeline(pipe, inputs), warmup, repeats)),
+            make_record(f"pipeline/denoise_step{suffix}", time_denoise_steps(pipe, inputs, warmup, repeats)),
+        ]
+    return records
+
+
+@register_benchmark("pipeline_controlnet_cfg")
+def bench_pipeline_controlnet_cfg(cfg, warmup, repeats):
+    """
+    Latency of a denoising step for the `controlnet_cfg_mode` options, and how far their final latents end up from the
+    ones of the full CFG controlnet (a quality proxy, not a parity check).
+    """
+    pipe = build_pipeline(cfg)
+    inputs = make_pipeline_inputs(cfg, guidance_scale=6.0)
+    reference = run_pipeline(pipe, inputs, controlnet_cfg_mode="full")
+    records = []
+    for mode in ["full", "shared", "cond_only"]:
+        records.append(make_record(
+            f"pipeline_controlnet_cfg/{mode}",
+            time_denoise_steps(pipe, inputs, warmup, repeats, controlnet_cfg_mode=mode),
+            max_abs_diff=max_abs_diff(run_pipeline(pipe, inputs, controlnet_cfg_mode=mode), reference),
+            latents_abs_max=reference.abs().max().item(),
+        ))
+    return records
+
+
+@register_benchmark("pipeline_controlnet_cache")
+def bench_pipeline_controlnet_cache(cfg, warmup, repeats):
+    """
+    Pipeline call time with the controlnet residual cache under different refresh policies. A refresh interval of 1
+    has to reproduce the uncached output exactly; the others report their distance to it and the skipped steps.
+    """
+    pipe = build_pipeline(cfg)
+    inputs = make_pipeline_inputs(cfg, guidance_scale=6.0)
+    reference = run_pipeline(pipe, inputs)
+    records = [make_record("pipeline_controlnet_cache/none", time_fn(lambda: run_pipeline(pipe, inputs), warmup, repeats))]
+
+    policies = {
+        "interval_1": {"refresh_interval": 1},
+        "interval_2": {"refresh_interval": 2},
+        "temb_1.5": {"temb_threshold": 1.5},
+        "residual_0.05": {"residual_threshold": 0.05},
+    }
+    for name, policy in policies.items():
+        cache = ControlnetResidualCache(**policy)
+        timings = time_fn(lambda: run_pipeline(pipe, inputs, controlnet_residual_cache=cache), warmup, repeats)
+        cache.reset_stats()
+        output = run_pipeline(pipe, inputs, controlnet_residual_cache=cache)
+        extra = {"atol": 0.0} if name == "interval_1" else {}
+        records.append(make_record(
+            f"pipeline_controlnet_cache/{name}",
+            timings,
+            max_abs_diff=max_abs_diff(output, reference),
+            num_evaluations=cache.num_evaluations,
+            num_skipped=cache.num_skipped,
+            **extra,
+        ))
+    return records
+
+
+@register_benchmark("pipeline_transformer_cache")
+def bench_pipeline_transformer_cache(cfg, warmup, repeats):
+    """
+    Pipeline call time with the transformer block output cache. A threshold of 0 has to reproduce the uncached output
+    bit-exactly; the others report their distance to it, the hit rate and the skipped steps. The random tiny models
+    change by 35% or more per step, so only the larger thresholds skip any.
+    """
+    pipe = build_pipeline(cfg)
+    inputs = make_pipeline_inputs(cfg, guidance_scale=6.0)
+    reference = run_pipeline(pipe, inputs)
+    records = [make_record("pipeline_transformer_cache/none", time_fn(lambda: run_pipeline(pipe, inputs), warmup, repeats))]
+
+    for indicator, threshold in [
+        ("modulated_input", 0.0), ("modulated_input", 0.5), ("hidden_states", 0.1), ("hidden_states", 1.0),
+        ("timestep_embedding", 1.0),
+    ]:
+        pipe.transformer.enable_block_output_cache(threshold=threshold, indicator=indicator)
+        timings = time_fn(lambda: run_pipeline(pipe, inputs), warmup, repeats)
+        cache = pipe.transformer.block_output_cache
+        cache.num_hits = cache.num_misses = 0
+        output = run_pipeline(pipe, inputs)
+        extra = {"atol": 0.0} if threshold == 0.0 else {}
+        records.append(make_record(
+            f"pipeline_transformer_cache/{indicator}_{threshold}",
+            timings,
+            max_abs_diff=max_abs_diff(output, reference),
+            hit_rate=cache.hit_rate,
+            skipped_steps=cache.num_hits,
+            **extra,
+        ))
+    pipe.transformer.disable_block_output_cache()
+    return records
+
+
+@register_benchmark("pipeline_cfg_schedule")
+def bench_pipeline_cfg_schedule(cfg, warmup, repeats):
+    """
+    Pipeline call time when classifier free guidance is only applied to the first part of the denoising steps, and
+    how far the final latents end up from the ones with guidance on every step (a quality proxy).
+    """
+    pipe = build_pipeline(cfg)
+    inputs = make_pipeline_inputs(cfg, guidance_scale=6.0)
+    records = []
+    for use_dynamic_cfg in [False, True]:
+        reference = run_pipeline(pipe, inputs, use_dynamic_cfg=use_dynamic_cfg)
+        for cfg_guidance_end in [1.0, 0.75, 0.5]:
+            kwargs = {"cfg_guidance_end": cfg_guidance_end, "use_dynamic_cfg": use_dynamic_cfg}
+            suffix = "_dynamic" if use_dynamic_cfg else ""
+            records.append(make_record(
+                f"pipeline_cfg_schedule/end_{cfg_guidance_end}{suffix}",
+                time_fn(lambda: run_pipeline(pipe, inputs, **kwargs), warmup, repeats),
+                max_abs_diff=max_abs_diff(run_pipeline(pipe, inputs, **kwargs), reference),
+            ))
+    return records
+
+
+@register_benchmark("pipeline_controlnet_weights")
+def bench_pipeline_controlnet_weights(cfg, warmup, repeats):
+    """
+    Pipeline call time for controlnet weight schedules. With all weights at 0 the controlnet is skipped, which has to
+    give exactly the output of a call without the controlnet.
+    """
+    pipe = build_pipeline(cfg)
+    inputs = make_pipeline_inputs(cfg, guidance_scale=6.0)
+    num_blocks = cfg["controlnet_num_layers"]
+    num_steps = cfg["num_inference_steps"]
+    without_controlnet = run_pipeline(pipe, inputs, controlnet_guidance_start=0.0, controlnet_guidance_end=0.0)
+
+    schedules = {
+        "all_1": 1.0,
+        "all_0": 0.0,
+        "first_block_only": [1.0] + [0.0] * (num_blocks - 1),
+        "linear_decay_per_step": [[1.0 - step / num_steps] for step in range(num_steps)],
+    }
+    records = []
+    for name, controlnet_weights in schedules.items():
+        extra = {}
+        if name == "all_0":
+            output = run_pipeline(pipe, inputs, controlnet_weights=controlnet_weights)
+            extra = {"max_abs_diff": max_abs_diff(output, without_controlnet), "atol": 0.0}
+        records.append(make_record(
+            f"pipeline_controlnet_weights/{name}",
+            time_fn(lambda: run_pipeline(pipe, inputs, controlnet_weights=controlnet_weights), warmup, repeats),
+            **extra,
+        ))
+    return records
+
+
+@register_benchmark("pipeline_batched")
+def bench_pipeline_batched(cfg, warmup, repeats):
+    """
+    Time per video when several (sample, seed) pairs are denoised in one pipeline call, with one generator per pair,
+    compared to one call per video. The batched videos have to match the unbatched ones up to float rounding.
+    """
+    pipe = build_pipeline(cfg)
+    batch_size = 4
+    inputs = make_pipeline_inputs(cfg, batch_size=batch_size, guidance_scale=6.0)
+    # the initial noise is drawn from the generators, like in `do_inference`
+    del inputs["latents"]
+
+    def generators(seeds):
+        return [torch.Generator().manual_seed(seed) for seed in seeds]
+
+    def sample_inputs(i):
+        sample = {}
+        for key, value in inputs.items():
+            if key == "controlnet_latents":
+                # the CFG batch is [uncond, cond], and the controlnet latents are duplicated the same way
+                sample[key] = torch.cat([value[i:i + 1], value[batch_size + i:batch_size + i + 1]])
+            elif torch.is_tensor(value):
+                sample[key] = value[i:i + 1]
+            else:
+                sample[key] = value
+        return sample
+
+    def unbatched():
+        return torch.cat([pipe(**sample_inputs(i), generator=generators([i])).frames for i in range(batch_size)])
+
+    def batched():
+        return pipe(**inputs, generator=generators(range(batch_size))).frames
+
+    unbatched_timings = time_fn(unbatched, warmup, repeats)
+    batched_timings = time_fn(batched, warmup, repeats)
+    for timings in [unbatched_timings, batched_timings]:
+        for key in ["median_s", "mean_s", "min_s", "max_s"]:
+            timings[key] /= batch_size
+    return [
+        make_record("pipeline_batched/per_video_unbatched", unbatched_timings),
+        make_record(
+            "pipeline_batched/per_video_batched",
+            batched_timings,
+            max_abs_diff=max_abs_diff(batched(), unbatched()),
+            atol=1e-4,
+            batch_size=batch_size,
+        ),
+    ]
+
+
+@register_benchmark("inference_session")
+def bench_inference_session(cfg, warmup, repeats):
+    """
+    Per-sample overhead outside the denoising loop: reconfiguring the pipeline for every sample, like `do_inference`
+    used to (scheduler from config, `pipe.to`, embeddings from disk, garbage collection), against a warm
+    `InferenceSession`. Both have to produce the same latents.
+    """
+    import gc
+    import tempfile
+
+    from diffusers import CogVideoXDPMScheduler
+    from pipelines.inference_session import InferenceSession
+
+    pipe = build_pipeline(cfg)
+    inputs = make_pipeline_inputs(cfg, guidance_scale=6.0)
+    prompt_embeds = inputs.pop("prompt_embeds")
+    negative_prompt_embeds = inputs.pop("negative_prompt_embeds")
+
+    with tempfile.TemporaryDirectory() as embeddings_dir:
+        embedding_map = {"prompt": f"{embeddings_dir}/prompt.pt", "": f"{embeddings_dir}/negative.pt"}
+        torch.save(prompt_embeds, embedding_map["prompt"])
+        torch.save(negative_prompt_embeds, embedding_map[""])
+
+        def reconfigure():
+            pipe.scheduler = CogVideoXDPMScheduler.from_config(pipe.scheduler.config)
+            pipe.to("cpu")
+            gc.collect()
+            return {"prompt_embeds": torch.load(embedding_map["prompt"]), "negative_prompt_embeds": torch.load(embedding_map[""])}
+
+        def reconfigure_and_generate():
+            return run_pipeline(pipe, {**inputs, **reconfigure()})
+
+        reference = reconfigure_and_generate()
+        records = [
+            make_record("inference_session/overhead_reconfigure", time_fn(reconfigure, warmup, repeats)),
+            make_record("inference_session/per_sample_reconfigure", time_fn(reconfigure_and_generate, warmup, repeats)),
+        ]
+
+        session = InferenceSession(pipe, "cpu", embedding_map=embedding_map, pipeline_kwargs=inputs)
+        request = {"prompt": "prompt", "seeds": [0]}
+
+        def generate():
+            return session.generate(request).frames
+
+        def session_overhead():
+            return session.get_prompt_embeds("prompt"), session.get_prompt_embeds("")
+
+        records += [
+            make_record("inference_session/overhead_session", time_fn(session_overhead, warmup, repeats)),
+            make_record(
+                "inference_session/per_sample_session",
+                time_fn(generate, warmup, repeats),
+                max_abs_diff=max_abs_diff(generate(), reference),
+                atol=0.0,
+            ),
+        ]
+    return records
+
+
+@register_benchmark("inference_session_sweep")
+def bench_inference_session_sweep(cfg, warmup, repeats):
+    """
+    A force sweep over one image and prompt: one `generate` call per row against `generate_sweep`, which encodes the
+    image and draws the noise once and batches the rows. Every row of the sweep has to match its own call.
+    """
+    import tempfile
+
+    from pipelines.inference_session import InferenceSession
+
+    num_rows = 4
+    pipe = build_pipeline(cfg)
+    inputs = make_pipeline_inputs(cfg, guidance_scale=6.0)
+    image = inputs.pop("image")
+    # the same blob at different strengths, like the force column of a benchmark CSV
+    controlnet_rows = torch.cat([make_point_force_frames(cfg) * (row + 1) / num_rows for row in range(num_rows)])
+
+    with tempfile.TemporaryDirectory() as embeddings_dir:
+        embedding_map = {"prompt": f"{embeddings_dir}/prompt.pt", "": f"{embeddings_dir}/negative.pt"}
+        torch.save(inputs.pop("prompt_embeds"), embedding_map["prompt"])
+        torch.save(inputs.pop("negative_prompt_embeds"), embedding_map[""])
+        for key in ["latents", "controlnet_latents"]:
+            del inputs[key]
+        session = InferenceSession(pipe, "cpu", embedding_map=embedding_map, pipeline_kwargs=inputs)
+        session.get_prompt_embeds("prompt")
+
+    def row_by_row():
+        return torch.cat([
+            session.generate({
+                "image": image,
+                "prompt": "prompt",
+                "controlnet_latents": torch.cat([controlnet_rows[row:row + 1]] * 2),
+                "seeds": [0],
+            }).frames
+            for row in range(num_rows)
+        ])
+
+    def sweep():
+        return session.generate_sweep({
+            "image": image,
+            "prompt": "prompt",
+            "controlnet_latents": torch.cat([controlnet_rows] * 2),
+            "seed": 0,
+        })
+
+    row_timings = time_fn(row_by_row, warmup, repeats)
+    sweep_timings = time_fn(sweep, warmup, repeats)
+    for timings in [row_timings, sweep_timings]:
+        for key in ["median_s", "mean_s", "min_s", "max_s"]:
+            timings[key] /= num_rows
+    return [
+        make_record("inference_session_sweep/per_row_generate", row_timings),
+        make_record(
+            "inference_session_sweep/per_row_sweep",
+            sweep_timings,
+            max_abs_diff=max_abs_diff(sweep(), row_by_row()),
+            atol=1e-4,
+            num_rows=num_rows,
+        ),
+    ]
+
+
+@register_benchmark("vae_decode_streaming")
+def bench_vae_decode_streaming(cfg, warmup, repeats):
+    """
+    Decoding the final latents to uint8 frames in one go (`decode_latents`, `postprocess_video`, then the uint8
+    conversion of `export_to_video`) against the chunked `decode_latents_streaming`, without and with VAE tiling. The
+    streamed frames have to be identical; `peak_video_bytes` is the largest decoded float video held at once.
+    """
+    from pipelines.controlnet_img2vid_pipeline import video_chunk_to_frames
+
+    pipe = build_pipeline(cfg)
+    generator = torch.Generator().manual_seed(0)
+    # at least three temporal chunks, like the 13 latent frames of the full model
+    num_latent_frames = max(cfg["latent_frames"], 2 * pipe.vae.num_latent_frames_batch_size + 1)
+    latents = torch.randn(
+        (2, num_latent_frames, LATENT_CHANNELS, cfg["latent_height"], cfg["latent_width"]), generator=generator
+    )
+
+    def decode():
+        with torch.no_grad():
+            video = pipe.decode_latents(latents)
+            video = pipe.video_processor.postprocess_video(video=video, output_type="np")
+        return (video * 255).astype("uint8"), video.nbytes
+
+    def decode_streaming():
+        with torch.no_grad():
+            chunks = list(pipe.decode_latents_streaming(latents))
+        return torch.cat([torch.from_numpy((video_chunk_to_frames(chunk) * 255).astype("uint8")) for chunk in chunks], dim=1).numpy(), max(
+            chunk.numel() * 4 for chunk in chunks
+        )
+
+    records = []
+    for tiling in [False, True]:
+        if tiling:
+            pipe.vae.enable_tiling()
+        suffix = "_tiled" if tiling else ""
+        reference, reference_bytes = decode()
+        frames, chunk_bytes = decode_streaming()
+        records += [
+            make_record(f"vae_decode_streaming/full{suffix}", time_fn(decode, warmup, repeats), peak_video_bytes=reference_bytes),
+            make_record(
+                f"vae_decode_streaming/streaming{suffix}",
+                time_fn(decode_streaming, warmup, repeats),
+                max_abs_diff=float(abs(frames.astype("int16") - reference.astype("int16")).max()),
+                atol=0.0,
+                peak_video_bytes=chunk_bytes,
+            ),
+        ]
+    pipe.vae.disable_tiling()
+    return records
+
+
+def _reference_point_force_signal(force_percent, angle, x_pos, y_pos, num_frames, height=480, width=720):
+    # the original per-frame loop of `ForcePromptingDataset_PointForce.load_controlnet_signal`
+    import math
+
+    controlnet_signal = torch.zeros((num_frames, 3, height, width))
+    x_pos_start = x_pos*width
+    y_pos_start = (1-y_pos)*height
+    total_displacement = width / 8 + (width / 2 - width / 8) * force_percent
+    x_pos_end = x_pos_start + total_displacement * math.cos(angle * torch.pi / 180.0)
+    y_pos_end = y_pos_start - total_displacement * math.sin(angle * torch.pi / 180.0)
+    y_grid, x_grid = torch.meshgrid(torch.arange(height), torch.arange(width), indexing='ij')
+    for frame in range(num_frames):
+        t = frame / (num_frames-1)
+        x_pos_ = x_pos_start * (1-t) + x_pos_end * t
+        y_pos_ = y_pos_start * (1-t) + y_pos_end * t
+        squared_dist = (x_grid - x_pos_) ** 2 + (y_grid - y_pos_) ** 2
+        gaussian = 1.0 * torch.exp(-squared_dist / (2.0 * 20 ** 2))
+        blob_tensor = torch.zeros((3, height, width))
+        for c in range(3):
+            blob_tensor[c] = gaussian
+        controlnet_signal[frame] += blob_tensor
+    return controlnet_signal
+
+
+def _reference_wind_force_signal(force_percent, angle, num_frames, height=480, width=720):
+    # the original `ForcePromptingDataset_WindForce.load_controlnet_signal`
+    import math
+
+    controlnet_signal = torch.zeros((num_frames, 3, height, width))
+    controlnet_signal[:, 0] = -1 + 2*force_percent
+    controlnet_signal[:, 1] = math.cos(angle * torch.pi / 180.0)
+    controlnet_signal[:, 2] = math.sin(angle * torch.pi / 180.0)
+    return controlnet_signal
+
+
+@register_benchmark("control_signal")
+def bench_control_signal(cfg, warmup, repeats):
+    """
+    Building the point- and wind-force control signals at the dataset resolution with the original per-frame code
+    against `data.control_signals`, which has to give identical frames, and the batched resize of `prepare_frames`
+    against resizing and cropping the frames one by one.
+    """
+    from torchvision import transforms
+
+    from data.control_signals import point_force_control_signal, wind_force_control_signal
+    from pipelines.controlnet_img2vid_pipeline import prepare_frames, resize_for_crop
+
+    num_frames = pixel_frames(cfg)
+    point_args = (0.7, 30.0, 0.4, 0.6)
+    wind_args = (0.7, 30.0)
+
+    reference = _reference_point_force_signal(*point_args, num_frames)
+    records = [
+        make_record(
+            "control_signal/point_force_reference",
+            time_fn(lambda: _reference_point_force_signal(*point_args, num_frames), warmup, repeats),
+        ),
+        make_record(
+            "control_signal/point_force",
+            time_fn(lambda: point_force_control_signal(*point_args, num_frames=num_frames), warmup, repeats),
+            max_abs_diff=max_abs_diff(point_force_control_signal(*point_args, num_frames=num_frames), reference),
+            atol=0.0,
+        ),
+    ]
+
+    reference = _reference_wind_force_signal(*wind_args, num_frames)
+    records += [
+        make_record(
+            "control_signal/wind_force_reference",
+            time_fn(lambda: _reference_wind_force_signal(*wind_args, num_frames), warmup, repeats),
+        ),
+        make_record(
+            "control_signal/wind_force",
+            time_fn(lambda: wind_force_control_signal(*wind_args, num_frames=num_frames), warmup, repeats),
+            max_abs_diff=max_abs_diff(wind_force_control_signal(*wind_args, num_frames=num_frames), reference),
+            atol=0.0,
+        ),
+    ]
+
+    # frames at the target size are passed through, other sizes are resized and cropped as one stack
+    frames = point_force_control_signal(*point_args, num_frames=num_frames, height=240, width=320)[None]
+
+    def resize_per_frame():
+        return torch.stack([
+            transforms.functional.center_crop(resize_for_crop(x, 480, 720), (480, 720)) for x in frames[0]
+        ])[None]
+
+    records += [
+        make_record("control_signal/prepare_resize_reference", time_fn(resize_per_frame, warmup, repeats)),
+        make_record(
+            "control_signal/prepare_resize",
+            time_fn(lambda: prepare_frames(frames, (480, 720)), warmup, repeats),
+            max_abs_diff=max_abs_diff(prepare_frames(frames, (480, 720)), resize_per_frame()),
+            atol=0.0,
+        ),
+    ]
+    return records
+
+
+class _ShardingDataset:
+    # just the part of the force prompting datasets that `utils.sharding` looks at
+    media_type = "image"
+
+    def __init__(self, images):
+        import pandas as pd
+
+        self.df = pd.DataFrame({"image": images})
+
+    def __len__(self):
+        return len(self.df)
+
+
+# (conditioning image, normalized force) of every sample: sweeps of 3, 2 and 1 rows over three images
+_SHARDING_SAMPLES = [("a", 0.2), ("a", 0.5), ("b", 0.3), ("a", 0.8), ("c", 0.6), ("b", 0.9)]
+
+
+def _generate_shard(cfg, indices, output_dir, shard_index):
+    # generates the samples `indices` with a seed per sample, and saves their latents and the manifest shard
+    from data.control_signals import point_force_control_signal
+    from pipelines.inference_session import InferenceSession
+    from utils.sharding import write_manifest_shard
+
+    pipe = build_pipeline(cfg)
+    inputs = make_pipeline_inputs(cfg, guidance_scale=6.0)
+    del inputs["controlnet_latents"], inputs["latents"], inputs["image"]
+    session = InferenceSession(pipe, "cpu", pipeline_kwargs=inputs)
+
+    records = []
+    for index in indices:
+        image_name, force = _SHARDING_SAMPLES[index]
+        generator = torch.Generator().manual_seed(ord(image_name))
+        controlnet_frames = point_force_control_signal(
+            force, 30.0, 0.5, 0.5, num_frames=inputs["num_frames"], height=inputs["height"], width=inputs["width"], radius=2.5
+        )
+        latents = session.generate({
+            "image": torch.rand((1, 3, inputs["height"], inputs["width"]), generator=generator),
+            "controlnet_frames": controlnet_frames[None],
+            "seeds": [index],
+        }).frames
+        path = os.path.join(output_dir, f"{index}.pt")
+        torch.save(latents, path)
+        records.append({"dataset_index": index, "video_index": 0, "process_index": shard_index, "videos": [path]})
+    write_manifest_shard(output_dir, shard_index, records)
+
+
+def _sharded_inference_worker(rank, num_shards, cfg, init_file, output_dir, num_threads):
+    import torch.distributed as dist
+
+    from utils.sharding import merge_manifest_shards, shard_dataset_indices
+
+    # the same number of threads as the single process, so that the reductions match
+    torch.set_num_threads(num_threads)
+    dist.init_process_group("gloo", init_method=f"file://{init_file}", rank=rank, world_size=num_shards)
+    dataset = _ShardingDataset([image_name for image_name, _ in _SHARDING_SAMPLES])
+    _generate_shard(cfg, shard_dataset_indices(dataset, num_shards, rank), output_dir, rank)
+    dist.barrier()
+    if rank == 0:
+        merge_manifest_shards(output_dir, num_shards)
+    dist.destroy_process_group()
+
+
+@register_benchmark("sharded_inference")
+def bench_sharded_inference(cfg, warmup, repeats):
+    """
+    Inference sharded over two gloo processes on CPU against one process generating every sample. Every sample has its
+    own seed, so the merged manifest has to point at the same latents whichever process generated them. The balance
+    records compare the largest shard of the longest-processing-time assignment with a round robin one on skewed
+    group sizes (`makespan`, in samples).
+    """
+    import json
+    import tempfile
+
+    import torch.multiprocessing as mp
+
+    from utils.sharding import balance_shards
+
+    num_shards = 2
+    records = []
+    costs = [8, 7, 6, 5, 4, 3, 2, 2, 1, 1, 1]
+    for num_balance_shards in [2, 4]:
+        round_robin = [sum(costs[shard::num_balance_shards]) for shard in range(num_balance_shards)]
+        balanced = [sum(costs[item] for item in shard) for shard in balance_shards(costs, num_balance_shards)]
+        records += [
+            make_record(f"sharded_inference/balance_{num_balance_shards}_round_robin", makespan=max(round_robin)),
+            make_record(f"sharded_inference/balance_{num_balance_shards}_lpt", makespan=max(balanced)),
+        ]
+
+    with tempfile.TemporaryDirectory() as output_dir:
+        reference_dir = os.path.join(output_dir, "reference")
+        sharded_dir = os.path.join(output_dir, "sharded")
+        os.makedirs(reference_dir)
+        os.makedirs(sharded_dir)
+
+        def single_process():
+            _generate_shard(cfg, list(range(len(_SHARDING_SAMPLES))), reference_dir, 0)
+
+        def sharded():
+            init_file = os.path.join(output_dir, f"init_{time.perf_counter_ns()}")
+            mp.spawn(_sharded_inference_worker, args=(num_shards, cfg, init_file, sharded_dir, torch.get_num_threads()), nprocs=num_shards)
+
+        # spawning the processes and building the pipelines dominates at this size, so a single repeat is enough
+        records.append(make_record("sharded_inference/single_process", time_fn(single_process, 0, 1)))
+        records.append(make_record("sharded_inference/sharded_gloo", time_fn(sharded, 0, 1)))
+
+        with open(os.path.join(sharded_dir, "inference_manifest.json")) as f:
+            manifest = json.load(f)
+        assert [record["dataset_index"] for record in manifest] == list(range(len(_SHARDING_SAMPLES)))
+        records[-1].update(
+            max_abs_diff=max_abs_diff(
+                [torch.load(record["videos"][0]) for record in manifest],
+                [torch.load(os.path.join(reference_dir, f"{index}.pt")) for index in range(len(_SHARDING_SAMPLES))],
+            ),
+            atol=0.0,
+            samples_per_process=[sum(record["process_index"] == rank for record in manifest) for rank in range(num_shards)],
+        )
+    return records
+
+
+@register_benchmark("result_index")
+def bench_result_index(cfg, warmup, repeats):
+    """
+    Resuming an interrupted force sweep with a `ResultIndex`: a full run of every row against a rerun after half of
+    the rows were written, which only generates the missing ones. The resumed outputs have to match the full run.
+    `lookup` is the cost of hashing a result key and checking the index for one row.
+    """
+    import tempfile
+
+    from pipelines.inference_session import InferenceSession
+    from utils.result_index import ResultIndex, result_key, tensor_digest
+
+    pipe = build_pipeline(cfg)
+    inputs = make_pipeline_inputs(cfg, guidance_scale=6.0)
+    controlnet_frames = inputs.pop("controlnet_latents")[:1]
+    image = inputs.pop("image")
+    del inputs["latents"]
+    session = InferenceSession(pipe, "cpu", pipeline_kwargs=inputs)
+    settings = {name: inputs[name] for name in ["num_inference_steps", "guidance_scale", "height", "width", "num_frames"]}
+    forces = [0.1, 0.3, 0.5, 0.7, 0.9, 1.0]
+
+    def get_key(force):
+        return result_key(image=tensor_digest(image), prompt="prompt", normalized_force=force, seed=0, **settings)
+
+    def run(output_dir, rows):
+        # the driver loop of `do_inference`, with the videos replaced by the latents
+        result_index = ResultIndex(output_dir)
+        latents = []
+        for force in rows:
+            key = get_key(force)
+            record = result_index.lookup(key)
+            if record is None:
+                path = os.path.join(output_dir, f"force_{force}.pt")
+                torch.save(session.generate({
+                    "image": image, "controlnet_frames": controlnet_frames * force, "seeds": [0],
+                }).frames, path)
+                record = {"videos": [path]}
+                result_index.add(key, record)
+                result_index.save()
+            latents.append(torch.load(record["videos"][0]))
+        return latents, result_index
+
+    with tempfile.TemporaryDirectory() as output_dir:
+        def full_run():
+            run_dir = tempfile.mkdtemp(dir=output_dir)
+            return run(run_dir, forces)
+
+        def resumed_run():
+            run_dir = tempfile.mkdtemp(dir=output_dir)
+            run(run_dir, forces[:len(forces) // 2]) # interrupted after half of the rows
+            start = time.perf_counter()
+            latents, result_index = run(run_dir, forces)
+            return latents, result_index, time.perf_counter() - start
+
+        reference, _ = full_run()
+        latents, result_index, _ = resumed_run()
+        resume_times = [resumed_run()[2] for _ in range(repeats)]
+
+        return [
+            make_record("result_index/full_run", time_fn(full_run, 0, repeats)),
+            make_record(
+                "result_index/resumed_run",
+                {
+                    "median_s": statistics.median(resume_times),
+                    "mean_s": statistics.mean(resume_times),
+                    "min_s": min(resume_times),
+                    "max_s": max(resume_times),
+                    "repeats": len(resume_times),
+                },
+                max_abs_diff=max_abs_diff(latents, reference),
+                atol=0.0,
+                cache_hits=result_index.num_hits,
+                cache_misses=result_index.num_misses,
+            ),
+            make_record("result_index/lookup", time_fn(lambda: result_index.lookup(get_key(0.5)), warmup, repeats)),
+        ]
+
+
+@register_benchmark("multi_csv")
+def bench_multi_csv(cfg, warmup, repeats):
+    """
+    Generating the rows of several small CSVs with one run per CSV, which loads the models from disk every time,
+    against one run that loads them once and streams through all the rows. Both have to give the same latents.
+    """
+    import tempfile
+
+    from pipelines.inference_session import InferenceSession
+
+    inputs = make_pipeline_inputs(cfg, guidance_scale=6.0)
+    controlnet_frames = inputs.pop("controlnet_latents")[:1]
+    image = inputs.pop("image")
+    del inputs["latents"]
+    # four CSVs of two rows, like the per-object CSVs of the point-force benchmark
+    csvs = [[0.2, 0.8], [0.3, 0.7], [0.4, 0.6], [0.5, 1.0]]
+
+    with tempfile.TemporaryDirectory() as checkpoint_dir:
+        pipe = build_pipeline(cfg)
+        for name in ["transformer", "vae", "controlnet"]:
+            torch.save(getattr(pipe, name).state_dict(), os.path.join(checkpoint_dir, f"{name}.pt"))
+
+        def load_session():
+            pipe = build_pipeline(cfg)
+            for name in ["transformer", "vae", "controlnet"]:
+                getattr(pipe, name).load_state_dict(torch.load(os.path.join(checkpoint_dir, f"{name}.pt")))
+            return InferenceSession(pipe, "cpu", pipeline_kwargs=inputs)
+
+        def generate(session, forces):
+            return [
+                session.generate({"image": image, "controlnet_frames": controlnet_frames * force, "seeds": [0]}).frames
+                for force in forces
+            ]
+
+        def run_per_csv():
+            return [latents for forces in csvs for latents in generate(load_session(), forces)]
+
+        def run_once():
+            session = load_session()
+            return [latents for forces in csvs for latents in generate(session, forces)]
+
+        reference = run_per_csv()
+        return [
+            make_record("multi_csv/run_per_csv", time_fn(run_per_csv, warmup, repeats)),
+            make_record("multi_csv/load_once", time_fn(load_session, warmup, repeats)),
+            make_record(
+                "multi_csv/run_once",
+                time_fn(run_once, warmup, repeats),
+                max_abs_diff=max_abs_diff(run_once(), reference),
+                atol=0.0,
+            ),
+        ]
+
+
+@register_benchmark("decode_worker")
+def bench_decode_worker(cfg, warmup, repeats):
+    """
+    Generating and decoding a few batches one after the other, with the decode inside the pipeline call, against
+    denoising to latents and decoding them on a `DecodeWorker` while the next batch is denoised. The frames have to be
+    identical. `chunks_decoded_during_denoising` counts the decoded chunks that the worker finished while the main
+    thread was denoising a later batch; the speedup needs more than one core (or a GPU), on a single core the two
+    stages only take turns.
+    """
+    from pipelines.decode_worker import DecodeWorker
+
+    pipe = build_pipeline(cfg)
+    inputs = make_pipeline_inputs(cfg, guidance_scale=6.0)
+    del inputs["output_type"]
+    num_batches = 3
+
+    def sequential():
+        frames = []
+        for batch in range(num_batches):
+            run_pipeline(pipe, {**inputs, "latents": inputs["latents"] + batch}, decoded_frames_callback=frames.append)
+        return frames
+
+    def pipelined(intervals=None):
+        frames = []
+        decode_worker = DecodeWorker(pipe, "cpu")
+
+        def frames_callback(chunk):
+            frames.append(chunk)
+            if intervals is not None:
+                intervals["decode"].append(time.perf_counter())
+
+        for batch in range(num_batches):
+            start = time.perf_counter()
+            latents = run_pipeline(pipe, {**inputs, "latents": inputs["latents"] + batch}, output_type="latent")
+            if intervals is not None:
+                intervals["denoise"].append((start, time.perf_counter()))
+            decode_worker.submit(latents, frames_callback)
+        decode_worker.close()
+        return frames
+
+    reference = sequential()
+    intervals = {"denoise": [], "decode": []}
+    frames = pipelined(intervals)
+    # a decoded chunk that arrived while a later batch was being denoised
+    overlapping_chunks = sum(
+        any(start <= chunk_time <= end for start, end in intervals["denoise"]) for chunk_time in intervals["decode"]
+    )
+    return [
+        make_record("decode_worker/sequential", time_fn(sequential, warmup, repeats)),
+        make_record(
+            "decode_worker/pipelined",
+            time_fn(pipelined, warmup, repeats),
+            max_abs_diff=max_abs_diff(
+                [torch.from_numpy(chunk) for chunk in frames], [torch.from_numpy(chunk) for chunk in reference]
+            ),
+            atol=0.0,
+            decoded_chunks=len(frames),
+            chunks_decoded_during_denoising=overlapping_chunks,
+        ),
+    ]
+
+
+@register_benchmark("block_streaming")
+def bench_block_streaming(cfg, warmup, repeats):
+    """
+    The pipeline with the transformer and controlnet blocks streamed from host memory (`enable_block_streaming`) in
+    the simulated CPU mode, against the same weights resident. The frames have to be identical, also with the
+    transformer block output cache, whose indicator uses the first block outside of its forward. Records the bytes
+    copied per denoising step and the most blocks that were on the "device" at once.
+    """
+    pipe = build_pipeline(cfg)
+    streamed_pipe = build_pipeline(cfg)
+    streamed_pipe.transformer.enable_block_streaming("cpu", simulate=True)
+    streamed_pipe.controlnet.enable_block_streaming("cpu", simulate=True)
+    inputs = make_pipeline_inputs(cfg, guidance_scale=6.0)
+
+    reference = run_pipeline(pipe, inputs)
+    transformer_streaming = streamed_pipe.transformer.block_streaming
+    controlnet_streaming = streamed_pipe.controlnet.block_streaming
+    frames = run_pipeline(streamed_pipe, inputs)
+    bytes_per_step = (transformer_streaming.bytes_transferred + controlnet_streaming.bytes_transferred) / cfg["num_inference_steps"]
+
+    for model in (pipe.transformer, streamed_pipe.transformer):
+        model.enable_block_output_cache(threshold=1.0)
+    cached_reference = run_pipeline(pipe, inputs)
+    cached_frames = run_pipeline(streamed_pipe, inputs)
+    cache_hits = streamed_pipe.transformer.block_output_cache.num_hits
+    for model in (pipe.transformer, streamed_pipe.transformer):
+        model.disable_block_output_cache()
+
+    return [
+        make_record("block_streaming/resident", time_fn(lambda: run_pipeline(pipe, inputs), warmup, repeats)),
+        make_record(
+            "block_streaming/streamed",
+            time_fn(lambda: run_pipeline(streamed_pipe, inputs), warmup, repeats),
+            max_abs_diff=max_abs_diff(frames, reference),
+            atol=0.0,
+            transferred_bytes_per_step=bytes_per_step,
+            block_bytes=transformer_streaming.total_block_bytes + controlnet_streaming.total_block_bytes,
+            max_transformer_blocks_on_device=transformer_streaming.max_blocks_on_device,
+            max_controlnet_blocks_on_device=controlnet_streaming.max_blocks_on_device,
+        ),
+        make_record(
+            "block_streaming/streamed_with_block_output_cache",
+            max_abs_diff=max_abs_diff(cached_frames, cached_reference),
+            atol=0.0,
+            skipped_steps=cache_hits,
+        ),
+    ]
@@ -0,0 +1,241 @@
+import functools
+import os
+import tempfile
+
+import numpy as np
+import torch
+
+from benchmarks.common import make_record, max_abs_diff, register_benchmark, time_fn
+
+
+def make_video(num_frames=13, height=480, width=720, seed=0):
+    """
+    A smooth random video in [0, 1], (num_frames, height, width, 3), like the float output of the pipeline. The
+    overlays use fixed pixel offsets, so it has the full resolution and fewer frames.
+    """
+    generator = torch.Generator().manual_seed(seed)
+    video = torch.rand((num_frames, 3, height // 16, width // 16), generator=generator)
+    video = torch.nn.functional.interpolate(video, size=(height, width), mode="bilinear")
+    return video.permute(0, 2, 3, 1).contiguous().numpy()
+
+
+@register_benchmark("video_export")
+def bench_video_export(cfg, warmup, repeats):
+    """
+    Writing a generated video and its two overlay videos: three `export_to_video` calls on float videos, like
+    `do_inference` used to, against one `MultiOutputVideoWriter` that gets the float frames once. The overlaid frames
+    have to be exactly those of the float path.
+    """
+    from diffusers.utils import export_to_video
+
+    # imported here so that the other benchmarks don't need the inference dependencies
+    from inference import (
+        add_aesthetic_point_force_prompt_to_video,
+        control_signal_overlay,
+        draw_point_force_prompt,
+        force_prompt_overlay,
+    )
+    from utils.video_utils import MultiOutputVideoWriter
+
+    video = make_video()
+    control_signal_video = make_video(seed=1) * 2 - 1
+    prompt = {"force": 0.5, "angle": 45.0, "x_pos": 0.4, "y_pos": 0.6}
+    overlays = {
+        "control_signal": control_signal_overlay(control_signal_video),
+        "pretty": force_prompt_overlay(functools.partial(draw_point_force_prompt, **prompt), num_frames_with_signal=8),
+    }
+
+    with tempfile.TemporaryDirectory() as output_dir:
+        paths = {name: os.path.join(output_dir, f"{name}.mp4") for name in ["raw", "control_signal", "pretty"]}
+
+        def export_float_videos():
+            export_to_video(video, paths["raw"], fps=8)
+            export_to_video(np.clip(video + control_signal_video, 0, 1.0), paths["control_signal"], fps=8)
+            export_to_video(
+                add_aesthetic_point_force_prompt_to_video(video, num_frames_with_signal=8, **prompt), paths["pretty"], fps=8
+            )
+
+        def export_multi_output(wait=True, prefix=""):
+            video_writer = MultiOutputVideoWriter(
+                {
+                    os.path.join(output_dir, f"{prefix}raw.mp4"): None,
+                    os.path.join(output_dir, f"{prefix}control_signal.mp4"): overlays["control_signal"],
+                    os.path.join(output_dir, f"{prefix}pretty.mp4"): overlays["pretty"],
+                },
+                fps=8,
+            )
+            video_writer.write(video)
+            video_writer.close(wait=wait)
+            return video_writer
+
+        # how long the caller is blocked when the encoding finishes in the background
+        video_writers = []
+        enqueue_timings = time_fn(
+            lambda: video_writers.append(export_multi_output(wait=False, prefix=f"{len(video_writers)}_")), warmup, repeats
+        )
+        for video_writer in video_writers:
+            video_writer.wait()
+
+        records = [
+            make_record("video_export/export_to_video", time_fn(export_float_videos, warmup, repeats)),
+            make_record("video_export/multi_output", time_fn(export_multi_output, warmup, repeats)),
+            make_record("video_export/multi_output_blocking", enqueue_timings),
+        ]
+
+    references = {
+        "control_signal": np.clip(video + control_signal_video, 0, 1.0),
+        "pretty": add_aesthetic_point_force_prompt_to_video(video, num_frames_with_signal=8, **prompt),
+    }
+    for name, overlay in overlays.items():
+        # the overlay gets the frames in two chunks, like from the streaming decode
+        overlaid = np.concatenate([overlay(video[:5], 0), overlay(video[5:], 5)])
+        records.append(make_record(
+            f"video_export/overlay_{name}",
+            max_abs_diff=max_abs_diff(torch.from_numpy(overlaid), torch.from_numpy((references[name] * 255).astype(np.uint8))),
+            atol=0.0,
+        ))
+    return records
+
+
+def _reference_tensor_to_video_ffmpeg(tensor, output_filename, fps=8, ffmpeg_exe="ffmpeg"):
+    # the original PNG-based `tensor_to_video_ffmpeg`, with its prints left out
+    import subprocess
+
+    import cv2
+
+    num_frames, channels, height, width = tensor.shape
+    if tensor.max() <= 1.0:
+        tensor = tensor * 255
+    frames = tensor.numpy().astype(np.uint8)
+    with tempfile.TemporaryDirectory() as temp_dir:
+        for i in range(num_frames):
+            frame = frames[i].transpose(1, 2, 0)[:, :, ::-1]
+            cv2.imwrite(os.path.join(temp_dir, f"frame_{i:04d}.png"), frame)
+        ffmpeg_cmd = [
+            ffmpeg_exe, '-y', '-loglevel', 'error', '-framerate', str(fps),
+            '-i', os.path.join(temp_dir, 'frame_%04d.png'),
+            '-c:v', 'libx264', '-profile:v', 'high', '-crf', '20', '-pix_fmt', 'yuv420p', output_filename,
+        ]
+        subprocess.run(ffmpeg_cmd, check=True)
+
+
+@register_benchmark("tensor_to_video_ffmpeg")
+def bench_tensor_to_video_ffmpeg(cfg, warmup, repeats):
+    """
+    `tensor_to_video_ffmpeg` streaming raw frames into ffmpeg against the original version that goes through PNG files.
+    Both feed ffmpeg the same pixels, so the decoded videos have to be identical.
+    """
+    import contextlib
+    import io
+
+    import imageio
+
+    from utils.video_utils import get_ffmpeg_exe, tensor_to_video_ffmpeg
+
+    tensor = torch.from_numpy(make_video(num_frames=25)).permute(0, 3, 1, 2)
+
+    def read_video(path):
+        with imageio.get_reader(path) as reader:
+            return torch.from_numpy(np.stack([reader.get_data(i) for i in range(reader.count_frames())]))
+
+    with tempfile.TemporaryDirectory() as output_dir:
+        reference_path = os.path.join(output_dir, "reference.mp4")
+        path = os.path.join(output_dir, "rawvideo.mp4")
+
+        def rawvideo():
+            with contextlib.redirect_stdout(io.StringIO()):
+                tensor_to_video_ffmpeg(tensor, path, fps=8)
+
+        def png():
+            _reference_tensor_to_video_ffmpeg(tensor, reference_path, fps=8, ffmpeg_exe=get_ffmpeg_exe())
+
+        records = [
+            make_record("tensor_to_video_ffmpeg/png", time_fn(png, warmup, repeats)),
+            make_record("tensor_to_video_ffmpeg/rawvideo", time_fn(rawvideo, warmup, repeats)),
+        ]
+        records[-1]["max_abs_diff"] = max_abs_diff(read_video(path), read_video(reference_path))
+        records[-1]["atol"] = 0.0
+
+        # values in [0, 255], which the original detected from the data, are passed with their range
+        with contextlib.redirect_stdout(io.StringIO()):
+            tensor_to_video_ffmpeg(tensor * 255, path, fps=8, max_value=255.0)
+        _reference_tensor_to_video_ffmpeg(tensor * 255, reference_path, fps=8, ffmpeg_exe=get_ffmpeg_exe())
+        records.append(make_record(
+            "tensor_to_video_ffmpeg/rawvideo_0_255",
+            max_abs_diff=max_abs_diff(read_video(path), read_video(reference_path)),
+            atol=0.0,
+        ))
+    return records
+
+
+@register_benchmark("force_prompt_overlay")
+def bench_force_prompt_overlay(cfg, warmup, repeats):
+    """
+    The force prompt overlays against the original `add_aesthetic_*` functions (`benchmarks.reference_overlays`),
+    which draw on every frame with a float to uint8 round trip per frame: the float functions, which round trip all
+    frames at once, and the uint8 overlays of the video writer, drawn on every frame or rendered once into an RGBA mask
+    and composited onto all annotated frames. All results have to match the original pixels exactly.
+    """
+    from benchmarks.reference_overlays import (
+        add_aesthetic_point_force_prompt_to_video as original_point_force_prompt,
+        add_aesthetic_wind_force_prompt_to_video as original_wind_force_prompt,
+    )
+    from inference import (
+        add_aesthetic_point_force_prompt_to_video,
+        add_aesthetic_wind_force_prompt_to_video,
+        draw_point_force_prompt,
+        draw_wind_force_prompt,
+        force_prompt_overlay,
+    )
+
+    video = make_video()
+    frames = (video * 255).astype(np.uint8)
+    point_prompt = {"force": 0.5, "angle": 45.0, "x_pos": 0.4, "y_pos": 0.6}
+    wind_prompt = {"force": 0.7, "angle": 135.0}
+    cases = {
+        "point": (
+            functools.partial(original_point_force_prompt, **point_prompt),
+            functools.partial(add_aesthetic_point_force_prompt_to_video, **point_prompt),
+            functools.partial(draw_point_force_prompt, **point_prompt),
+            8,
+        ),
+        "wind": (
+            functools.partial(original_wind_force_prompt, **wind_prompt),
+            functools.partial(add_aesthetic_wind_force_prompt_to_video, **wind_prompt),
+            functools.partial(draw_wind_force_prompt, **wind_prompt),
+            len(video),
+        ),
+    }
+    records = []
+    for name, (original_force_prompt, add_force_prompt, draw_force_prompt, num_frames_with_signal) in cases.items():
+        reference = original_force_prompt(video, num_frames_with_signal=num_frames_with_signal)
+        reference_frames = original_force_prompt(frames / 255.0, num_frames_with_signal=num_frames_with_signal)
+        reference_frames = np.round(reference_frames * 255).astype(np.uint8)
+
+        def overlay(render_once):
+            # a new overlay, so that the mask is rendered in every call
+            return force_prompt_overlay(draw_force_prompt, num_frames_with_signal, render_once=render_once)(frames, 0)
+
+        records += [
+            make_record(
+                f"force_prompt_overlay/{name}_float_original",
+                time_fn(lambda: original_force_prompt(video, num_frames_with_signal=num_frames_with_signal), warmup, repeats),
+            ),
+            make_record(
+                f"force_prompt_overlay/{name}_float",
+                time_fn(lambda: add_force_prompt(video, num_frames_with_signal=num_frames_with_signal), warmup, repeats),
+                max_abs_diff=max_abs_diff(
+                    torch.from_numpy(add_force_prompt(video, num_frames_with_signal=num_frames_with_signal)),
+                    torch.from_numpy(reference),
+                ),
+                atol=0.0,
+            ),
+        ]
+        for render_once, mode in [(False, "per_frame"), (True, "mask")]:
+            records.append(make_record(
+                f"force_prompt_overlay/{name}_uint8_{mode}",
+                time_fn(lambda: overlay(render_once), warmup, repeats),
+                max_abs_diff=max_abs_diff(torch.from_numpy(overlay(render_once)), torch.from_numpy(reference_frames)),
+                atol=0.0,
+            ))
+    return records
@@ -0,0 +1,299 @@
+import json
+import os
+import platform
+import statistics
+import time
+
+import torch
+from diffusers import AutoencoderKLCogVideoX, CogVideoXDPMScheduler
+
+from models.cogvideo_controlnet import CogVideoXControlnet
+from models.cogvideo_transformer import CustomCogVideoXTransformer3DModel
+from utils.video_utils import prepare_rotary_positional_embeddings
+
+# Reduced model sizes for CPU benchmarking. The real 5B setup is 42 transformer layers, 6 controlnet layers,
+# 48 heads of dim 64, and 13 latent frames of 60x90 (49 frames of 480x720 in pixel space).
+TINY_CONFIGS = {
+    "tiny": {
+        "num_layers": 2,
+        "controlnet_num_layers": 2,
+        "num_attention_heads": 2,
+        "attention_head_dim": 16,
+        "latent_frames": 3,
+        "latent_height": 8,
+        "latent_width": 12,
+        "num_inference_steps": 4,
+    },
+    "small": {
+        "num_layers": 4,
+        "controlnet_num_layers": 2,
+        "num_attention_heads": 4,
+        "attention_head_dim": 32,
+        "latent_frames": 5,
+        "latent_height": 16,
+        "latent_width": 24,
+        "num_inference_steps": 4,
+    },
+}
+
+# CogVideoX constants that the controlnet and pipeline code rely on
+LATENT_CHANNELS = 16
+TEXT_SEQ_LENGTH = 226
+TEXT_EMBED_DIM = 4096
+VAE_SCALE_FACTOR_SPATIAL = 8
+VAE_SCALE_FACTOR_TEMPORAL = 4
+
+BENCHMARKS = {}
+
+
+def register_benchmark(name):
+    """
+    Register a benchmark case under `name`. A case is called with the config dict and the timing options, and
+    returns a list of result records (see `make_record`).
+    """
+    def decorator(fn):
+        BENCHMARKS[name] = fn
+        return fn
+    return decorator
+
+
+def pixel_frames(cfg):
+    return (cfg["latent_frames"] - 1) * VAE_SCALE_FACTOR_TEMPORAL + 1
+
+
+def time_fn(fn, warmup=1, repeats=5):
+    """
+    Time `fn()` and return summary statistics in seconds.
+    """
+    for _ in range(warmup):
+        fn()
+    times = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        fn()
+        times.append(time.perf_counter() - start)
+    return {
+        "median_s": statistics.median(times),
+        "mean_s": statistics.mean(times),
+        "min_s": min(times),
+        "max_s": max(times),
+        "repeats": repeats,
+    }
+
+
+def max_abs_diff(a, b):
+    if isinstance(a, (list, tuple)):
+        return max([max_abs_diff(x, y) for x, y in zip(a, b)] + [0.0])
+    return (a.float() - b.float()).abs().max().item()
+
+
+def make_record(name, timings=None, **extra):
+    """
+    One row of the results file. Records with `max_abs_diff` and `atol` are also checked for parity.
+    """
+    record = {"name": name}
+    if timings is not None:
+        record.update(timings)
+    record.update(extra)
+    return record
+
+
+def _randomize_zero_initialized(model, std=0.02):
+    # the zero convs (and the zeroed half of the controlnet patch embedding) would make every output trivially
+    # zero, which hides both the cost of the residual path and any numerical difference in it
+    with torch.no_grad():
+        for param in model.parameters():
+            if param.dim() > 1 and not param.any():
+                param.normal_(std=std)
+        if model.patch_embed.proj.weight.shape[1] == 2 * 2 * LATENT_CHANNELS:
+            model.patch_embed.proj.weight[:, 2 * LATENT_CHANNELS:].normal_(std=std)
+
+
+def build_controlnet(cfg, seed=0, **kwargs):
+    torch.manual_seed(seed)
+    controlnet = CogVideoXControlnet(
+        **kwargs,
+        num_layers=cfg["controlnet_num_layers"],
+        num_attention_heads=cfg["num_attention_heads"],
+        attention_head_dim=cfg["attention_head_dim"],
+        time_embed_dim=cfg["num_attention_heads"] * cfg["attention_head_dim"],
+        sample_height=cfg["latent_height"],
+        sample_width=cfg["latent_width"],
+        sample_frames=pixel_frames(cfg),
+    )
+    _randomize_zero_initialized(controlnet)
+    return controlnet.eval()
+
+
+def build_transformer(cfg, seed=0):
+    torch.manual_seed(seed)
+    transformer = CustomCogVideoXTransformer3DModel(
+        num_attention_heads=cfg["num_attention_heads"],
+        attention_head_dim=cfg["attention_head_dim"],
+        in_channels=2 * LATENT_CHANNELS,
+        out_channels=LATENT_CHANNELS,
+        time_embed_dim=cfg["num_attention_heads"] * cfg["attention_head_dim"],
+        text_embed_dim=TEXT_EMBED_DIM,
+        num_layers=cfg["num_layers"],
+        sample_height=cfg["latent_height"],
+        sample_width=cfg["latent_width"],
+        sample_frames=pixel_frames(cfg),
+        use_rotary_positional_embeddings=True,
+    )
+    return transformer.eval()
+
+
+def build_vae(cfg, seed=0):
+    torch.manual_seed(seed)
+    vae = AutoencoderKLCogVideoX(
+        block_out_channels=(8, 8, 8, 8),
+        layers_per_block=1,
+        norm_num_groups=4,
+        latent_channels=LATENT_CHANNELS,
+        sample_height=cfg["latent_height"] * VAE_SCALE_FACTOR_SPATIAL,
+        sample_width=cfg["latent_width"] * VAE_SCALE_FACTOR_SPATIAL,
+    )
+    return vae.eval()
+
+
+def build_pipeline(cfg, seed=0):
+    # imported here so that the model-only benchmarks don't need the pipeline dependencies
+    from pipelines.controlnet_img2vid_pipeline import CogVideoXImageToVideoControlnetPipeline
+
+    pipe = CogVideoXImageToVideoControlnetPipeline(
+        tokenizer=None,
+        text_encoder=None,
+        vae=build_vae(cfg, seed=seed),
+        transformer=build_transformer(cfg, seed=seed),
+        scheduler=CogVideoXDPMScheduler(
+            beta_schedule="scaled_linear",
+            beta_start=0.00085,
+            beta_end=0.012,
+            prediction_type="v_prediction",
+            rescale_betas_zero_snr=True,
+            snr_shift_scale=1.0,
+            timestep_spacing="trailing",
+        ),
+        controlnet=build_controlnet(cfg, seed=seed),
+    )
+    pipe.set_progress_bar_config(disable=True)
+    return pipe
+
+
+def make_point_force_frames(cfg, batch_size=1, radius=2.5):
+    """
+    A moving Gaussian blob on a zero background, i.e. a scaled-down version of the point-force control signal.
+    """
+    num_frames = pixel_frames(cfg)
+    height = cfg["latent_height"] * VAE_SCALE_FACTOR_SPATIAL
+    width = cfg["latent_width"] * VAE_SCALE_FACTOR_SPATIAL
+    y_grid, x_grid = torch.meshgrid(torch.arange(height), torch.arange(width), indexing="ij")
+    frames = torch.zeros(batch_size, num_frames, 3, height, width)
+    for frame in range(num_frames):
+        t = frame / max(num_frames - 1, 1)
+        x_pos = width * (0.3 + 0.3 * t)
+        y_pos = height * 0.5
+        squared_dist = (x_grid - x_pos) ** 2 + (y_grid - y_pos) ** 2
+        frames[:, frame] = torch.exp(-squared_dist / (2.0 * radius ** 2))
+    return frames
+
+
+def make_wind_force_frames(cfg, batch_size=1, force=0.5, angle=30.0):
+    """
+    A scaled-down version of the wind-force control signal, which is constant over space and time.
+    """
+    num_frames = pixel_frames(cfg)
+    height = cfg["latent_height"] * VAE_SCALE_FACTOR_SPATIAL
+    width = cfg["latent_width"] * VAE_SCALE_FACTOR_SPATIAL
+    frames = torch.zeros(batch_size, num_frames, 3, height, width)
+    frames[:, :, 0] = -1 + 2 * force
+    frames[:, :, 1] = torch.cos(torch.tensor(angle) * torch.pi / 180.0)
+    frames[:, :, 2] = torch.sin(torch.tensor(angle) * torch.pi / 180.0)
+    return frames
+
+
+def make_inputs(cfg, batch_size=1, seed=0):
+    """
+    Random model inputs with the same layout as in training: noisy latents concatenated with the image latents
+    along channels, T5 prompt embeddings, the control signal video and rotary embeddings.
+    """
+    generator = torch.Generator().manual_seed(seed)
+    latent_shape = (batch_size, cfg["latent_frames"], 2 * LATENT_CHANNELS, cfg["latent_height"], cfg["latent_width"])
+    hidden_states = torch.randn(latent_shape, generator=generator)
+    prompt_embeds = torch.randn((batch_size, TEXT_SEQ_LENGTH, TEXT_EMBED_DIM), generator=generator)
+    timestep = torch.randint(0, 1000, (batch_size,), generator=generator)
+    image_rotary_emb = prepare_rotary_positional_embeddings(
+        height=cfg["latent_height"] * VAE_SCALE_FACTOR_SPATIAL,
+        width=cfg["latent_width"] * VAE_SCALE_FACTOR_SPATIAL,
+        num_frames=cfg["latent_frames"],
+        vae_scale_factor_spatial=VAE_SCALE_FACTOR_SPATIAL,
+        patch_size=2,
+        attention_head_dim=cfg["attention_head_dim"],
+        base_height=cfg["latent_height"] * VAE_SCALE_FACTOR_SPATIAL,
+        base_width=cfg["latent_width"] * VAE_SCALE_FACTOR_SPATIAL,
+    )
+    return {
+        "hidden_states": hidden_states,
+        "encoder_hidden_states": prompt_embeds,
+        "controlnet_states": make_point_force_frames(cfg, batch_size=batch_size),
+        "timestep": timestep,
+        "image_rotary_emb": image_rotary_emb,
+    }
+
+
+def environment_info():
+    return {
+        "torch": torch.__version__,
+        "python": platform.python_version(),
+        "machine": platform.machine(),
+        "processor": platform.processor(),
+        "num_threads": torch.get_num_threads(),
+    }
+
+
+def write_results(path, config_name, records):
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    results = {
+        "config": config_name,
+        "environment": environment_info(),
+        "results": {record["name"]: record for record in records},
+    }
+    with open(path, "w") as f:
+        json.dump(results, f, indent=4)
+    return results
+
+
+def load_results(path):
+    with open(path, "r") as f:
+        return json.load(f)
+
+
+def compare_to_baseline(results, baseline, tolerance=0.25):
+    """
+    Compare median timings against a stored baseline. Returns one row per benchmark that exists in both, with
+    `regressed=True` for the ones that got slower by more than `tolerance` (relative).
+    """
+    rows = []
+    if results["config"] != baseline["config"]:
+        print(f"Baseline was recorded with config '{baseline['config']}', not '{results['config']}'; skipping comparison.")
+        return rows
+    for name, record in results["results"].items():
+        baseline_record = baseline["results"].get(name)
+        if baseline_record is None or "median_s" not in record or "median_s" not in baseline_record:
+            continue
+        ratio = record["median_s"] / max(baseline_record["median_s"], 1e-12)
+        rows.append({
+            "name": name,
+            "baseline_s": baseline_record["median_s"],
+            "current_s": record["median_s"],
+            "ratio": ratio,
+            "regressed": ratio > 1.0 + tolerance,
+        })
+    return rows
+
+
+def parity_failures(records):
+    return [
+        record for record in records
+        if "max_abs_diff" in record and "atol" in record and not record["max_abs_diff"] <= record["atol"]
+    ]
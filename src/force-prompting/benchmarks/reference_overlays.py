@@ -0,0 +1,153 @@
+"""
+The force prompt overlays exactly as they were drawn before the overlays were split into `draw_*` functions, kept
+verbatim as the reference for the pixel-exact checks of the overlays in `inference.py`.
+"""
+import math
+
+import cv2
+import numpy as np
+
+
+def add_aesthetic_point_force_prompt_to_video(video, force, angle, x_pos, y_pos, circle_radius=20, num_frames_with_signal=1):
+    """
+    Annotate the first frame of a video with a white circle and directional yellow arrow.
+    
+    Parameters:
+    -----------
+    video : numpy.ndarray
+        Video array with shape (num_frames, height, width, channels), values in [0,1]
+    force : float
+        Value in [0,1] that determines the length of the arrow
+    angle : float
+        Value in [0,360] that determines the direction of the arrow
+    x_pos : float
+        Horizontal position in [0,1] (will be scaled to pixel coordinates)
+    y_pos : float
+        Vertical position in [0,1] (will be scaled to pixel coordinates)
+    
+    Returns:
+    --------
+    numpy.ndarray
+        Modified video with annotations on the first frame
+    """
+    # Create a copy of the video to avoid modifying the original
+    result_video = video.copy()
+    
+    # Get the dimensions of the video
+    num_frames, height, width, channels = video.shape
+    
+    # Convert the position from [0,1] range to pixel coordinates
+    center_x = int(x_pos * width)
+    center_y = int(y_pos * height)
+    
+    # Convert angle from degrees to radians
+    angle_rad = math.radians(angle)
+    
+    # Calculate the arrow endpoint
+    arrow_length = 10 + 90 * force # min force in dataset, corresponidng to 0, should have some positive length...
+    end_x = int(center_x + arrow_length * math.cos(angle_rad))
+    end_y = int(center_y - arrow_length * math.sin(angle_rad))
+
+    for i in range(num_frames_with_signal):
+        # Convert the first frame to uint8 format (0-255) for OpenCV
+        this_frame = (result_video[i] * 255).astype(np.uint8)
+        
+        # Draw a white circle with radius 10 pixels and thickness 2 pixels
+        cv2.circle(this_frame, (center_x, center_y), circle_radius, (255, 255, 255), 2)
+        
+        # Draw a yellow arrow
+        cv2.arrowedLine(this_frame, (center_x, center_y), (end_x, end_y), (0, 255, 255), 2, tipLength=0.3)
+        
+        # Convert the frame back to [0,1] range
+    
+        result_video[i] = this_frame / 255.0
+    
+    return result_video
+
+# Update max_arrow_length properly to 90 to account for forward distance
+def add_aesthetic_wind_force_prompt_to_video(
+    video,
+    force,
+    angle,
+    num_frames_with_signal=1,
+    base_periods=1,
+    periods_per_0_1_force=1,
+    wave_amplitude=2,
+    extra_straight_length=20,
+    arrowhead_length=7,
+    forward_distance=6
+):
+    result_video = video.copy()
+    num_frames, height, width, channels = video.shape
+
+    arrowhead_base = int(arrowhead_length * (2 / math.sqrt(3)))
+
+    min_arrow_length = 30
+    max_arrow_length = 90  # final correct value
+
+    arrow_length = min_arrow_length + force * (max_arrow_length - min_arrow_length)
+    periods = base_periods + int(force * 10) * periods_per_0_1_force
+
+    angle_rad = math.radians(angle)
+    dir_x = math.cos(angle_rad)
+    dir_y = -math.sin(angle_rad)
+    perp_x = -dir_y
+    perp_y = dir_x
+
+    base_x = width - 100
+    base_y = 100
+
+    for i in range(min(num_frames_with_signal, num_frames)):
+        frame = (result_video[i] * 255).astype(np.uint8)
+
+        for j in range(3):
+            offset = (j - 1) * 20
+            start_x = base_x + offset * perp_x
+            start_y = base_y + offset * perp_y
+
+            points = []
+            num_points = 100
+            squiggly_part_length = arrow_length - extra_straight_length
+            squiggly_end_t = squiggly_part_length / arrow_length
+
+            for k in range(num_points):
+                t = k / (num_points - 1)
+                if t < squiggly_end_t:
+                    main_x = start_x + dir_x * t * arrow_length
+                    main_y = start_y + dir_y * t * arrow_length
+                    squiggle = math.sin(t * periods * 2 * math.pi) * wave_amplitude
+                    squiggle_x = main_x + perp_x * squiggle
+                    squiggle_y = main_y + perp_y * squiggle
+                else:
+                    straight_progress = (t - squiggly_end_t) / (1 - squiggly_end_t)
+                    main_x = start_x + dir_x * (squiggly_part_length + straight_progress * extra_straight_length)
+                    main_y = start_y + dir_y * (squiggly_part_length + straight_progress * extra_straight_length)
+                    squiggle_x = main_x
+                    squiggle_y = main_y
+
+                points.append((int(squiggle_x), int(squiggle_y)))
+
+            for p in range(len(points) - 1):
+                cv2.line(frame, points[p], points[p + 1], (0, 255, 255), 2)
+
+            tip = points[-1]
+            tip_forward_x = tip[0] + forward_distance * dir_x
+            tip_forward_y = tip[1] + forward_distance * dir_y
+            tip_point = (int(tip_forward_x), int(tip_forward_y))
+
+            base_center_x = tip[0] - arrowhead_length * dir_x
+            base_center_y = tip[1] - arrowhead_length * dir_y
+
+            left_base_x = int(base_center_x + (arrowhead_base / 2) * -dir_y)
+            left_base_y = int(base_center_y + (arrowhead_base / 2) * dir_x)
+
+            right_base_x = int(base_center_x - (arrowhead_base / 2) * -dir_y)
+            right_base_y = int(base_center_y - (arrowhead_base / 2) * dir_x)
+
+            cv2.line(frame, (left_base_x, left_base_y), tip_point, (0, 255, 255), 2)
+            cv2.line(frame, (right_base_x, right_base_y), tip_point, (0, 255, 255), 2)
+
+        result_video[i] = frame / 255.0
+
+
+    return result_video
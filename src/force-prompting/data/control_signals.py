@@ -0,0 +1,62 @@
+import math
+
+import torch
+
+
+def point_force_control_signal(
+    force_percent, angle, x_pos, y_pos, num_frames=49, num_channels=3, height=480, width=720, radius=20,
+    device=None, dtype=torch.float32,
+):
+    """
+    The point-force control signal of `ForcePromptingDataset_PointForce`, built directly on `device`: a Gaussian blob
+    moving in a straight line from (x_pos, y_pos) in the direction of `angle` (degrees), further for a larger
+    `force_percent` (the force normalized to [0, 1] over the dataset). `y_pos` is measured from the bottom.
+
+    All frames are computed at once, with the same float32 arithmetic as the per-frame dataset loop, so the result is
+    identical to it.
+
+    Returns:
+        torch.Tensor: (num_frames, num_channels, height, width)
+    """
+    x_pos_start = x_pos*width
+    y_pos_start = (1-y_pos)*height
+
+    DISPLACEMENT_FOR_MAX_FORCE = width / 2
+    DISPLACEMENT_FOR_MIN_FORCE = width / 8
+
+    total_displacement = DISPLACEMENT_FOR_MIN_FORCE + (DISPLACEMENT_FOR_MAX_FORCE - DISPLACEMENT_FOR_MIN_FORCE) * force_percent
+
+    x_pos_end = x_pos_start + total_displacement * math.cos(angle * math.pi / 180.0)
+    y_pos_end = y_pos_start - total_displacement * math.sin(angle * math.pi / 180.0)
+
+    # the blob centers are interpolated in double precision, like the python floats of the dataset loop
+    t = torch.arange(num_frames, device=device, dtype=torch.float64) / max(num_frames - 1, 1)
+    x_centers = (x_pos_start * (1-t) + x_pos_end * t).float()
+    y_centers = (y_pos_start * (1-t) + y_pos_end * t).float()
+
+    x_grid = torch.arange(width, device=device)
+    y_grid = torch.arange(height, device=device)
+    squared_dist = (
+        (x_grid[None, None, :] - x_centers[:, None, None]) ** 2 + (y_grid[None, :, None] - y_centers[:, None, None]) ** 2
+    ) # (num_frames, height, width)
+    gaussian = torch.exp(-squared_dist / (2.0 * radius ** 2))
+
+    return gaussian[:, None].expand(-1, num_channels, -1, -1).to(dtype).contiguous()
+
+
+def wind_force_control_signal(
+    force_percent, angle, num_frames=49, num_channels=3, height=480, width=720, device=None, dtype=torch.float32,
+):
+    """
+    The wind-force control signal of `ForcePromptingDataset_WindForce`, built directly on `device`: constant over
+    space and time, with the wind speed (`force_percent` mapped to [-1, 1]), cos(angle) and sin(angle) in the three
+    channels.
+
+    Returns:
+        torch.Tensor: (num_frames, num_channels, height, width)
+    """
+    channels = torch.tensor(
+        [-1 + 2*force_percent, math.cos(angle * math.pi / 180.0), math.sin(angle * math.pi / 180.0)],
+        device=device,
+    )
+    return channels[None, :num_channels, None, None].expand(num_frames, -1, height, width).to(dtype).contiguous()
@@ -1,5 +1,6 @@
 import os
 import glob
+import bisect
 import random
 
 
@@ -10,9 +11,11 @@ import pandas as pd
 import torchvision.transforms as transforms
 from PIL import Image
 from decord import VideoReader
-from torch.utils.data.dataset import Dataset
+from torch.utils.data.dataset import ConcatDataset, Dataset
 from controlnet_aux import CannyDetector, HEDdetector
 
+from data.control_signals import point_force_control_signal, wind_force_control_signal
+
 def unpack_mm_params(p):
     if isinstance(p, (tuple, list)):
         return p[0], p[1]
@@ -273,30 +276,12 @@ class ForcePromptingDataset_PointForce(BaseClass):
 
     def load_controlnet_signal(self, force, angle, x_pos, y_pos, num_frames=49, num_channels=3, height=480, width=720):
 
-        controlnet_signal = torch.zeros((num_frames, num_channels, height, width)) # (49, 3, 480, 720)
-
-        x_pos_start = x_pos*width
-        y_pos_start = (1-y_pos)*height
-
-        DISPLACEMENT_FOR_MAX_FORCE = width / 2
-        DISPLACEMENT_FOR_MIN_FORCE = width / 8
-
         force_percent = (force - self.min_force) / (self.max_force - self.min_force)
-        total_displacement = DISPLACEMENT_FOR_MIN_FORCE + (DISPLACEMENT_FOR_MAX_FORCE - DISPLACEMENT_FOR_MIN_FORCE) * force_percent
 
-        x_pos_end = x_pos_start + total_displacement * math.cos(angle * torch.pi / 180.0)
-        y_pos_end = y_pos_start - total_displacement * math.sin(angle * torch.pi / 180.0)
+        controlnet_signal = point_force_control_signal(
+            force_percent, angle, x_pos, y_pos, num_frames=num_frames, num_channels=num_channels, height=height, width=width
+        ) # (49, 3, 480, 720)
 
-        for frame in range(num_frames):
-
-            t = frame / (num_frames-1)
-            x_pos_ = x_pos_start * (1-t) + x_pos_end * t # t = 0 --> start; t = 0 --> end
-            y_pos_ = y_pos_start * (1-t) + y_pos_end * t # t = 0 --> start; t = 0 --> end
-
-            blob_tensor = self.get_gaussian_blob(x=x_pos_, y=y_pos_, radius=20, amplitude=1.0, shape=(3, 480, 720))
-
-            controlnet_signal[frame] += blob_tensor
-        
         return controlnet_signal
 
 class ForcePromptingDataset_WindForce(BaseClass):
@@ -392,15 +377,51 @@ class ForcePromptingDataset_WindForce(BaseClass):
 
     def load_controlnet_signal(self, force, angle, num_frames=49, num_channels=3, height=480, width=720):
 
-        controlnet_signal = torch.zeros((num_frames, num_channels, height, width)) # (49, 3, 480, 720)
+        force_percent = (force - self.min_force) / (self.max_force - self.min_force)
+
+        # the channels get wind_speed, cos(wind_angle) and sin(wind_angle)
+        controlnet_signal = wind_force_control_signal(
+            force_percent, angle, num_frames=num_frames, num_channels=num_channels, height=height, width=width
+        ) # (49, 3, 480, 720)
 
-        # first channel gets wind_speed
-        controlnet_signal[:, 0] = -1 + 2*(force-self.min_force)/(self.max_force-self.min_force)
+        return controlnet_signal
 
-        # second channel gets cos(wind_angle)
-        controlnet_signal[:, 1] = math.cos(angle * torch.pi / 180.0)
 
-        # third channel gets sin(wind_angle)
-        controlnet_signal[:, 2] = math.sin(angle * torch.pi / 180.0)
-        
-        return controlnet_signal
\ No newline at end of file
+def expand_val_csv_paths(csv_paths):
+    """
+    The validation CSVs of `--csv_paths_val`: every entry is a path or a glob, and a `benchmark_details.csv` stands for
+    the per-object CSVs in the subdirectories next to it (`<benchmark>/<object>/*.csv`). Duplicates are dropped.
+    """
+    expanded = []
+    for csv_path in csv_paths:
+        for path in sorted(glob.glob(csv_path)) or [csv_path]:
+            if os.path.basename(path) == "benchmark_details.csv":
+                expanded += sorted(glob.glob(os.path.join(os.path.dirname(path), "*", "*.csv")))
+            else:
+                expanded.append(path)
+    return list(dict.fromkeys(expanded))
+
+
+class MultiCSVDataset(ConcatDataset):
+    """
+    The validation datasets of several CSVs as one, so that a single run streams through all of them. `df` stacks the
+    CSV rows, with the full image paths in the `media_type` column, and the force range covers all datasets.
+    """
+
+    def __init__(self, datasets):
+        super().__init__(datasets)
+        self.media_type = datasets[0].media_type
+        self.df = pd.concat(
+            [
+                dataset.df.assign(**{
+                    self.media_type: [os.path.join(dataset.video_root_dir, x) for x in dataset.df[self.media_type]]
+                })
+                for dataset in datasets
+            ],
+            ignore_index=True,
+        )
+        self.min_force = min(dataset.min_force for dataset in datasets)
+        self.max_force = max(dataset.max_force for dataset in datasets)
+
+    def get_video_root_dir(self, idx):
+        return self.datasets[bisect.bisect_right(self.cumulative_sizes, idx)].video_root_dir
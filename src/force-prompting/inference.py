@@ -15,6 +15,7 @@
 
 import os
 import shutil
+import functools
 import logging
 import math
 from pathlib import Path
@@ -27,7 +28,7 @@ from accelerate import Accelerator
 from accelerate.logging import get_logger
 from accelerate.utils import DistributedDataParallelKwargs, ProjectConfiguration, set_seed
 from huggingface_hub import create_repo
-from torch.utils.data import DataLoader
+from torch.utils.data import DataLoader, Subset
 from tqdm.auto import tqdm
 
 import diffusers
@@ -39,15 +40,21 @@ from diffusers.utils import check_min_version, export_to_video, is_wandb_availab
 from diffusers.utils.hub_utils import load_or_create_model_card, populate_model_card
 
 from pipelines.controlnet_img2vid_pipeline import CogVideoXImageToVideoControlnetPipeline
+from pipelines.controlnet_residual_cache import ControlnetResidualCache
+from pipelines.inference_session import InferenceSession
+from pipelines.decode_worker import DecodeWorker
 from einops import rearrange
 
 from utils.model_utils import compute_prompt_embeddings, get_optimizer, load_models, unwrap_model, clear_objs_and_retain_memory
-from utils.video_utils import prepare_rotary_positional_embeddings, encode_video, tensor_to_video_ffmpeg
+from utils.video_utils import prepare_rotary_positional_embeddings, encode_video, tensor_to_video_ffmpeg, MultiOutputVideoWriter, frames_to_uint8
+from utils.sharding import shard_dataset_indices, write_manifest_shard, merge_manifest_shards
+from utils.result_index import ResultIndex, checkpoint_digest, result_key, tensor_digest
 
 from data.controlnet_datasets import (
     ForcePromptingDataset_PointForce,
     ForcePromptingDataset_WindForce,
 )
+from data.control_signals import point_force_control_signal, wind_force_control_signal
 from data.data_utils import (
     collate_fn_ForcePromptingDataset_PointForce,
     collate_fn_ForcePromptingDataset_WindForce,
@@ -166,9 +173,26 @@ def add_aesthetic_point_force_prompt_to_video(video, force, angle, x_pos, y_pos,
     """
     # Create a copy of the video to avoid modifying the original
     result_video = video.copy()
-    
-    # Get the dimensions of the video
     num_frames, height, width, channels = video.shape
+    num_frames_with_signal = min(num_frames_with_signal, num_frames)
+
+    # The annotated frames are converted to uint8 (0-255) for OpenCV and back to the [0,1] range all at once. The
+    # circle and arrow take less time to draw on every frame than compositing a mask of them
+    frames = (result_video[:num_frames_with_signal] * 255).astype(np.uint8)
+    for frame in frames:
+        draw_point_force_prompt(frame, force, angle, x_pos, y_pos, circle_radius)
+    np.divide(frames, result_video.dtype.type(255.0), out=result_video[:num_frames_with_signal])
+    
+    return result_video
+
+def draw_point_force_prompt(frame, force, angle, x_pos, y_pos, circle_radius=20):
+    """
+    Draw the circle and arrow of `add_aesthetic_point_force_prompt_to_video` in place on a uint8 frame (height, width, 3)
+    or RGBA mask (height, width, 4).
+    """
+    # Get the dimensions of the frame; on an RGBA mask the drawing is opaque
+    height, width, channels = frame.shape
+    white, yellow = (255, 255, 255, 255)[:channels], (0, 255, 255, 255)[:channels]
     
     # Convert the position from [0,1] range to pixel coordinates
     center_x = int(x_pos * width)
@@ -182,21 +206,12 @@ def add_aesthetic_point_force_prompt_to_video(video, force, angle, x_pos, y_pos,
     end_x = int(center_x + arrow_length * math.cos(angle_rad))
     end_y = int(center_y - arrow_length * math.sin(angle_rad))
 
-    for i in range(num_frames_with_signal):
-        # Convert the first frame to uint8 format (0-255) for OpenCV
-        this_frame = (result_video[i] * 255).astype(np.uint8)
-        
-        # Draw a white circle with radius 10 pixels and thickness 2 pixels
-        cv2.circle(this_frame, (center_x, center_y), circle_radius, (255, 255, 255), 2)
-        
-        # Draw a yellow arrow
-        cv2.arrowedLine(this_frame, (center_x, center_y), (end_x, end_y), (0, 255, 255), 2, tipLength=0.3)
-        
-        # Convert the frame back to [0,1] range
+    # Draw a white circle with radius 10 pixels and thickness 2 pixels
+    cv2.circle(frame, (center_x, center_y), circle_radius, white, 2)
     
-        result_video[i] = this_frame / 255.0
-    
-    return result_video
+    # Draw a yellow arrow
+    cv2.arrowedLine(frame, (center_x, center_y), (end_x, end_y), yellow, 2, tipLength=0.3)
+    return frame
 
 # Update max_arrow_length properly to 90 to account for forward distance
 def add_aesthetic_wind_force_prompt_to_video(
@@ -213,6 +228,40 @@ def add_aesthetic_wind_force_prompt_to_video(
 ):
     result_video = video.copy()
     num_frames, height, width, channels = video.shape
+    num_frames_with_signal = min(num_frames_with_signal, num_frames)
+
+    mask = render_force_prompt_mask(
+        height, width, functools.partial(
+            draw_wind_force_prompt, force=force, angle=angle, base_periods=base_periods,
+            periods_per_0_1_force=periods_per_0_1_force, wave_amplitude=wave_amplitude,
+            extra_straight_length=extra_straight_length, arrowhead_length=arrowhead_length,
+            forward_distance=forward_distance
+        )
+    )
+    # the wavy arrows are built point by point, so they are drawn once and composited onto all frames
+    frames = (result_video[:num_frames_with_signal] * 255).astype(np.uint8)
+    composite_overlay_mask(frames, mask)
+    np.divide(frames, result_video.dtype.type(255.0), out=result_video[:num_frames_with_signal])
+
+    return result_video
+
+def draw_wind_force_prompt(
+    frame,
+    force,
+    angle,
+    base_periods=1,
+    periods_per_0_1_force=1,
+    wave_amplitude=2,
+    extra_straight_length=20,
+    arrowhead_length=7,
+    forward_distance=6
+):
+    """
+    Draw the three wavy arrows of `add_aesthetic_wind_force_prompt_to_video` in place on a uint8 frame (height, width, 3)
+    or RGBA mask (height, width, 4).
+    """
+    height, width, channels = frame.shape
+    yellow = (0, 255, 255, 255)[:channels]
 
     arrowhead_base = int(arrowhead_length * (2 / math.sqrt(3)))
 
@@ -231,59 +280,119 @@ def add_aesthetic_wind_force_prompt_to_video(
     base_x = width - 100
     base_y = 100
 
-    for i in range(min(num_frames_with_signal, num_frames)):
-        frame = (result_video[i] * 255).astype(np.uint8)
-
-        for j in range(3):
-            offset = (j - 1) * 20
-            start_x = base_x + offset * perp_x
-            start_y = base_y + offset * perp_y
+    for j in range(3):
+        offset = (j - 1) * 20
+        start_x = base_x + offset * perp_x
+        start_y = base_y + offset * perp_y
+
+        points = []
+        num_points = 100
+        squiggly_part_length = arrow_length - extra_straight_length
+        squiggly_end_t = squiggly_part_length / arrow_length
+
+        for k in range(num_points):
+            t = k / (num_points - 1)
+            if t < squiggly_end_t:
+                main_x = start_x + dir_x * t * arrow_length
+                main_y = start_y + dir_y * t * arrow_length
+                squiggle = math.sin(t * periods * 2 * math.pi) * wave_amplitude
+                squiggle_x = main_x + perp_x * squiggle
+                squiggle_y = main_y + perp_y * squiggle
+            else:
+                straight_progress = (t - squiggly_end_t) / (1 - squiggly_end_t)
+                main_x = start_x + dir_x * (squiggly_part_length + straight_progress * extra_straight_length)
+                main_y = start_y + dir_y * (squiggly_part_length + straight_progress * extra_straight_length)
+                squiggle_x = main_x
+                squiggle_y = main_y
 
-            points = []
-            num_points = 100
-            squiggly_part_length = arrow_length - extra_straight_length
-            squiggly_end_t = squiggly_part_length / arrow_length
+            points.append((int(squiggle_x), int(squiggle_y)))
 
-            for k in range(num_points):
-                t = k / (num_points - 1)
-                if t < squiggly_end_t:
-                    main_x = start_x + dir_x * t * arrow_length
-                    main_y = start_y + dir_y * t * arrow_length
-                    squiggle = math.sin(t * periods * 2 * math.pi) * wave_amplitude
-                    squiggle_x = main_x + perp_x * squiggle
-                    squiggle_y = main_y + perp_y * squiggle
-                else:
-                    straight_progress = (t - squiggly_end_t) / (1 - squiggly_end_t)
-                    main_x = start_x + dir_x * (squiggly_part_length + straight_progress * extra_straight_length)
-                    main_y = start_y + dir_y * (squiggly_part_length + straight_progress * extra_straight_length)
-                    squiggle_x = main_x
-                    squiggle_y = main_y
+        for p in range(len(points) - 1):
+            cv2.line(frame, points[p], points[p + 1], yellow, 2)
 
-                points.append((int(squiggle_x), int(squiggle_y)))
+        tip = points[-1]
+        tip_forward_x = tip[0] + forward_distance * dir_x
+        tip_forward_y = tip[1] + forward_distance * dir_y
+        tip_point = (int(tip_forward_x), int(tip_forward_y))
 
-            for p in range(len(points) - 1):
-                cv2.line(frame, points[p], points[p + 1], (0, 255, 255), 2)
+        base_center_x = tip[0] - arrowhead_length * dir_x
+        base_center_y = tip[1] - arrowhead_length * dir_y
 
-            tip = points[-1]
-            tip_forward_x = tip[0] + forward_distance * dir_x
-            tip_forward_y = tip[1] + forward_distance * dir_y
-            tip_point = (int(tip_forward_x), int(tip_forward_y))
+        left_base_x = int(base_center_x + (arrowhead_base / 2) * -dir_y)
+        left_base_y = int(base_center_y + (arrowhead_base / 2) * dir_x)
 
-            base_center_x = tip[0] - arrowhead_length * dir_x
-            base_center_y = tip[1] - arrowhead_length * dir_y
+        right_base_x = int(base_center_x - (arrowhead_base / 2) * -dir_y)
+        right_base_y = int(base_center_y - (arrowhead_base / 2) * dir_x)
 
-            left_base_x = int(base_center_x + (arrowhead_base / 2) * -dir_y)
-            left_base_y = int(base_center_y + (arrowhead_base / 2) * dir_x)
+        cv2.line(frame, (left_base_x, left_base_y), tip_point, yellow, 2)
+        cv2.line(frame, (right_base_x, right_base_y), tip_point, yellow, 2)
 
-            right_base_x = int(base_center_x - (arrowhead_base / 2) * -dir_y)
-            right_base_y = int(base_center_y - (arrowhead_base / 2) * dir_x)
+    return frame
 
-            cv2.line(frame, (left_base_x, left_base_y), tip_point, (0, 255, 255), 2)
-            cv2.line(frame, (right_base_x, right_base_y), tip_point, (0, 255, 255), 2)
+def render_force_prompt_mask(height, width, draw_force_prompt):
+    """
+    Render a force prompt, e.g. a `functools.partial` of `draw_point_force_prompt`, once into an RGBA uint8 mask
+    (height, width, 4) that is transparent where nothing is drawn.
+    """
+    mask = np.zeros((height, width, 4), dtype=np.uint8)
+    draw_force_prompt(mask)
+    return mask
 
-        result_video[i] = frame / 255.0
+def composite_overlay_mask(frames, mask):
+    """
+    Alpha-composite an RGBA mask (height, width, 4) over uint8 frames (..., height, width, 3) in place, in one
+    vectorized step within the bounding box of the pixels the mask covers. The force prompt masks are opaque where they
+    are drawn, so they are copied onto the frames, which gives exactly the pixels of drawing on them.
+    """
+    alpha = mask[..., 3]
+    rows, cols = np.flatnonzero(alpha.any(axis=1)), np.flatnonzero(alpha.any(axis=0))
+    if len(rows) == 0:
+        return frames
+    box = (slice(rows[0], rows[-1] + 1), slice(cols[0], cols[-1] + 1))
+    box_frames, box_mask, box_alpha = frames[..., box[0], box[1], :], mask[box], alpha[box][..., None]
+    if np.all((box_alpha == 0) | (box_alpha == 255)):
+        np.copyto(box_frames, box_mask[..., :3], where=box_alpha == 255)
+    else:
+        blended = (box_frames * (255 - box_alpha.astype(np.uint16)) + box_mask[..., :3] * box_alpha.astype(np.uint16) + 127) // 255
+        box_frames[...] = blended
+    return frames
 
-    return result_video
+def control_signal_overlay(control_signal_video):
+    """
+    An overlay for `MultiOutputVideoWriter` that adds the control signal video (49, 480, 720, 3) to the frames, like the
+    `___with_control_signal` video of `do_inference`. Only float frames give exactly the pixels of the float video.
+    """
+    def overlay(frames, start_frame):
+        control_signal = control_signal_video[start_frame:start_frame + len(frames)]
+        if frames.dtype == np.uint8:
+            frames = frames / 255.0
+        return frames_to_uint8(np.clip(frames + control_signal, 0, 1.0))
+    return overlay
+
+def force_prompt_overlay(draw_force_prompt, num_frames_with_signal=1, render_once=False):
+    """
+    An overlay for `MultiOutputVideoWriter` that draws a force prompt, e.g. a `functools.partial` of
+    `draw_point_force_prompt`, on the first `num_frames_with_signal` frames of the video. With `render_once`
+    the prompt is rendered into a mask on the first call and composited onto the frames, which only pays off for
+    prompts that take longer to draw than to composite, like the wind force arrows.
+    """
+    masks = {}
+
+    def overlay(frames, start_frame):
+        num_frames = max(min(num_frames_with_signal - start_frame, len(frames)), 0)
+        frames = frames.copy() if frames.dtype == np.uint8 else frames_to_uint8(frames)
+        if num_frames == 0:
+            return frames
+        if not render_once:
+            for frame in frames[:num_frames]:
+                draw_force_prompt(frame)
+            return frames
+        height, width = frames.shape[1:3]
+        if (height, width) not in masks:
+            masks[height, width] = render_force_prompt_mask(height, width, draw_force_prompt)
+        composite_overlay_mask(frames[:num_frames], masks[height, width])
+        return frames
+    return overlay
 
 def get_object_description_point_force(file_id):
 
@@ -328,6 +437,88 @@ def get_object_description_point_force(file_id):
     assert file_id in file_id_to_object_description
     return file_id_to_object_description[file_id]
 
+def estimate_inference_memory_per_sample(args, transformer):
+    """
+    A rough estimate, in bytes, of the extra GPU memory one more (sample, seed) pair needs during the denoising loop:
+    the activations of the widest layers of a transformer block (qkv and the 4x feed-forward), for both halves of the
+    classifier free guidance batch, plus the control signal video. The VAE decode is not included, use
+    `--enable_slicing` so that it decodes one video at a time.
+    """
+    config = transformer.config
+    latent_frames = (args.max_num_frames - 1) // 4 + 1
+    num_tokens = latent_frames * (args.height // 8 // config.patch_size) * (args.width // 8 // config.patch_size)
+    num_tokens += config.max_text_seq_length
+    inner_dim = config.num_attention_heads * config.attention_head_dim
+    bytes_per_element = torch.finfo(transformer.dtype).bits // 8
+    cfg_factor = 2 if args.guidance_scale > 1.0 else 1
+
+    activations = 10 * num_tokens * inner_dim * bytes_per_element * cfg_factor
+    control_signal = cfg_factor * args.max_num_frames * 3 * args.height * args.width * bytes_per_element
+    return activations + control_signal
+
+
+def get_inference_batch_size(args, transformer):
+    """
+    `args.inference_batch_size`, lowered so that the estimated memory of the batch fits into
+    `args.inference_memory_budget_gb` when that is set.
+    """
+    inference_batch_size = max(args.inference_batch_size, 1)
+    if args.inference_memory_budget_gb is not None:
+        per_sample = estimate_inference_memory_per_sample(args, transformer)
+        max_batch_size = max(int(args.inference_memory_budget_gb * 1024 ** 3 // per_sample), 1)
+        if max_batch_size < inference_batch_size:
+            print(
+                f"Lowering the inference batch size from {inference_batch_size} to {max_batch_size} to stay within"
+                f" {args.inference_memory_budget_gb} GB (~{per_sample / 1024 ** 3:.2f} GB per video)."
+            )
+            inference_batch_size = max_batch_size
+    return inference_batch_size
+
+
+# the arguments that cannot change a generated video; every other argument is part of the key of a result in the
+# `ResultIndex`, so that a new argument makes an earlier result miss instead of being reused with other settings. The
+# sample and the seed are part of the key on their own, the controlnet checkpoint by the digest of its content
+RESULT_INDEPENDENT_ARGS = [
+    # inputs, outputs and bookkeeping
+    "video_root_dir", "csv_path", "csv_path_val", "csv_paths_val", "image_root_dir_val", "output_dir", "logging_dir",
+    "pretrained_controlnet_path", "quantized_weights_dir", "launch_script_path", "seed", "num_validation_videos",
+    "regenerate_existing_results", "skip_training_and_only_generate_val_videos",
+    # how the videos are scheduled, decoded and written, which gives the same frames
+    "dataloader_num_workers", "inference_batch_size", "inference_memory_budget_gb", "streaming_decode", "decode_worker",
+    # training only
+    "train_batch_size", "num_train_epochs", "max_train_steps", "checkpointing_steps", "checkpoints_total_limit",
+    "validation_steps", "gradient_accumulation_steps", "gradient_checkpointing", "learning_rate", "scale_lr",
+    "lr_scheduler", "lr_warmup_steps", "lr_num_cycles", "lr_power", "optimizer", "use_8bit_adam", "adam_beta1",
+    "adam_beta2", "prodigy_beta3", "prodigy_decouple", "adam_weight_decay", "adam_epsilon", "max_grad_norm",
+    "prodigy_use_bias_correction", "prodigy_safeguard_warmup", "init_from_transformer",
+    # logging and the hub
+    "tracker_name", "report_to", "push_to_hub", "hub_token", "hub_model_id",
+]
+
+
+def get_result_settings(args):
+    """
+    The arguments that a generated video depends on, besides its sample and seed.
+    """
+    return {name: value for name, value in sorted(vars(args).items()) if name not in RESULT_INDEPENDENT_ARGS}
+
+
+def make_control_signal(args, sample, device):
+    """
+    The control signal of a queued sample, built directly on `device` from its force parameters instead of copying
+    the dataset's (1, 49, 3, 480, 720) float32 video over.
+    """
+    num_frames, num_channels, height, width = sample["controlnet_videos"].shape[1:]
+    shape_kwargs = {"num_frames": num_frames, "num_channels": num_channels, "height": height, "width": width}
+    if args.controlnet_type == "point_force":
+        control_signal = point_force_control_signal(
+            sample["normalized_force"], sample["angle"], sample["x_pos"], sample["y_pos"], device=device, **shape_kwargs
+        )
+    else:
+        control_signal = wind_force_control_signal(sample["normalized_force"], sample["angle"], device=device, **shape_kwargs)
+    return control_signal[None] # (1, 49, 3, 480, 720)
+
+
 def do_inference(
     accelerator,
     transformer,
@@ -358,13 +549,239 @@ def do_inference(
         local_files_only=False,
     )
 
+    controlnet_residual_cache = None
+    if (
+        args.controlnet_cache_interval > 1
+        or args.controlnet_cache_temb_threshold is not None
+        or args.controlnet_cache_residual_threshold is not None
+    ):
+        controlnet_residual_cache = ControlnetResidualCache(
+            refresh_interval=args.controlnet_cache_interval,
+            temb_threshold=args.controlnet_cache_temb_threshold,
+            residual_threshold=args.controlnet_cache_residual_threshold,
+            max_skip_steps=args.controlnet_cache_max_skip_steps,
+        )
+
+    # the scheduler, the embeddings and the rotary embeddings are set up once for all samples
+    session = InferenceSession(
+        pipe,
+        accelerator.device,
+        embedding_map=embedding_map,
+        pipeline_kwargs={
+            "guidance_scale": args.guidance_scale,
+            "use_dynamic_cfg": args.use_dynamic_cfg,
+            "cfg_guidance_start": args.cfg_guidance_start,
+            "cfg_guidance_end": args.cfg_guidance_end,
+            "height": args.height,
+            "width": args.width,
+            "num_frames": args.max_num_frames,
+            "num_inference_steps": args.num_inference_steps,
+            "controlnet_cfg_mode": args.controlnet_cfg_mode,
+            "controlnet_residual_cache": controlnet_residual_cache,
+            "output_type": "np"
+        },
+    )
+    pipe = session.pipe
+
+    inference_batch_size = get_inference_batch_size(args, pipe.transformer)
+    print(f"Generating up to {inference_batch_size} (sample, seed) pairs per pipeline call.")
+    pending_generations = []
+    pending_video_writers = [] # the video writers that may still be encoding
+
+    def wait_for_video_writers():
+        while len(pending_video_writers) > 0:
+            pending_video_writers.pop(0).wait()
+    # decodes batch k while batch k + 1 is denoised
+    decode_worker = DecodeWorker(pipe, accelerator.device) if args.decode_worker else None
+    manifest_records = []
+
+    # videos that an earlier, interrupted run already generated are skipped; the index is saved as videos are written
+    result_index = ResultIndex(args.output_dir, accelerator.process_index)
+    result_settings = get_result_settings(args)
+    result_settings["controlnet_checkpoint"] = checkpoint_digest(args.pretrained_controlnet_path)
+    pending_results = [] # (video writer, result key, manifest record) until the videos are written
+
+    def get_result_key(sample, i):
+        return result_key(
+            image=sample["image_digest"],
+            prompt=sample["prompt"],
+            mode=sample["mode"],
+            controlnet_weights=sample["controlnet_weights"],
+            normalized_force=sample["normalized_force"],
+            angle=sample["angle"],
+            x_pos=sample["x_pos"],
+            y_pos=sample["y_pos"],
+            seed=args.seed + i if args.seed else None,
+            video_index=i,
+            **result_settings,
+        )
+
+    def commit_written_results():
+        """
+        Add the results whose videos are written to the index, and save it.
+        """
+        written = [result for result in pending_results if result[0].done]
+        pending_results[:] = [result for result in pending_results if not result[0].done]
+        for video_writer, key, record in written:
+            if not video_writer.errors:
+                result_index.add(key, record)
+        if len(written) > 0:
+            result_index.save()
+
+    # with several processes every one generates its own share of the samples, balanced by the number of videos;
+    # a video's seed only depends on its index, so it is the same whichever process generates it
+    val_dataset = val_dataloader.dataset
+    if accelerator.num_processes > 1:
+        shard_indices = shard_dataset_indices(
+            val_dataset,
+            accelerator.num_processes,
+            accelerator.process_index,
+            sample_cost=args.num_validation_videos,
+            max_group_size=inference_batch_size,
+        )
+        val_dataloader = DataLoader(
+            Subset(val_dataset, shard_indices),
+            batch_size=1,
+            shuffle=False,
+            collate_fn=val_dataloader.collate_fn,
+            num_workers=val_dataloader.num_workers,
+        )
+        print(f"Process {accelerator.process_index} generates {len(shard_indices)} of {len(val_dataset)} samples.")
+    else:
+        shard_indices = list(range(len(val_dataset)))
+
+    def generate_batch(generations):
+        """
+        Generate the videos of a list of (sample, video index) pairs in one batched pipeline call, and save them.
+        Every pair has its own generator, seeded with `args.seed + video index`, so a video doesn't depend on what it
+        is batched with.
+        """
+        request = {
+            "prompt": [sample["prompt"] for sample, _ in generations], # list of str
+            "image": torch.cat([sample["first_frames"] for sample, _ in generations]).to(accelerator.device), # (b, 3, 480, 720)
+            "controlnet_frames": torch.cat([make_control_signal(args, sample, accelerator.device) for sample, _ in generations]), # (b, 49, 3, 480, 720)
+            # all samples of one run use the same mode, and therefore the same weights
+            "controlnet_weights": generations[0][0]["controlnet_weights"],
+            "seeds": [args.seed + i for _, i in generations] if args.seed else None,
+        }
+
+        # a force/angle sweep over the same image, prompt and seed encodes the image and draws the noise only once
+        is_sweep = (
+            len(generations) > 1
+            and len(set(request["prompt"])) == 1
+            and len(set(i for _, i in generations)) == 1
+            and all(torch.equal(sample["first_frames"], generations[0][0]["first_frames"]) for sample, _ in generations)
+        )
+
+        # every generated video is encoded once per output (the video itself and its overlays), in the background
+        video_writers = []
+        for sample, i in generations:
+            output_dir = sample["output_dir"]
+            fname_base_generated_video = sample["fname_base_generated_video"]
+            outputs = {os.path.join(output_dir, f"{fname_base_generated_video}__video_{i}.mp4"): None}
+
+            if sample["mode"] == "controlnet_with_force_control_signal":
+                # visualize video and control signal prompt in same video
+                filename_generated_video_with_force_prompt = os.path.join(
+                    output_dir, 
+                    f"{fname_base_generated_video}___video_{i}_with_control_signal.mp4"
+                )
+                outputs[filename_generated_video_with_force_prompt] = control_signal_overlay(sample["control_signal_video"].numpy())
+
+            # visualize video and a pretty version of the control signal prompt in same video
+            filename_generated_video_with_force_prompt_aesthetic = os.path.join(
+                output_dir, 
+                f"{fname_base_generated_video}___video_{i}_with_pretty_force_prompt.mp4"
+            )
+
+            if args.controlnet_type == "point_force":
+                outputs[filename_generated_video_with_force_prompt_aesthetic] = force_prompt_overlay(
+                    functools.partial(
+                        draw_point_force_prompt, force=sample["normalized_force"], angle=sample["angle"],
+                        x_pos=sample["x_pos"], y_pos=1 - sample["y_pos"]
+                    ),
+                    num_frames_with_signal=8,
+                )
+            elif args.controlnet_type == "wind_force":
+                outputs[filename_generated_video_with_force_prompt_aesthetic] = force_prompt_overlay(
+                    functools.partial(draw_wind_force_prompt, force=sample["normalized_force"], angle=sample["angle"]),
+                    num_frames_with_signal=49,
+                    render_once=True,
+                )
+            video_writers.append(MultiOutputVideoWriter(outputs, fps=8))
+            record = {
+                "dataset_index": sample["dataset_index"],
+                "video_index": i,
+                "seed": args.seed + i if args.seed else None,
+                "process_index": accelerator.process_index,
+                "mode": sample["mode"],
+                "prompt": sample["prompt"],
+                "normalized_force": float(sample["normalized_force"]),
+                "angle": float(sample["angle"]),
+                "x_pos": float(sample["x_pos"]) if sample["x_pos"] is not None else None,
+                "y_pos": float(sample["y_pos"]) if sample["y_pos"] is not None else None,
+                "videos": list(outputs),
+            }
+            manifest_records.append(record)
+            pending_results.append((video_writers[-1], get_result_key(sample, i), record))
+
+        # the videos are written while they are decoded
+        def write_decoded_frames(frames):
+            for video_writer, video in zip(video_writers, frames):
+                video_writer.write(video)
+
+        def close_video_writers():
+            # finish encoding while the next batch is generated
+            for video_writer in video_writers:
+                video_writer.close(wait=False)
+
+        if decode_worker is not None:
+            request["output_type"] = "latent"
+        elif args.streaming_decode:
+            request["decoded_frames_callback"] = write_decoded_frames
+
+        # generate the videos
+        if is_sweep:
+            seeds = request.pop("seeds")
+            request["prompt"] = request["prompt"][0]
+            request["image"] = request["image"][:1]
+            request["seed"] = seeds[0] if seeds is not None else None
+            videos = session.generate_sweep(request) # (b, 49, 480, 720, 3)
+        else:
+            videos = session.generate(request).frames # (b, 49, 480, 720, 3)
+        if controlnet_residual_cache is not None:
+            print(controlnet_residual_cache.summary())
+        if pipe.transformer.block_output_cache is not None:
+            print(pipe.transformer.block_output_cache.summary())
+        for name, model in (("transformer", pipe.transformer), ("controlnet", pipe.controlnet)):
+            if model.block_streaming is not None:
+                print(f"{name} {model.block_streaming.summary()}")
+
+        # the videos of the previous batch were encoded while this one was denoised; they are finished before the
+        # videos of this batch are written, so that at most two batches of encoder threads and ffmpeg processes exist
+        wait_for_video_writers()
+
+        if decode_worker is not None:
+            decode_worker.submit(videos, write_decoded_frames, close_video_writers) # (b, 13, 16, 60, 90)
+        else:
+            if not args.streaming_decode:
+                write_decoded_frames(videos)
+            close_video_writers()
+        pending_video_writers.extend(video_writers)
+        commit_written_results()
+
     # for validation_prompt, validation_video in zip(validation_prompts, validation_videos):
     print(f"Beginning val with {len(val_dataloader)} batches...")
-    for _, val_batch in enumerate(val_dataloader):
+    for dataset_index, val_batch in zip(shard_indices, val_dataloader):
 
         # BASELINE: controlnet weights = 0, updated text prompt
         # PHYSICS CONTROL: controlnet weights = 1, original text prompt
         file_id = val_batch["file_ids"][0]
+        # the baseline videos go next to the images of the sample's CSV, which differ between the CSVs of a benchmark
+        if hasattr(val_dataset, "get_video_root_dir"):
+            image_root_dir_val = val_dataset.get_video_root_dir(dataset_index)
+        else:
+            image_root_dir_val = args.image_root_dir_val
 
         if args.controlnet_type == "point_force":
 
@@ -389,7 +806,7 @@ def do_inference(
                     "fname_image_condition" : f"{fname_str}___image_condition.png",
                     "fname_base_generated_video" : f"{fname_str}",
                     "fname_text_prompt" : f"{fname_str}_baseline___prompt.json",
-                    "output_dir" : os.path.join(os.path.dirname(os.path.dirname(args.image_root_dir_val)), "_videos_baseline_with_original_prompt")
+                    "output_dir" : os.path.join(os.path.dirname(os.path.dirname(image_root_dir_val)), "_videos_baseline_with_original_prompt")
                 },
                 "baseline_with_append_force_string_prompt" :  {
                     "controlnet_weights" : 0.0, # completely ignore controlnet signal!
@@ -397,7 +814,7 @@ def do_inference(
                     "fname_image_condition" : f"{fname_str}___image_condition.png",
                     "fname_base_generated_video" : f"{fname_str}_baseline",
                     "fname_text_prompt" : f"{fname_str}_baseline___prompt.json",
-                    "output_dir" : os.path.join(os.path.dirname(os.path.dirname(args.image_root_dir_val)), "_videos_baseline_with_append_force_string_prompt")
+                    "output_dir" : os.path.join(os.path.dirname(os.path.dirname(image_root_dir_val)), "_videos_baseline_with_append_force_string_prompt")
                 },
                 "baseline_finetune_with_append_force_string_prompt" :  {
                     "controlnet_weights" : 1.0, # use the controlnet signal!
@@ -440,7 +857,7 @@ def do_inference(
                     "fname_image_condition" : f"{fname_str}___image_condition.png",
                     "fname_base_generated_video" : f"{fname_str}",
                     "fname_text_prompt" : f"{fname_str}_baseline___prompt.json",
-                    "output_dir" : os.path.join(os.path.dirname(os.path.dirname(args.image_root_dir_val)), "videos_baseline_with_original_prompt")
+                    "output_dir" : os.path.join(os.path.dirname(os.path.dirname(image_root_dir_val)), "videos_baseline_with_original_prompt")
                 },
                 "baseline_with_append_force_string_prompt" :  {
                     "controlnet_weights" : 0.0, # completely ignore controlnet signal!
@@ -448,7 +865,7 @@ def do_inference(
                     "fname_image_condition" : f"{fname_str}___image_condition.png",
                     "fname_base_generated_video" : f"{fname_str}_baseline",
                     "fname_text_prompt" : f"{fname_str}_baseline___prompt.json",
-                    "output_dir" : os.path.join(os.path.dirname(os.path.dirname(args.image_root_dir_val)), f"_videos_baseline_with_append_force_string_prompts")
+                    "output_dir" : os.path.join(os.path.dirname(os.path.dirname(image_root_dir_val)), f"_videos_baseline_with_append_force_string_prompts")
                 },
                 "baseline_finetune_with_append_force_string_prompt" :  {
                     "controlnet_weights" : 1.0, # use the controlnet signal!
@@ -478,44 +895,8 @@ def do_inference(
             prompt = INFERENCE_CONFIGS_FOR_MODE[MODE]["prompt"]
             fname_base_generated_video = INFERENCE_CONFIGS_FOR_MODE[MODE]["fname_base_generated_video"]
             fname_text_prompt = INFERENCE_CONFIGS_FOR_MODE[MODE]["fname_text_prompt"]
-            
-            generator = torch.Generator(device=accelerator.device).manual_seed(args.seed) if args.seed else None
-
-            # We train on the simplified learning objective. If we were previously predicting a variance, we need the scheduler to ignore it
-            scheduler_args = {}
-
-            if "variance_type" in pipe.scheduler.config:
-                variance_type = pipe.scheduler.config.variance_type
-
-                if variance_type in ["learned", "learned_range"]:
-                    variance_type = "fixed_small"
-
-                scheduler_args["variance_type"] = variance_type
-
-            pipe.scheduler = CogVideoXDPMScheduler.from_config(pipe.scheduler.config, **scheduler_args)
-            pipe = pipe.to(accelerator.device)
-
-            pipeline_args = {
-                "prompt": prompt, # str
-                "image": val_batch["first_frames"].to(accelerator.device), # (1, 3, 480, 720)
-                "controlnet_frames": val_batch["controlnet_videos"].to(accelerator.device), # (1, 49, 3, 480, 720)
-                "guidance_scale": args.guidance_scale,
-                "use_dynamic_cfg": args.use_dynamic_cfg,
-                "height": args.height,
-                "width": args.width,
-                "num_frames": args.max_num_frames,
-                "num_inference_steps": args.num_inference_steps,
-                "controlnet_weights": controlnet_weights,
-                "generator": generator,
-                "output_type": "np"
-            }
-            if len(embedding_map) > 0: # in case we precomputed embeddings
-                del[pipeline_args["prompt"]]
-                pipeline_args["prompt_embeds"] = torch.load(embedding_map[prompt])
-                pipeline_args["negative_prompt_embeds"] = torch.load(embedding_map[''])
-
-
 
+            control_signal_video = None
             if MODE == "controlnet_with_force_control_signal":
                 # save the controlnet video
                 filename_control_signal = os.path.join(
@@ -524,7 +905,13 @@ def do_inference(
                 )
                 control_signal_video = val_batch["controlnet_videos"] # (1, 49, 3, 480, 720), torch.float32 from [-1,1] mostly -1
                 control_signal_video = rearrange(control_signal_video, 'b f c h w -> (b f) h w c') # (49, 480, 720, 3)
-                export_to_video(control_signal_video.numpy(), filename_control_signal, fps=8)
+                # the same float to uint8 conversion as `export_to_video`, encoded in the background; the writer only
+                # moves complete videos to their path, so an existing file is not left over from an interrupted run
+                if args.regenerate_existing_results or not os.path.isfile(filename_control_signal):
+                    video_writer = MultiOutputVideoWriter({filename_control_signal: None}, fps=8)
+                    video_writer.write((control_signal_video.numpy() * 255).astype(np.uint8))
+                    video_writer.close(wait=False)
+                    pending_video_writers.append(video_writer)
 
             # save the conditioning image as well...
             filename_image_condition = os.path.join(
@@ -546,60 +933,55 @@ def do_inference(
             with open(text_prompt_save_path, 'w') as f:
                 json.dump(text_prompt, f, indent=4)
 
-            videos = []
-            for i in range(args.num_validation_videos):
-
-                filename_generated_video = os.path.join(
-                    output_dir, 
-                    f"{fname_base_generated_video}__video_{i}.mp4"
-                )
-
-                # generate the video
-                video = pipe(**pipeline_args).frames[0] # (49, 480, 720, 3)
-                videos.append(video)
-
-                # save the generated video
-                export_to_video(video, filename_generated_video, fps=8)
-
-
-                if MODE == "controlnet_with_force_control_signal":
-                    # visualize video and control signal prompt in same video
-                    filename_generated_video_with_force_prompt = os.path.join(
-                        output_dir, 
-                        f"{fname_base_generated_video}___video_{i}_with_control_signal.mp4"
-                    )
-                    video_with_force_prompt = np.clip(video + control_signal_video.numpy(), 0, 1.0)
-                    export_to_video(
-                        video_with_force_prompt, filename_generated_video_with_force_prompt, fps=8
-                    )
-
-                # visualize video and a pretty version of the control signal prompt in same video
-                filename_generated_video_with_force_prompt_aesthetic = os.path.join(
-                    output_dir, 
-                    f"{fname_base_generated_video}___video_{i}_with_pretty_force_prompt.mp4"
-                )
-                min_force = val_dataloader.dataset.min_force
-                max_force = val_dataloader.dataset.max_force
-                normalized_force = (val_batch["force"][0] - min_force) / (max_force - min_force)
-
-                if args.controlnet_type == "point_force":
-                    video_with_force_prompt_aesthetic = add_aesthetic_point_force_prompt_to_video(
-                        video, normalized_force, angle, x_pos, 1 - y_pos, num_frames_with_signal=8
-                    )
-                elif args.controlnet_type == "wind_force":
-                    video_with_force_prompt_aesthetic = add_aesthetic_wind_force_prompt_to_video(
-                        video, normalized_force, angle, num_frames_with_signal=49
-                    )
-
-                export_to_video(
-                    video_with_force_prompt_aesthetic, filename_generated_video_with_force_prompt_aesthetic, fps=8
-                )
-
-        clear_objs_and_retain_memory([pipe])
-
-        # del pipeline_args, videos, control_signal_video
+            min_force = val_dataset.min_force
+            max_force = val_dataset.max_force
+            sample = {
+                "dataset_index": dataset_index,
+                "mode": MODE,
+                "prompt": prompt,
+                "controlnet_weights": controlnet_weights,
+                "first_frames": val_batch["first_frames"], # (1, 3, 480, 720)
+                "controlnet_videos": val_batch["controlnet_videos"], # (1, 49, 3, 480, 720)
+                "control_signal_video": control_signal_video,
+                "output_dir": output_dir,
+                "fname_base_generated_video": fname_base_generated_video,
+                "normalized_force": (val_batch["force"][0] - min_force) / (max_force - min_force),
+                "angle": angle,
+                "x_pos": x_pos if args.controlnet_type == "point_force" else None,
+                "y_pos": y_pos if args.controlnet_type == "point_force" else None,
+                "image_digest": tensor_digest(val_batch["first_frames"]),
+            }
 
-    del pipe
+            # queue one (sample, seed) pair per video; they are generated in batches of `inference_batch_size`
+            for i in range(args.num_validation_videos):
+                if not args.regenerate_existing_results:
+                    record = result_index.lookup(get_result_key(sample, i))
+                    if record is not None:
+                        manifest_records.append({**record, "dataset_index": dataset_index, "process_index": accelerator.process_index})
+                        continue
+                pending_generations.append((sample, i))
+                if len(pending_generations) == inference_batch_size:
+                    generate_batch(pending_generations)
+                    pending_generations = []
+
+    if len(pending_generations) > 0:
+        generate_batch(pending_generations)
+
+    if decode_worker is not None:
+        decode_worker.close()
+    wait_for_video_writers()
+    commit_written_results()
+    print(result_index.summary())
+
+    # one manifest of all generated videos, in dataset order
+    write_manifest_shard(args.output_dir, accelerator.process_index, manifest_records)
+    accelerator.wait_for_everyone()
+    if accelerator.is_main_process:
+        manifest_records = merge_manifest_shards(args.output_dir, accelerator.num_processes)
+        print(f"Wrote the manifest of {len(manifest_records)} videos to {args.output_dir}.")
+        result_index.merge()
+
+    del session, pipe
     torch.cuda.empty_cache()
     import gc
     gc.collect()
@@ -0,0 +1,177 @@
+from typing import Optional
+
+import torch
+from torch import nn
+
+
+def _module_tensors(module: nn.Module):
+    # (owner, name, is_parameter) of every parameter and buffer, with the submodule that holds it
+    for owner in module.modules():
+        for name, param in owner._parameters.items():
+            if param is not None:
+                yield owner, name, True
+        for name, buffer in owner._buffers.items():
+            if buffer is not None:
+                yield owner, name, False
+
+
+def _get_tensor(owner: nn.Module, name: str, is_parameter: bool) -> torch.Tensor:
+    return owner._parameters[name].data if is_parameter else owner._buffers[name]
+
+
+def _set_tensor(owner: nn.Module, name: str, is_parameter: bool, tensor: torch.Tensor):
+    if is_parameter:
+        owner._parameters[name].data = tensor
+    else:
+        owner._buffers[name] = tensor
+
+
+class BlockStreamingOffload:
+    r"""
+    Keeps the weights of the transformer blocks of a model in host memory and streams them to `device` block by block,
+    so that only about two blocks are on the device at a time. Everything else of the model, e.g. the patch embedding
+    and the output projection, is moved to `device` once. The weights are not changed, so the outputs are exactly
+    those of the model on the device.
+
+    A forward pre-hook of every block copies its weights to the device, unless they were prefetched, and starts the
+    copy of the next block; a forward hook drops the device copy again once the block has run. The block after the
+    last one is the first, which is copied while the rest of the model and the next denoising step start. On CUDA the
+    host copies are pinned and the copies run on their own stream, overlapping with the compute of the current block.
+
+    With `simulate=True` (the default on CPU) the "device copy" is a clone in host memory and an offloaded block holds
+    empty placeholders, so that using a block whose weights were not streamed in fails, and `bytes_transferred`
+    counts the copied bytes. Only for inference: autograd would keep the device copies alive for the backward pass.
+    """
+
+    def __init__(
+        self,
+        model: nn.Module,
+        device: torch.device,
+        dtype: Optional[torch.dtype] = None,
+        blocks: Optional[nn.ModuleList] = None,
+        simulate: Optional[bool] = None,
+        prefetch: bool = True,
+    ):
+        self.device = torch.device(device)
+        self.simulate = self.device.type != "cuda" if simulate is None else simulate
+        self.prefetch = prefetch
+        self.blocks = blocks if blocks is not None else model.transformer_blocks
+        # the blocks that run in a forward pass, a model that only runs the first few sets it so that those wrap around
+        self.num_active_blocks = len(self.blocks)
+        self.copy_stream = torch.cuda.Stream(self.device) if self.device.type == "cuda" and not self.simulate else None
+
+        block_tensors = set()
+        for block in self.blocks:
+            block_tensors.update((id(owner), name) for owner, name, _ in _module_tensors(block))
+
+        # the rest of the model lives on the device
+        for owner, name, is_parameter in _module_tensors(model):
+            if (id(owner), name) not in block_tensors:
+                tensor = _get_tensor(owner, name, is_parameter)
+                _set_tensor(owner, name, is_parameter, tensor.to(self.device, dtype=dtype if tensor.is_floating_point() else None))
+
+        # per block: (owner, name, is_parameter, host tensor, placeholder) of all its weights
+        self.host_tensors = []
+        self.block_bytes = []
+        for block in self.blocks:
+            tensors = []
+            for owner, name, is_parameter in _module_tensors(block):
+                tensor = _get_tensor(owner, name, is_parameter)
+                host_tensor = tensor.to("cpu", dtype=dtype if tensor.is_floating_point() else None)
+                if self.copy_stream is not None:
+                    host_tensor = host_tensor.pin_memory()
+                placeholder = host_tensor.new_empty(0) if self.simulate else host_tensor
+                _set_tensor(owner, name, is_parameter, placeholder)
+                tensors.append((owner, name, is_parameter, host_tensor, placeholder))
+            self.host_tensors.append(tensors)
+            self.block_bytes.append(sum(host.numel() * host.element_size() for _, _, _, host, _ in tensors))
+
+        # block index -> (device tensors, copy event) of the streamed-in blocks; `resident` are those in use
+        self.prefetched = {}
+        self.resident = set()
+        self.bytes_transferred = 0
+        self.max_blocks_on_device = 0
+
+        self.hook_handles = []
+        for index, block in enumerate(self.blocks):
+            self.hook_handles.append(block.register_forward_pre_hook(self._make_pre_hook(index)))
+            self.hook_handles.append(block.register_forward_hook(self._make_post_hook(index)))
+
+    def _make_pre_hook(self, index):
+        def pre_hook(module, args):
+            self.load_block(index)
+            if self.prefetch:
+                self._copy_block((index + 1) % self.num_active_blocks)
+
+        return pre_hook
+
+    def _make_post_hook(self, index):
+        def post_hook(module, args, output):
+            self.offload_block(index)
+
+        return post_hook
+
+    def _copy_block(self, index):
+        if index in self.resident or index in self.prefetched:
+            return
+        copy_event = None
+        if self.copy_stream is not None:
+            with torch.cuda.stream(self.copy_stream):
+                device_tensors = [host.to(self.device, non_blocking=True) for _, _, _, host, _ in self.host_tensors[index]]
+            copy_event = torch.cuda.Event()
+            copy_event.record(self.copy_stream)
+        elif self.simulate:
+            device_tensors = [host.clone() for _, _, _, host, _ in self.host_tensors[index]]
+        else:
+            device_tensors = [host.to(self.device) for _, _, _, host, _ in self.host_tensors[index]]
+        self.prefetched[index] = (device_tensors, copy_event)
+        self.bytes_transferred += self.block_bytes[index]
+        self.max_blocks_on_device = max(self.max_blocks_on_device, len(self.resident) + len(self.prefetched))
+
+    def load_block(self, index: int):
+        """
+        Put the weights of block `index` on the device, e.g. to use a layer of the block outside of its forward. They
+        stay there until the block has run.
+        """
+        if index in self.resident:
+            return
+        self._copy_block(index)
+        device_tensors, copy_event = self.prefetched.pop(index)
+        if copy_event is not None:
+            torch.cuda.current_stream(self.device).wait_event(copy_event)
+        for (owner, name, is_parameter, _, _), tensor in zip(self.host_tensors[index], device_tensors):
+            if copy_event is not None:
+                # allocated on the copy stream, used and freed on the compute stream
+                tensor.record_stream(torch.cuda.current_stream(self.device))
+            _set_tensor(owner, name, is_parameter, tensor)
+        self.resident.add(index)
+
+    def offload_block(self, index: int):
+        if index not in self.resident:
+            return
+        for owner, name, is_parameter, _, placeholder in self.host_tensors[index]:
+            _set_tensor(owner, name, is_parameter, placeholder)
+        self.resident.discard(index)
+
+    @property
+    def total_block_bytes(self):
+        return sum(self.block_bytes)
+
+    def remove(self):
+        """
+        Remove the hooks and leave the weights of all blocks in host memory.
+        """
+        for handle in self.hook_handles:
+            handle.remove()
+        self.hook_handles = []
+        self.prefetched = {}
+        self.resident = set()
+        for tensors in self.host_tensors:
+            for owner, name, is_parameter, host_tensor, _ in tensors:
+                _set_tensor(owner, name, is_parameter, host_tensor)
+
+    def summary(self) -> str:
+        return (
+            f"block streaming: {self.bytes_transferred / 2**20:.1f} MiB transferred, at most"
+            f" {self.max_blocks_on_device}/{len(self.blocks)} blocks on the device"
+        )
@@ -0,0 +1,163 @@
+import math
+from typing import Optional
+
+import torch
+import torch.nn.functional as F
+from torch import nn
+from diffusers.models.attention_processor import Attention
+from diffusers.models.embeddings import apply_rotary_emb
+
+
+def attention_chunk_sizes(batch_heads: int, query_length: int, key_length: int, element_size: int, memory_budget: int, min_query_chunk_size: int = 64):
+    """
+    The query and key chunk sizes for which the attention scores of one chunk, and their exponentials, fit into
+    `memory_budget` bytes, with `element_size` bytes per score (4 for the float32 online softmax). Keys are only split when not even `min_query_chunk_size` queries fit with all keys.
+    """
+    row_bytes = 2 * batch_heads * element_size
+    query_chunk_size = memory_budget // (row_bytes * key_length)
+    if query_chunk_size >= min(min_query_chunk_size, query_length):
+        return min(query_chunk_size, query_length), key_length
+    query_chunk_size = min(min_query_chunk_size, query_length)
+    return query_chunk_size, max(memory_budget // (row_bytes * query_chunk_size), 1)
+
+
+def chunked_scaled_dot_product_attention(
+    query: torch.Tensor,
+    key: torch.Tensor,
+    value: torch.Tensor,
+    query_chunk_size: int,
+    key_chunk_size: int,
+    attention_mask: Optional[torch.Tensor] = None,
+) -> torch.Tensor:
+    r"""
+    `F.scaled_dot_product_attention` of (B, H, L, D) tensors, `query_chunk_size` queries at a time. Every query chunk
+    attends to all keys with `F.scaled_dot_product_attention` itself, or, if the keys are split, to `key_chunk_size`
+    keys at a time with an online softmax: the running row maximum, the sum of the exponentials and the weighted sum
+    of the values are rescaled whenever a key chunk raises the maximum. The online softmax accumulates in float32.
+    """
+    query_length, key_length = query.shape[-2], key.shape[-2]
+    scale = 1.0 / math.sqrt(query.shape[-1])
+    outputs = []
+    for query_start in range(0, query_length, query_chunk_size):
+        query_chunk = query[:, :, query_start:query_start + query_chunk_size]
+        mask_chunk = attention_mask
+        if attention_mask is not None and attention_mask.shape[-2] > 1:
+            mask_chunk = attention_mask[..., query_start:query_start + query_chunk_size, :]
+
+        if key_chunk_size >= key_length:
+            outputs.append(F.scaled_dot_product_attention(query_chunk, key, value, attn_mask=mask_chunk, dropout_p=0.0, is_causal=False))
+            continue
+
+        query_chunk = query_chunk.float() * scale
+        row_max = torch.full((*query_chunk.shape[:-1], 1), float("-inf"), device=query.device)
+        row_sum = torch.zeros_like(row_max)
+        output = torch.zeros((*query_chunk.shape[:-1], value.shape[-1]), device=query.device)
+        for key_start in range(0, key_length, key_chunk_size):
+            key_chunk = key[:, :, key_start:key_start + key_chunk_size].float()
+            value_chunk = value[:, :, key_start:key_start + key_chunk_size].float()
+            scores = query_chunk @ key_chunk.transpose(-1, -2)
+            if mask_chunk is not None:
+                key_mask = mask_chunk[..., key_start:key_start + key_chunk_size]
+                scores = scores.masked_fill(~key_mask, float("-inf")) if key_mask.dtype == torch.bool else scores + key_mask
+            new_row_max = torch.maximum(row_max, scores.amax(dim=-1, keepdim=True))
+            # rows whose keys are all masked so far keep a maximum of -inf, which must not turn into nan
+            new_row_max = new_row_max.masked_fill(torch.isinf(new_row_max), 0.0)
+            correction = torch.exp(row_max - new_row_max)
+            probs = torch.exp(scores - new_row_max)
+            row_sum = row_sum * correction + probs.sum(dim=-1, keepdim=True)
+            output = output * correction + probs @ value_chunk
+            row_max = new_row_max
+        outputs.append((output / row_sum).to(value.dtype))
+    return torch.cat(outputs, dim=2)
+
+
+class ChunkedCogVideoXAttnProcessor:
+    r"""
+    `CogVideoXAttnProcessor2_0` with the attention computed in chunks (`chunked_scaled_dot_product_attention`), such
+    that the scores of one chunk take at most `memory_budget` bytes. With a budget that fits the whole score matrix
+    it is plain `F.scaled_dot_product_attention`. Query chunks with all keys give the same result as the unchunked
+    attention; when the keys are split as well, the online softmax differs from it by float rounding.
+
+    `max_chunk_bytes` keeps the largest score chunk used so far.
+    """
+
+    def __init__(self, memory_budget: int, min_query_chunk_size: int = 64):
+        self.memory_budget = memory_budget
+        self.min_query_chunk_size = min_query_chunk_size
+        self.max_chunk_bytes = 0
+
+    def __call__(
+        self,
+        attn: Attention,
+        hidden_states: torch.Tensor,
+        encoder_hidden_states: torch.Tensor,
+        attention_mask: Optional[torch.Tensor] = None,
+        image_rotary_emb: Optional[torch.Tensor] = None,
+    ) -> torch.Tensor:
+        text_seq_length = encoder_hidden_states.size(1)
+
+        hidden_states = torch.cat([encoder_hidden_states, hidden_states], dim=1)
+
+        batch_size, sequence_length, _ = hidden_states.shape
+
+        if attention_mask is not None:
+            attention_mask = attn.prepare_attention_mask(attention_mask, sequence_length, batch_size)
+            attention_mask = attention_mask.view(batch_size, attn.heads, -1, attention_mask.shape[-1])
+
+        query = attn.to_q(hidden_states)
+        key = attn.to_k(hidden_states)
+        value = attn.to_v(hidden_states)
+
+        inner_dim = key.shape[-1]
+        head_dim = inner_dim // attn.heads
+
+        query = query.view(batch_size, -1, attn.heads, head_dim).transpose(1, 2)
+        key = key.view(batch_size, -1, attn.heads, head_dim).transpose(1, 2)
+        value = value.view(batch_size, -1, attn.heads, head_dim).transpose(1, 2)
+
+        if attn.norm_q is not None:
+            query = attn.norm_q(query)
+        if attn.norm_k is not None:
+            key = attn.norm_k(key)
+
+        # Apply RoPE if needed
+        if image_rotary_emb is not None:
+            query[:, :, text_seq_length:] = apply_rotary_emb(query[:, :, text_seq_length:], image_rotary_emb)
+            if not attn.is_cross_attention:
+                key[:, :, text_seq_length:] = apply_rotary_emb(key[:, :, text_seq_length:], image_rotary_emb)
+
+        # the online softmax keeps its scores and probabilities in float32, also for half precision inputs
+        score_element_size = max(query.element_size(), 4)
+        query_chunk_size, key_chunk_size = attention_chunk_sizes(
+            batch_size * attn.heads, query.shape[2], key.shape[2], score_element_size, self.memory_budget,
+            min_query_chunk_size=self.min_query_chunk_size,
+        )
+        self.max_chunk_bytes = max(
+            self.max_chunk_bytes, batch_size * attn.heads * query_chunk_size * min(key_chunk_size, key.shape[2]) * score_element_size
+        )
+        hidden_states = chunked_scaled_dot_product_attention(
+            query, key, value, query_chunk_size, key_chunk_size, attention_mask=attention_mask
+        )
+
+        hidden_states = hidden_states.transpose(1, 2).reshape(batch_size, -1, attn.heads * head_dim)
+
+        # linear proj
+        hidden_states = attn.to_out[0](hidden_states)
+        # dropout
+        hidden_states = attn.to_out[1](hidden_states)
+
+        encoder_hidden_states, hidden_states = hidden_states.split(
+            [text_seq_length, hidden_states.size(1) - text_seq_length], dim=1
+        )
+        return hidden_states, encoder_hidden_states
+
+
+def enable_chunked_attention(model: nn.Module, memory_budget: int, min_query_chunk_size: int = 64) -> ChunkedCogVideoXAttnProcessor:
+    """
+    Use one `ChunkedCogVideoXAttnProcessor` for the attention of all transformer blocks of `model`, e.g. the
+    transformer or the controlnet, and return it.
+    """
+    processor = ChunkedCogVideoXAttnProcessor(memory_budget, min_query_chunk_size=min_query_chunk_size)
+    for block in model.transformer_blocks:
+        block.attn1.set_processor(processor)
+    return processor
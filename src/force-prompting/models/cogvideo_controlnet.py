@@ -10,6 +10,7 @@ from diffusers.loaders import  PeftAdapterMixin
 from diffusers.utils.torch_utils import maybe_allow_in_graph
 from diffusers.models.embeddings import TimestepEmbedding, Timesteps, get_3d_sincos_pos_embed # CogVideoXPatchEmbed
 from .cogvideo_patch_embed import CogVideoXPatchEmbed
+from .block_streaming import BlockStreamingOffload
 from diffusers.models.modeling_utils import ModelMixin
 from diffusers.models.attention import Attention, FeedForward
 from diffusers.models.attention_processor import AttentionProcessor, AttnProcessor2_0
@@ -133,11 +134,12 @@ class CogVideoXControlnet(ModelMixin, ConfigMixin, PeftAdapterMixin):
                 for _ in range(num_layers)
             ]
         )
-        # ... as well as the zero-convs that we apply after
+        # ... as well as the zero-convs that we apply after, to the block outputs or their projections
+        zero_conv_dim = out_proj_dim or inner_dim
         self.controlnet_zero_convs_after = nn.ModuleList(
             [
                 zero_module(
-                    nn.Conv3d(in_channels=3072, out_channels=3072, kernel_size=1, stride=1, padding=0)
+                    nn.Conv3d(in_channels=zero_conv_dim, out_channels=zero_conv_dim, kernel_size=1, stride=1, padding=0)
                 )
                 for _ in range(num_layers)
             ]
@@ -151,25 +153,216 @@ class CogVideoXControlnet(ModelMixin, ConfigMixin, PeftAdapterMixin):
             )
             
         self.gradient_checkpointing = False
+        # options of the sparse control signal encoder, see `enable_sparse_control_encoding`
+        self.sparse_control_encoding = None
+        # encode spatially uniform control signals (e.g. wind force) at a single position, see
+        # `enable_uniform_control_encoding`
+        self.uniform_control_encoding = False
+        # streams the block weights from host memory, see `enable_block_streaming`
+        self.block_streaming = None
         
     def _set_gradient_checkpointing(self, module, value=False):
         self.gradient_checkpointing = value
 
+    def enable_sparse_control_encoding(self, background_value: float = 0.0, atol: float = 1e-4, max_active_fraction: float = 0.5):
+        r"""
+        Encode mostly-empty control signals (e.g. the point-force Gaussian blob on a zero background) sparsely. Only the
+        latent cells in which some pixel differs from `background_value` by more than `atol` go through the encoder
+        convs; every other cell of a frame has the same "empty input" response, which is computed once per frame and
+        enters the GroupNorm statistics with the number of cells it stands for.
+
+        With `atol=0` the result matches the dense encoder up to floating point summation order. Larger values treat
+        the tails of the blob as background, which is what makes the active region small. Falls back to the dense
+        encoder when more than `max_active_fraction` of the latent cells of a latent frame are active.
+        """
+        self.sparse_control_encoding = {
+            "background_value": background_value,
+            "atol": atol,
+            "max_active_fraction": max_active_fraction,
+        }
+
+    def disable_sparse_control_encoding(self):
+        self.sparse_control_encoding = None
+
+    def enable_uniform_control_encoding(self):
+        r"""
+        Encode control signals whose frames are each constant over space (e.g. the wind-force signal) at a single
+        position and broadcast the result. All positions of the encoder output are identical for such signals, so this
+        matches the full encoder up to floating point summation order. Checking for it costs a min/max pass over the
+        control signal on every forward. Inference only.
+        """
+        self.uniform_control_encoding = True
+
+    def disable_uniform_control_encoding(self):
+        self.uniform_control_encoding = False
+
+    def enable_block_streaming(self, device: torch.device, dtype: Optional[torch.dtype] = None, simulate: Optional[bool] = None):
+        r"""
+        Keep the weights of the transformer blocks in host memory and stream them to `device` block by block, moving
+        the encoder, the zero-convs and the projectors to `device` (and `dtype`). See `BlockStreamingOffload`.
+        Inference only.
+        """
+        self.block_streaming = BlockStreamingOffload(self, device, dtype=dtype, simulate=simulate)
+
+    def disable_block_streaming(self):
+        if self.block_streaming is not None:
+            self.block_streaming.remove()
+        self.block_streaming = None
+
     def compress_time(self, x, num_frames):
-        x = rearrange(x, '(b f) c h w -> b f c h w', f=num_frames)
-        batch_size, frames, channels, height, width = x.shape
-        x = rearrange(x, 'b f c h w -> (b h w) c f')
-        
-        if x.shape[-1] % 2 == 1:
-            x_first, x_rest = x[..., 0], x[..., 1:]
-            if x_rest.shape[-1] > 0:
-                x_rest = F.avg_pool1d(x_rest, kernel_size=2, stride=2)
+        # average pairs of consecutive frames, keeping the first frame as is when the frame count is odd. Works on a
+        # (b, f, c, h, w) view with strided frame slices instead of permuting to (b h w) c f for avg_pool1d; the
+        # result is bitwise identical, since halving a sum is exact.
+        x = x.unflatten(0, (-1, num_frames)) # (b * f, c, h, w) --> (b, f, c, h, w)
+        num_first = num_frames % 2
+        x_first = x[:, :num_first]
+        x_even, x_odd = x[:, num_first::2], x[:, num_first + 1::2]
+
+        if torch.is_grad_enabled() and x.requires_grad:
+            x = torch.cat([x_first, (x_even + x_odd) * 0.5], dim=1)
+        else:
+            out = x.new_empty((x.shape[0], num_first + x_even.shape[1], *x.shape[2:]))
+            out[:, :num_first] = x_first
+            torch.add(x_even, x_odd, out=out[:, num_first:]).mul_(0.5)
+            x = out
+        return x.flatten(0, 1) # (b * f', c, h, w)
+
+    def encode_controlnet_states(self, controlnet_states):
+        """
+        Encode the control signal video (b, f, c, h, w) to (b, f', 32, h / downscale_coef, w / downscale_coef).
+
+        With `enable_uniform_control_encoding`, a signal whose every frame is constant over space is encoded at a single
+        position and broadcast (the GroupNorm statistics over identical positions are those of a single one). With
+        `enable_sparse_control_encoding`, mostly-empty signals only run the encoder on their active cells.
+        """
+        if self.uniform_control_encoding:
+            encoded = self._encode_controlnet_states_uniform(controlnet_states)
+            if encoded is not None:
+                return encoded
+
+        if self.sparse_control_encoding is not None:
+            encoded = self._encode_controlnet_states_sparse(controlnet_states, **self.sparse_control_encoding)
+            if encoded is not None:
+                return encoded
+
+        batch_size, num_frames, channels, height, width = controlnet_states.shape # (1, 49, 3, 480, 720)
+        controlnet_states = rearrange(controlnet_states, 'b f c h w -> (b f) c h w') # (1, 49, 3, 480, 720) --> (49, 3, 480, 720)
+        controlnet_states = self.unshuffle(controlnet_states) # (49, 192, 60, 90)
+        controlnet_states = self.controlnet_encode_first(controlnet_states) # (49, 96, 60, 90)
+        controlnet_states = self.compress_time(controlnet_states, num_frames=num_frames) # (25, 96, 60, 90)
+        num_frames = controlnet_states.shape[0] // batch_size # 25
+
+        controlnet_states = self.controlnet_encode_second(controlnet_states) # (25, 32, 60, 90)
+        controlnet_states = self.compress_time(controlnet_states, num_frames=num_frames) # (13, 32, 60, 90)
+        controlnet_states = rearrange(controlnet_states, '(b f) c h w -> b f c h w', b=batch_size) # (1, 13, 32, 60, 90)
+        return controlnet_states
+
+    @staticmethod
+    def _sparse_conv_norm_relu(encoder, x, cell_weights):
+        # 1x1 conv + GroupNorm + ReLU on (frames, c, k + 1) columns, where the last column stands for cell_weights[-1]
+        # identical background cells. The GroupNorm statistics are weighted accordingly.
+        conv, norm, _ = encoder
+        x = torch.matmul(conv.weight.flatten(1), x) + conv.bias[:, None]
 
-            x = torch.cat([x_first[..., None], x_rest], dim=-1)
+        frames, channels, num_columns = x.shape
+        x_grouped = x.float().view(frames, norm.num_groups, channels // norm.num_groups, num_columns)
+        weights = cell_weights.float()
+        count = (channels // norm.num_groups) * weights.sum()
+        mean = (x_grouped * weights).sum(dim=(2, 3), keepdim=True) / count
+        var = ((x_grouped - mean) ** 2 * weights).sum(dim=(2, 3), keepdim=True) / count
+        x_grouped = (x_grouped - mean) * torch.rsqrt(var + norm.eps)
+        x = x_grouped.view(frames, channels, num_columns).to(x.dtype)
+        if norm.affine:
+            x = x * norm.weight[:, None] + norm.bias[:, None]
+        return F.relu(x)
+
+    @staticmethod
+    def _sparse_compress_time(x, batch_size):
+        # same as `compress_time`, on (b * f, c, k + 1) columns that share their cell indices within a latent frame
+        x = x.unflatten(0, (batch_size, -1))
+        if x.shape[1] % 2 == 1:
+            x_first, x_rest = x[:, :1], x[:, 1:]
+            x_rest = x_rest.unflatten(1, (-1, 2)).mean(dim=2)
+            x = torch.cat([x_first, x_rest], dim=1)
         else:
-            x = F.avg_pool1d(x, kernel_size=2, stride=2)
-        x = rearrange(x, '(b h w) c f -> (b f) c h w', b=batch_size, h=height, w=width)
-        return x
+            x = x.unflatten(1, (-1, 2)).mean(dim=2)
+        return x.flatten(0, 1)
+
+    def _encode_controlnet_states_uniform(self, controlnet_states):
+        batch_size, num_frames, channels, height, width = controlnet_states.shape # (1, 49, 3, 480, 720)
+        pixels = controlnet_states.reshape(batch_size * num_frames, channels, height * width)
+        if not torch.equal(pixels.amax(dim=-1), pixels.amin(dim=-1)):
+            return None
+
+        downscale_coef = self.unshuffle.downscale_factor
+        latent_height, latent_width = height // downscale_coef, width // downscale_coef
+        # the PixelUnshuffle output of a single position
+        columns = pixels[..., :1].repeat_interleave(downscale_coef ** 2, dim=1) # (49, 192, 1)
+        cell_weights = torch.ones(1, device=columns.device)
+        columns = self._sparse_conv_norm_relu(self.controlnet_encode_first, columns, cell_weights) # (49, 96, 1)
+        columns = self._sparse_compress_time(columns, batch_size) # (25, 96, 1)
+        columns = self._sparse_conv_norm_relu(self.controlnet_encode_second, columns, cell_weights) # (25, 32, 1)
+        columns = self._sparse_compress_time(columns, batch_size) # (13, 32, 1)
+        columns = columns.unflatten(0, (batch_size, -1))[..., None]
+        return columns.expand(-1, -1, -1, latent_height, latent_width) # (1, 13, 32, 60, 90)
+
+    def _encode_controlnet_states_sparse(self, controlnet_states, background_value=0.0, atol=1e-4, max_active_fraction=0.5):
+        batch_size, num_frames, channels, height, width = controlnet_states.shape # (1, 49, 3, 480, 720)
+        temporal_compression = 4 # two `compress_time` passes
+        if (num_frames - 1) % temporal_compression != 0:
+            return None
+        num_latent_frames = (num_frames - 1) // temporal_compression + 1 # 13
+
+        downscale_coef = self.unshuffle.downscale_factor
+        latent_height, latent_width = height // downscale_coef, width // downscale_coef
+        num_cells = latent_height * latent_width
+        # (b, f, c, h', 8, w', 8), i.e. the pixels of every latent cell without the copy that PixelUnshuffle makes
+        cells = controlnet_states.reshape(
+            batch_size, num_frames, channels, latent_height, downscale_coef, latent_width, downscale_coef
+        )
+
+        # a cell is active if any of its pixels, in any of the frames that end up in the same latent frame, is not
+        # background. The latent frames are pixel frame 0, then groups of 4 pixel frames. Reducing over the
+        # contiguous last dim first is much faster than a single reduction over all the pixel dims.
+        cell_max = cells.amax(dim=-1).amax(dim=(2, 4))
+        cell_min = cells.amin(dim=-1).amin(dim=(2, 4))
+        active = (cell_max > background_value + atol) | (cell_min < background_value - atol) # (1, 49, 60, 90)
+        active = active.flatten(2)
+        active = torch.cat(
+            [active[:, :1], active[:, 1:].unflatten(1, (-1, temporal_compression)).any(dim=2)], dim=1
+        ) # (1, 13, 5400)
+        num_active = int(active.sum(dim=-1).max())
+        if num_active > max_active_fraction * num_cells:
+            return None
+
+        # pad the cell indices of every latent frame to the same count with background cells, which are then just
+        # computed explicitly
+        cell_indices = torch.topk(active.float(), num_active, dim=-1, sorted=False).indices # (1, 13, k)
+        frame_cell_indices = torch.cat(
+            [cell_indices[:, :1], cell_indices[:, 1:].repeat_interleave(temporal_compression, dim=1)], dim=1
+        ) # (1, 49, k)
+        batch_indices = torch.arange(batch_size, device=cells.device)[:, None, None]
+        frame_indices = torch.arange(num_frames, device=cells.device)[None, :, None]
+        columns = cells[
+            batch_indices, frame_indices, :, frame_cell_indices // latent_width, :, frame_cell_indices % latent_width, :
+        ] # (1, 49, k, 3, 8, 8), in the channel order of PixelUnshuffle
+        columns = columns.flatten(3).flatten(0, 1).transpose(1, 2) # (49, 192, k)
+        background = columns.new_full((*columns.shape[:2], 1), background_value)
+        columns = torch.cat([columns, background], dim=-1) # (49, 192, k + 1)
+
+        cell_weights = torch.ones(num_active + 1, device=columns.device)
+        cell_weights[-1] = num_cells - num_active
+        columns = self._sparse_conv_norm_relu(self.controlnet_encode_first, columns, cell_weights) # (49, 96, k + 1)
+        columns = self._sparse_compress_time(columns, batch_size) # (25, 96, k + 1)
+        columns = self._sparse_conv_norm_relu(self.controlnet_encode_second, columns, cell_weights) # (25, 32, k + 1)
+        columns = self._sparse_compress_time(columns, batch_size) # (13, 32, k + 1)
+
+        # fill every cell with the background response, then put the active cells back
+        cell_indices = cell_indices.flatten(0, 1)[:, None].expand(-1, columns.shape[1], -1)
+        controlnet_states = columns[..., -1:].expand(-1, -1, num_cells)
+        controlnet_states = controlnet_states.scatter(2, cell_indices, columns[..., :-1]) # (13, 32, 5400)
+        controlnet_states = controlnet_states.view(batch_size, num_latent_frames, -1, latent_height, latent_width)
+        return controlnet_states # (1, 13, 32, 60, 90)
         
     def forward(
         self,
@@ -180,19 +373,12 @@ class CogVideoXControlnet(ModelMixin, ConfigMixin, PeftAdapterMixin):
         image_rotary_emb: Optional[Tuple[torch.Tensor, torch.Tensor]] = None,
         timestep_cond: Optional[torch.Tensor] = None,
         return_dict: bool = True,
+        num_blocks: Optional[int] = None,
     ):
+        # `num_blocks` stops after the first few blocks, e.g. when the residuals of the later ones are weighted with 0
 
-        batch_size, num_frames, channels, height, width = controlnet_states.shape # (1, 49, 3, 480, 720)
         # 0. Controlnet encoder
-        controlnet_states = rearrange(controlnet_states, 'b f c h w -> (b f) c h w') # (1, 49, 3, 480, 720) --> (49, 3, 480, 720)
-        controlnet_states = self.unshuffle(controlnet_states) # (49, 192, 60, 90)
-        controlnet_states = self.controlnet_encode_first(controlnet_states) # (49, 96, 60, 90)
-        controlnet_states = self.compress_time(controlnet_states, num_frames=num_frames) # (25, 96, 60, 90)
-        num_frames = controlnet_states.shape[0] // batch_size # 25
-
-        controlnet_states = self.controlnet_encode_second(controlnet_states) # (25, 32, 60, 90)
-        controlnet_states = self.compress_time(controlnet_states, num_frames=num_frames) # (13, 32, 60, 90)
-        controlnet_states = rearrange(controlnet_states, '(b f) c h w -> b f c h w', b=batch_size) # (1, 13, 32, 60, 90)
+        controlnet_states = self.encode_controlnet_states(controlnet_states) # (1, 49, 3, 480, 720) --> (1, 13, 32, 60, 90)
 
         # concatenate along the channel dimension
         hidden_states = torch.cat([hidden_states, controlnet_states], dim=2) # (1, 13, 64, 60, 90)
@@ -238,7 +424,9 @@ class CogVideoXControlnet(ModelMixin, ConfigMixin, PeftAdapterMixin):
         
         controlnet_hidden_states = ()
         # 3. Transformer blocks
-        for i, block in enumerate(self.transformer_blocks):
+        if self.block_streaming is not None:
+            self.block_streaming.num_active_blocks = len(self.transformer_blocks[:num_blocks])
+        for i, block in enumerate(self.transformer_blocks[:num_blocks]):
             if self.training and self.gradient_checkpointing:
 
                 def create_custom_forward(module):
@@ -274,12 +462,10 @@ class CogVideoXControlnet(ModelMixin, ConfigMixin, PeftAdapterMixin):
             # need to pass them through the zero conv, I think...
             controlnet_hidden_states_after_zero_conv = ()
             for i, (zero_conv, hidden_states) in enumerate(zip(self.controlnet_zero_convs_after, controlnet_hidden_states)):
-                hidden_states = hidden_states.unsqueeze(-1).unsqueeze(-1) # (1, 17550, 1920) --> (1, 17550, 1920, 1, 1)
-                hidden_states = rearrange(hidden_states, 'b s c h w -> b c s h w') # (1, 17550, 1920, 1, 1) --> (1, 1920, 17550, 1, 1)
                 if DO_ZERO_CONV:
-                    hidden_states = zero_conv(hidden_states) # (1, 1920, 17550, 1, 1) --> (1, 1920, 17550, 1, 1)
-                hidden_states = rearrange(hidden_states, 'b c s h w -> b s c h w') # (1, 1920, 17550, 1, 1) --> (1, 17550, 1920, 1, 1)
-                hidden_states = hidden_states.squeeze(-1).squeeze(-1) # (1, 17550, 1920, 1, 1) --> (1, 17550, 1920)
+                    # a 1x1x1 Conv3d over channels is a linear layer on the token-major (1, 17550, 1920) layout; using
+                    # the conv weight as (out, in) keeps the checkpoints as they are and avoids the permute copies
+                    hidden_states = F.linear(hidden_states, zero_conv.weight.flatten(1), zero_conv.bias) # (1, 17550, 1920)
                 controlnet_hidden_states_after_zero_conv += (hidden_states,)
             return (controlnet_hidden_states_after_zero_conv,)
         else:
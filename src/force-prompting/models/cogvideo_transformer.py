@@ -7,10 +7,126 @@ import numpy as np
 from diffusers.utils import is_torch_version
 from diffusers.models.transformers.cogvideox_transformer_3d import Transformer2DModelOutput
 
+from models.block_streaming import BlockStreamingOffload
 from models.cogvideox_transformer_3d import CogVideoXTransformer3DModel
 
 
-class CustomCogVideoXTransformer3DModel(CogVideoXTransformer3DModel):        
+class TransformerBlockOutputCache:
+    r"""
+    Reuses the output of the transformer blocks across denoising steps, as the residual between the input and the
+    output of the whole block stack (including the added controlnet states). At every step a cheap indicator is
+    compared to the one of the previous step; the relative L1 changes are accumulated, and as long as the sum stays
+    below `threshold` the blocks are skipped and the cached residual is added to the input instead.
+
+    Indicators:
+        - `"hidden_states"` (default): the patch embedded input, which costs nothing to compute.
+        - `"modulated_input"`: the output of `norm1` of the first block on the hidden states, i.e. the timestep
+          modulated input of the block stack. It tracks `"hidden_states"` closely, but runs `norm1` on every step,
+          also on the steps whose blocks are skipped.
+        - `"timestep_embedding"`: the timestep embedding.
+
+    The comparison is strict, so `threshold=0` always runs the blocks and gives bit-exact outputs. With the default
+    `threshold=0.1` blocks are only skipped once consecutive steps change the indicator by less than 10% on average.
+    On the random-weight tiny models of the benchmark suite they change by 35% to 120% per step, so there the
+    default never skips; the `pipeline_transformer_cache` benchmark records the skips at larger thresholds.
+    """
+
+    INDICATORS = ["modulated_input", "timestep_embedding", "hidden_states"]
+
+    def __init__(self, threshold: float = 0.1, indicator: str = "hidden_states", max_skip_steps: Optional[int] = None):
+        if indicator not in self.INDICATORS:
+            raise ValueError(f"`indicator` has to be one of {self.INDICATORS}, but is {indicator}.")
+        self.threshold = threshold
+        self.indicator = indicator
+        self.max_skip_steps = max_skip_steps
+        self.num_hits = 0
+        self.num_misses = 0
+        self.reset()
+
+    def reset(self):
+        """
+        Forget the cached residuals, at the start of every pipeline call.
+        """
+        self.previous_indicator = None
+        self.accumulated_change = 0.0
+        self.steps_since_refresh = 0
+        self.hidden_states_residual = None
+        self.encoder_hidden_states_residual = None
+
+    def can_reuse(self, indicator: torch.Tensor) -> bool:
+        previous_indicator, self.previous_indicator = self.previous_indicator, indicator
+        if self.hidden_states_residual is None or previous_indicator is None:
+            return False
+        if previous_indicator.shape != indicator.shape:
+            return False
+        if self.max_skip_steps is not None and self.steps_since_refresh >= self.max_skip_steps:
+            return False
+        change = (indicator - previous_indicator).abs().mean() / previous_indicator.abs().mean().clamp_min(1e-12)
+        self.accumulated_change += change.item()
+        return self.accumulated_change < self.threshold
+
+    def update(self, hidden_states_residual: torch.Tensor, encoder_hidden_states_residual: torch.Tensor):
+        self.hidden_states_residual = hidden_states_residual
+        self.encoder_hidden_states_residual = encoder_hidden_states_residual
+        self.accumulated_change = 0.0
+        self.steps_since_refresh = 0
+        self.num_misses += 1
+
+    def apply(self, hidden_states: torch.Tensor, encoder_hidden_states: torch.Tensor):
+        self.steps_since_refresh += 1
+        self.num_hits += 1
+        return hidden_states + self.hidden_states_residual, encoder_hidden_states + self.encoder_hidden_states_residual
+
+    @property
+    def hit_rate(self):
+        return self.num_hits / max(self.num_hits + self.num_misses, 1)
+
+    def summary(self) -> str:
+        return (
+            f"transformer blocks skipped on {self.num_hits}/{self.num_hits + self.num_misses} steps"
+            f" ({100.0 * self.hit_rate:.1f}% hit rate)"
+        )
+
+
+class CustomCogVideoXTransformer3DModel(CogVideoXTransformer3DModel):
+    # see `enable_block_output_cache`
+    block_output_cache = None
+    # see `enable_block_streaming`
+    block_streaming = None
+
+    def enable_block_output_cache(self, threshold: float = 0.1, indicator: str = "hidden_states", max_skip_steps: Optional[int] = None):
+        r"""
+        Skip the transformer blocks on denoising steps whose input is similar to the previous step's, and reuse the
+        residual of the blocks from the last step on which they ran. See `TransformerBlockOutputCache`. Only used in
+        eval mode.
+        """
+        self.block_output_cache = TransformerBlockOutputCache(threshold, indicator, max_skip_steps)
+
+    def disable_block_output_cache(self):
+        self.block_output_cache = None
+
+    def enable_block_streaming(self, device: torch.device, dtype: Optional[torch.dtype] = None, simulate: Optional[bool] = None):
+        r"""
+        Keep the weights of the transformer blocks in host memory and stream them to `device` block by block, moving
+        the rest of the model to `device` (and `dtype`). See `BlockStreamingOffload`. Inference only.
+        """
+        self.block_streaming = BlockStreamingOffload(self, device, dtype=dtype, simulate=simulate)
+
+    def disable_block_streaming(self):
+        if self.block_streaming is not None:
+            self.block_streaming.remove()
+        self.block_streaming = None
+
+    def _block_output_cache_indicator(self, indicator, hidden_states, encoder_hidden_states, emb):
+        if indicator == "timestep_embedding":
+            return emb
+        if indicator == "hidden_states":
+            return hidden_states
+        if self.block_streaming is not None:
+            self.block_streaming.load_block(0)
+        norm_hidden_states, _, _, _ = self.transformer_blocks[0].norm1(hidden_states, encoder_hidden_states, emb)
+        return norm_hidden_states
+
     def forward(
         self,
         hidden_states: torch.Tensor,
@@ -46,10 +162,18 @@ class CustomCogVideoXTransformer3DModel(CogVideoXTransformer3DModel):
         hidden_states = hidden_states[:, text_seq_length:]
 
         # 3. Transformer blocks
-        if self.low_memory_mode:
-            transformer_blocks = self.transformer_blocks[:4]
-        else:
-            transformer_blocks = self.transformer_blocks
+        transformer_blocks = self.transformer_blocks
+
+        block_output_cache = None if self.training else self.block_output_cache
+        reuse_block_outputs = False
+        if block_output_cache is not None:
+            reuse_block_outputs = block_output_cache.can_reuse(
+                self._block_output_cache_indicator(block_output_cache.indicator, hidden_states, encoder_hidden_states, emb)
+            )
+            if reuse_block_outputs:
+                transformer_blocks = []
+            blocks_input = (hidden_states, encoder_hidden_states)
+
         for i, block in enumerate(transformer_blocks):
             if self.training and self.gradient_checkpointing:
 
@@ -84,10 +208,17 @@ class CustomCogVideoXTransformer3DModel(CogVideoXTransformer3DModel):
                 elif isinstance(controlnet_weights, (float, int)):
                     controlnet_block_weight = controlnet_weights
                 
-                hidden_states = hidden_states + controlnet_states_block * controlnet_block_weight 
+                # adding a residual weighted with 0 would not change anything
+                if not (isinstance(controlnet_block_weight, (float, int)) and controlnet_block_weight == 0):
+                    hidden_states = hidden_states + controlnet_states_block * controlnet_block_weight 
                 # print("# do we need some convex combination instead?")
                 # hidden_states = (hidden_states + controlnet_states_block) / 2
 
+        if reuse_block_outputs:
+            hidden_states, encoder_hidden_states = block_output_cache.apply(*blocks_input)
+        elif block_output_cache is not None:
+            block_output_cache.update(hidden_states - blocks_input[0], encoder_hidden_states - blocks_input[1])
+
         if not self.config.use_rotary_positional_embeddings:
             # CogVideoX-2B
             hidden_states = self.norm_final(hidden_states)
@@ -0,0 +1,216 @@
+import os
+import warnings
+from typing import Dict, Optional
+
+import torch
+import torch.nn.functional as F
+from torch import nn
+
+
+QUANTIZATION_BITS = {"int8": 8, "int4": 4}
+
+
+def _has_quantized_cpu_linear():
+    return torch.backends.quantized.engine != "none" and hasattr(torch.ops.quantized, "linear_dynamic")
+
+
+class QuantizedLinear(nn.Module):
+    r"""
+    A `nn.Linear` with weights stored as signed integers and symmetric scales.
+
+    - int8: one scale per output channel, the weights are a (out_features, in_features) int8 buffer.
+    - int4: one scale per `group_size` input channels of every output channel, two weights are packed into every byte
+      of a (out_features, in_features / 2) uint8 buffer.
+
+    The quantization is weight-only: the weights are dequantized `dequantize_chunk_size` output channels at a time and
+    multiplied with the activations as they are, so that only a chunk of float weights exists at once. That keeps it a
+    memory and storage option, unpacking the weights makes it slower than the float linear.
+
+    With `int8_matmul`, int8 weights on CPU are instead prepacked once for the quantized CPU engine (fbgemm / onednn)
+    and multiplied with `torch.ops.quantized.linear_dynamic`, which also quantizes the activations on every call (to 7
+    bits on fbgemm) and runs an int8 matmul. That is W8A8, with the activation error on top of the weight error, and
+    only faster than the float linear for large layers. The packed copy is kept next to `qweight`.
+
+    `scale` stays float32 when the module is cast to another dtype, e.g. with `model.to(torch.bfloat16)`.
+    """
+
+    dequantize_chunk_size = 1024
+
+    def __init__(
+        self, in_features: int, out_features: int, bias: bool = True, bits: int = 8, group_size: int = 64,
+        int8_matmul: bool = False,
+    ):
+        super().__init__()
+        if bits not in (4, 8):
+            raise ValueError(f"Only 8 and 4 bit weights are supported, got {bits}.")
+        self.in_features = in_features
+        self.out_features = out_features
+        self.bits = bits
+        self.int8_matmul = int8_matmul
+        self.group_size = min(group_size, in_features) if bits == 4 else in_features
+        if in_features % self.group_size != 0 or (bits == 4 and self.group_size % 2 != 0):
+            raise ValueError(f"in_features={in_features} has to be a multiple of an even group size, got {self.group_size}.")
+
+        if bits == 8:
+            self.register_buffer("qweight", torch.zeros((out_features, in_features), dtype=torch.int8))
+            self.register_buffer("scale", torch.ones(out_features))
+        else:
+            self.register_buffer("qweight", torch.zeros((out_features, in_features // 2), dtype=torch.uint8))
+            self.register_buffer("scale", torch.ones((out_features, in_features // self.group_size)))
+        self.register_buffer("bias", torch.zeros(out_features) if bias else None)
+        # (key of the buffers it was packed from, packed weight) for the quantized CPU engine
+        self.packed_weight = None
+
+    @classmethod
+    def from_linear(cls, linear: nn.Linear, bits: int = 8, group_size: int = 64, int8_matmul: bool = False):
+        module = cls(
+            linear.in_features, linear.out_features, bias=linear.bias is not None, bits=bits, group_size=group_size,
+            int8_matmul=int8_matmul,
+        )
+        weight = linear.weight.detach().float()
+        qmax = 2 ** (bits - 1) - 1
+        if bits == 8:
+            scale = weight.abs().amax(dim=1).clamp(min=1e-12) / qmax
+            qweight = torch.round(weight / scale[:, None]).clamp(-qmax, qmax).to(torch.int8)
+        else:
+            grouped = weight.reshape(module.out_features, -1, module.group_size)
+            scale = grouped.abs().amax(dim=2).clamp(min=1e-12) / qmax
+            qweight = torch.round(grouped / scale[..., None]).clamp(-qmax - 1, qmax).reshape(module.out_features, -1)
+            # offset to [0, 15], the even input channels go into the low nibble
+            qweight = (qweight + 8).to(torch.uint8)
+            qweight = qweight[:, 0::2] | (qweight[:, 1::2] << 4)
+        module.qweight.copy_(qweight)
+        module.scale = scale.to(linear.weight.device)
+        if linear.bias is not None:
+            module.bias = linear.bias.detach().clone()
+        return module.to(linear.weight.device)
+
+    def _apply(self, fn, recurse=True):
+        # casting the per-channel scales to half precision would put its rounding error on every weight of a channel,
+        # so they only follow the device
+        scale = self._buffers.pop("scale")
+        try:
+            super()._apply(fn, recurse=recurse)
+        finally:
+            moved = fn(scale)
+            self._buffers["scale"] = scale.to(moved.device) if moved.dtype != scale.dtype else moved
+        return self
+
+    def _load_from_state_dict(self, *args, **kwargs):
+        # the buffers are overwritten in place, so their addresses don't tell that the packed weight is stale
+        self.packed_weight = None
+        super()._load_from_state_dict(*args, **kwargs)
+
+    def dequantize(self, dtype: torch.dtype = torch.float32, start: int = 0, end: Optional[int] = None) -> torch.Tensor:
+        """
+        The float weights of the output channels `start:end`, scaled in float32 and then cast to `dtype`.
+        """
+        qweight, scale = self.qweight[start:end], self.scale[start:end].float()
+        if self.bits == 8:
+            return (qweight.float() * scale[:, None]).to(dtype)
+        low = (qweight & 0x0F).to(torch.int8) - 8
+        high = (qweight >> 4).to(torch.int8) - 8
+        weight = torch.stack([low, high], dim=-1).reshape(qweight.shape[0], -1, self.group_size)
+        return (weight.float() * scale[..., None]).reshape(qweight.shape[0], self.in_features).to(dtype)
+
+    def _get_packed_weight(self):
+        key = (self.qweight.data_ptr(), self.scale.data_ptr(), None if self.bias is None else self.bias.data_ptr())
+        if self.packed_weight is None or self.packed_weight[0] != key:
+            with warnings.catch_warnings():
+                # the quantized tensor constructors are deprecated, but the packed linear still takes one
+                warnings.simplefilter("ignore", UserWarning)
+                weight = torch._make_per_channel_quantized_tensor(
+                    self.qweight, self.scale.double(), torch.zeros(self.out_features, dtype=torch.long), 0
+                )
+            self.packed_weight = (key, torch.ops.quantized.linear_prepack(weight, None if self.bias is None else self.bias.float()))
+        return self.packed_weight[1]
+
+    def forward(self, hidden_states: torch.Tensor) -> torch.Tensor:
+        if self.int8_matmul and self.bits == 8 and hidden_states.device.type == "cpu" and _has_quantized_cpu_linear():
+            # fbgemm's int8 products saturate for full range activations, it needs them in 7 bits
+            reduce_range = torch.backends.quantized.engine in ("x86", "fbgemm")
+            output = torch.ops.quantized.linear_dynamic(
+                hidden_states.reshape(-1, self.in_features).float().contiguous(), self._get_packed_weight(), reduce_range
+            )
+            return output.reshape(*hidden_states.shape[:-1], self.out_features).to(hidden_states.dtype)
+
+        bias = self.bias.to(hidden_states.dtype) if self.bias is not None else None
+        outputs = []
+        for start in range(0, self.out_features, self.dequantize_chunk_size):
+            end = start + self.dequantize_chunk_size
+            weight = self.dequantize(hidden_states.dtype, start, end)
+            outputs.append(F.linear(hidden_states, weight, bias[start:end] if bias is not None else None))
+        return outputs[0] if len(outputs) == 1 else torch.cat(outputs, dim=-1)
+
+    def extra_repr(self) -> str:
+        return f"in_features={self.in_features}, out_features={self.out_features}, bits={self.bits}, group_size={self.group_size}"
+
+
+def _replace_block_linears(model: nn.Module, make_module, blocks: Optional[nn.ModuleList] = None):
+    blocks = blocks if blocks is not None else model.transformer_blocks
+    for block in blocks:
+        for name, module in list(block.named_modules()):
+            if isinstance(module, nn.Linear):
+                parent_name, _, child_name = name.rpartition(".")
+                parent = block.get_submodule(parent_name) if parent_name else block
+                setattr(parent, child_name, make_module(module))
+
+
+def quantize_block_linears(
+    model: nn.Module, quantization: str = "int8", group_size: int = 64, blocks: Optional[nn.ModuleList] = None,
+    int8_matmul: bool = False,
+):
+    """
+    Replace every `nn.Linear` of the transformer blocks of `model` (attention projections, feed forward and the
+    adaptive norms) by a `QuantizedLinear`, in place. Everything outside of the blocks keeps its weights.
+    """
+    bits = QUANTIZATION_BITS[quantization]
+    _replace_block_linears(
+        model,
+        lambda linear: QuantizedLinear.from_linear(linear, bits=bits, group_size=group_size, int8_matmul=int8_matmul),
+        blocks=blocks,
+    )
+    model.weight_quantization = {"quantization": quantization, "group_size": group_size}
+    return model
+
+
+def save_quantized_weights(model: nn.Module, path: str, source: Optional[Dict] = None):
+    """
+    Save the quantized linears of a model processed by `quantize_block_linears`, to be applied to the same
+    unquantized model with `load_quantized_weights`. `source` identifies the weights they were made from, e.g. the
+    checkpoint digest, and is checked on load.
+    """
+    state_dict = {
+        f"{name}.{key}": tensor.cpu()
+        for name, module in model.named_modules() if isinstance(module, QuantizedLinear)
+        for key, tensor in module.state_dict().items()
+    }
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    # written to a temporary file first, so that an interrupted save never leaves a truncated artifact
+    torch.save({**model.weight_quantization, "source": source, "state_dict": state_dict}, f"{path}.tmp")
+    os.replace(f"{path}.tmp", path)
+
+
+def load_quantized_weights(model: nn.Module, path: str, source: Optional[Dict] = None, int8_matmul: bool = False) -> bool:
+    """
+    Quantize the block linears of `model` with the weights saved by `save_quantized_weights`. Returns `False`, and
+    leaves the model unchanged, if the artifact was made from different weights than `source`.
+    """
+    artifact = torch.load(path, map_location="cpu", weights_only=True)
+    if artifact["source"] != source:
+        return False
+    # empty quantized modules of the right shapes, the float weights are not quantized again
+    bits = QUANTIZATION_BITS[artifact["quantization"]]
+    _replace_block_linears(model, lambda linear: QuantizedLinear(
+        linear.in_features, linear.out_features, bias=linear.bias is not None, bits=bits, group_size=artifact["group_size"],
+        int8_matmul=int8_matmul,
+    ).to(linear.weight.device))
+    model.weight_quantization = {"quantization": artifact["quantization"], "group_size": artifact["group_size"]}
+    for name, module in model.named_modules():
+        if isinstance(module, QuantizedLinear):
+            module.load_state_dict({key: artifact["state_dict"][f"{name}.{key}"] for key in module.state_dict()})
+    return True
+
+
+def module_weight_bytes(model: nn.Module) -> int:
+    return sum(t.numel() * t.element_size() for t in list(model.parameters()) + list(model.buffers()))
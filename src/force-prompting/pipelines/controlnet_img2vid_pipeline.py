@@ -1,5 +1,6 @@
 import inspect
 import math
+import threading
 from typing import Any, Callable, Dict, List, Optional, Tuple, Union
 
 import torch
@@ -19,6 +20,10 @@ from diffusers.callbacks import MultiPipelineCallbacks, PipelineCallback
 from diffusers.pipelines.cogvideo.pipeline_cogvideox import CogVideoXPipelineOutput, CogVideoXLoraLoaderMixin
 
 from models.cogvideo_controlnet import CogVideoXControlnet
+from pipelines.controlnet_residual_cache import ControlnetResidualCache
+
+# see `controlnet_cfg_mode` in `CogVideoXImageToVideoControlnetPipeline.__call__`
+CONTROLNET_CFG_MODES = ["full", "shared", "cond_only"]
 
 
 def resize_for_crop(image, crop_h, crop_w):
@@ -36,17 +41,19 @@ def resize_for_crop(image, crop_h, crop_w):
 
 def prepare_frames(input_images, video_size, do_resize=True, do_crop=True):
     """
-    input_images = np.stack([np.array(x) for x in input_images])
-    images_tensor = torch.from_numpy(input_images).permute(0, 3, 1, 2) / 127.5 - 1
+    Resize and center crop control signal frames, (..., C, H, W), to `video_size`, on the device they are on. Frames
+    that are already at `video_size`, like the control signals of our datasets, are returned as they are.
+    """
+    if tuple(input_images.shape[-2:]) == tuple(video_size):
+        return input_images
+    leading_dims = input_images.shape[:-3]
+    images_tensor = input_images.flatten(0, -4) if input_images.dim() > 3 else input_images[None]
+    # the whole stack at once, every frame has the same size
     if do_resize:
-        images_tensor = [resize_for_crop(x, crop_h=video_size[0], crop_w=video_size[1]) for x in images_tensor]
+        images_tensor = resize_for_crop(images_tensor, crop_h=video_size[0], crop_w=video_size[1])
     if do_crop:
-        images_tensor = [transforms.functional.center_crop(x, video_size) for x in images_tensor]
-    if isinstance(images_tensor, list):
-        images_tensor = torch.stack(images_tensor)
-    return images_tensor.unsqueeze(0) 
-    """
-    return input_images
+        images_tensor = transforms.functional.center_crop(images_tensor, video_size)
+    return images_tensor.reshape(*leading_dims, *images_tensor.shape[-3:])
 
 
 def get_resize_crop_region_for_grid(src, tgt_width, tgt_height):
@@ -67,6 +74,36 @@ def get_resize_crop_region_for_grid(src, tgt_width, tgt_height):
     return (crop_top, crop_left), (crop_top + resize_height, crop_left + resize_width)
 
 
+def video_chunk_to_frames(video: torch.Tensor) -> np.ndarray:
+    """
+    Decoded frames (B, C, f, H, W) in [-1, 1] to float frames (B, f, H, W, C) in [0, 1], the same as
+    `postprocess_video` with `output_type="np"`.
+    """
+    video = (video * 0.5 + 0.5).clamp(0, 1)
+    return video.permute(0, 2, 3, 4, 1).float().cpu().numpy()
+
+
+def get_controlnet_block_weights(controlnet_weights, step, timestep, num_blocks):
+    """
+    Resolve the `controlnet_weights` of the pipeline to a list with one float per controlnet block for a denoising step.
+    `controlnet_weights` can be a number (all blocks, all steps), a 1D sequence (per block), a 2D sequence of shape
+    (num_inference_steps, num_blocks or 1) (per step and block), or a callable `(step, timestep)` returning any of the
+    former.
+    """
+    if callable(controlnet_weights):
+        controlnet_weights = controlnet_weights(step, timestep)
+    if torch.is_tensor(controlnet_weights) or isinstance(controlnet_weights, np.ndarray):
+        controlnet_weights = controlnet_weights.tolist()
+    if isinstance(controlnet_weights, (float, int)):
+        return [float(controlnet_weights)] * num_blocks
+
+    if len(controlnet_weights) > 0 and isinstance(controlnet_weights[0], (list, tuple)):
+        controlnet_weights = controlnet_weights[step]
+        if len(controlnet_weights) == 1:
+            return [float(controlnet_weights[0])] * num_blocks
+    return [float(weight) for weight in controlnet_weights]
+
+
 # Copied from diffusers.pipelines.stable_diffusion.pipeline_stable_diffusion.retrieve_timesteps
 def retrieve_timesteps(
     scheduler,
@@ -198,9 +235,17 @@ class CogVideoXImageToVideoControlnetPipeline(DiffusionPipeline, CogVideoXLoraLo
 
         self.video_processor = VideoProcessor(vae_scale_factor=self.vae_scale_factor_spatial)
 
-    def prepare_controlnet_frames(self, controlnet_frames, height, width, do_classifier_free_guidance):
-        prepared_frames = prepare_frames(controlnet_frames, (height, width)) # right now, doesn't change anything... (1, 49, 3, 480, 720)
-        controlnet_encoded_frames = prepared_frames.to(dtype=self.vae.dtype, device='cuda')
+        # set to a dict to keep the rotary positional embeddings between calls, see `InferenceSession`
+        self.rotary_embedding_cache = None
+        # held around every use of the VAE, which a `DecodeWorker` shares with the pipeline calls of the main thread
+        self.vae_lock = threading.Lock()
+
+    def prepare_controlnet_frames(self, controlnet_frames, height, width, do_classifier_free_guidance, device=None):
+        # moved to the device first, so that any resizing happens there; a no-op for frames built on the device, see
+        # `data.control_signals`
+        device = device or self._execution_device
+        controlnet_frames = controlnet_frames.to(dtype=self.vae.dtype, device=device)
+        controlnet_encoded_frames = prepare_frames(controlnet_frames, (height, width)) # (1, 49, 3, 480, 720)
         controlnet_encoded_frames = torch.cat([controlnet_encoded_frames] * 2) if do_classifier_free_guidance else controlnet_encoded_frames
         return controlnet_encoded_frames.contiguous()
 
@@ -329,7 +374,7 @@ class CogVideoXImageToVideoControlnetPipeline(DiffusionPipeline, CogVideoXLoraLo
 
         return prompt_embeds, negative_prompt_embeds
 
-    def prepare_latents(
+    def prepare_image_latents(
         self,
         image: torch.Tensor,
         batch_size: int = 1,
@@ -340,34 +385,21 @@ class CogVideoXImageToVideoControlnetPipeline(DiffusionPipeline, CogVideoXLoraLo
         dtype: Optional[torch.dtype] = None,
         device: Optional[torch.device] = None,
         generator: Optional[torch.Generator] = None,
-        latents: Optional[torch.Tensor] = None,
     ):
+        """
+        Encode the conditioning image with the VAE into the scaled and zero-padded image latents that are concatenated
+        to the noisy latents along the channels, (B, F, C, H, W). The VAE posterior is sampled with `generator`.
+        """
         num_frames = (num_frames - 1) // self.vae_scale_factor_temporal + 1
-        shape = (
-            batch_size,
-            num_frames,
-            num_channels_latents,
-            height // self.vae_scale_factor_spatial,
-            width // self.vae_scale_factor_spatial,
-        ) # (1, 13, 16, 60, 90)
-        if isinstance(generator, list) and len(generator) != batch_size:
-            raise ValueError(
-                f"You have passed a list of generators of length {len(generator)}, but requested an effective batch"
-                f" size of {batch_size}. Make sure the batch size matches the length of the generators."
-            )
-
-        # For CogVideoX1.5, the latent should add 1 for padding (Not use)
-        if self.transformer.config.patch_size_t is not None:
-            shape = shape[:1] + (shape[1] + shape[1] % self.transformer.config.patch_size_t,) + shape[2:]
-
         image = image.unsqueeze(2)  # [B, C, F, H, W]
 
-        if isinstance(generator, list):
-            image_latents = [
-                retrieve_latents(self.vae.encode(image[i].unsqueeze(0)), generator[i]) for i in range(batch_size)
-            ]
-        else:
-            image_latents = [retrieve_latents(self.vae.encode(img.unsqueeze(0).to(self.vae.dtype)), generator) for img in image] # (1, 16, 1, 60, 90)
+        with self.vae_lock:
+            if isinstance(generator, list):
+                image_latents = [
+                    retrieve_latents(self.vae.encode(image[i].unsqueeze(0).to(self.vae.dtype)), generator[i]) for i in range(batch_size)
+                ]
+            else:
+                image_latents = [retrieve_latents(self.vae.encode(img.unsqueeze(0).to(self.vae.dtype)), generator) for img in image] # (1, 16, 1, 60, 90)
         image_latents = torch.cat(image_latents, dim=0).to(dtype).permute(0, 2, 1, 3, 4)  # [B, F, C, H, W] = (1, 1, 16, 60, 90)
 
         if not self.vae.config.invert_scale_latents:
@@ -392,6 +424,46 @@ class CogVideoXImageToVideoControlnetPipeline(DiffusionPipeline, CogVideoXLoraLo
         if self.transformer.config.patch_size_t is not None:
             first_frame = image_latents[:, : image_latents.size(1) % self.transformer.config.patch_size_t, ...]
             image_latents = torch.cat([first_frame, image_latents], dim=1)
+        return image_latents
+
+    def prepare_latents(
+        self,
+        image: torch.Tensor,
+        batch_size: int = 1,
+        num_channels_latents: int = 16,
+        num_frames: int = 13,
+        height: int = 60,
+        width: int = 90,
+        dtype: Optional[torch.dtype] = None,
+        device: Optional[torch.device] = None,
+        generator: Optional[torch.Generator] = None,
+        latents: Optional[torch.Tensor] = None,
+        image_latents: Optional[torch.Tensor] = None,
+    ):
+        shape = (
+            batch_size,
+            (num_frames - 1) // self.vae_scale_factor_temporal + 1,
+            num_channels_latents,
+            height // self.vae_scale_factor_spatial,
+            width // self.vae_scale_factor_spatial,
+        ) # (1, 13, 16, 60, 90)
+        if isinstance(generator, list) and len(generator) != batch_size:
+            raise ValueError(
+                f"You have passed a list of generators of length {len(generator)}, but requested an effective batch"
+                f" size of {batch_size}. Make sure the batch size matches the length of the generators."
+            )
+
+        # For CogVideoX1.5, the latent should add 1 for padding (Not use)
+        if self.transformer.config.patch_size_t is not None:
+            shape = shape[:1] + (shape[1] + shape[1] % self.transformer.config.patch_size_t,) + shape[2:]
+
+        if image_latents is None:
+            image_latents = self.prepare_image_latents(
+                image, batch_size, num_channels_latents, num_frames, height, width, dtype, device, generator
+            )
+        else:
+            # precomputed, e.g. shared by all samples of a sweep
+            image_latents = image_latents.to(device=device, dtype=dtype).expand(batch_size, -1, -1, -1, -1)
 
         if latents is None:
             latents = randn_tensor(shape, generator=generator, device=device, dtype=dtype)
@@ -407,9 +479,81 @@ class CogVideoXImageToVideoControlnetPipeline(DiffusionPipeline, CogVideoXLoraLo
         latents = latents.permute(0, 2, 1, 3, 4)  # [batch_size, num_channels, num_frames, height, width]
         latents = 1 / self.vae_scaling_factor_image * latents
 
-        frames = self.vae.decode(latents).sample
+        with self.vae_lock:
+            frames = self.vae.decode(latents).sample
         return frames
 
+    def decode_latents_streaming(self, latents: torch.Tensor):
+        """
+        Like `decode_latents`, but yields the video in temporal chunks, (B, C, f, H, W), so that only one chunk of the
+        decoded video has to be in memory. The chunks are the ones of `AutoencoderKLCogVideoX._decode` and
+        `tiled_decode`, and the causal convolutions carry their context from chunk to chunk in a `conv_cache` per
+        sample (with `enable_slicing`) and per spatial tile (with `enable_tiling`), so the concatenated chunks are
+        exactly the output of `decode_latents`. `vae_lock` is held while a chunk is decoded, but not between chunks.
+        """
+        vae = self.vae
+        z = latents.permute(0, 2, 1, 3, 4)  # [batch_size, num_channels, num_frames, height, width]
+        z = 1 / self.vae_scaling_factor_image * z
+
+        batch_size, num_channels, num_frames, height, width = z.shape
+        use_tiling = vae.use_tiling and (width > vae.tile_latent_min_width or height > vae.tile_latent_min_height)
+        samples = z.split(1) if vae.use_slicing and batch_size > 1 else [z]
+        conv_caches = {}
+
+        frame_batch_size = vae.num_latent_frames_batch_size
+        num_batches = max(num_frames // frame_batch_size, 1)
+        remaining_frames = num_frames % frame_batch_size
+        for k in range(num_batches):
+            start_frame = frame_batch_size * k + (0 if k == 0 else remaining_frames)
+            end_frame = frame_batch_size * (k + 1) + remaining_frames
+            chunks = []
+            with self.vae_lock:
+                for sample_index, sample in enumerate(samples):
+                    chunk = sample[:, :, start_frame:end_frame]
+                    if use_tiling:
+                        chunks.append(self._decode_tiled_latent_chunk(chunk, conv_caches, sample_index))
+                    else:
+                        chunks.append(self._decode_latent_chunk(chunk, conv_caches, sample_index))
+            yield torch.cat(chunks)
+
+    def _decode_latent_chunk(self, z, conv_caches, key):
+        if self.vae.post_quant_conv is not None:
+            z = self.vae.post_quant_conv(z)
+        z, conv_caches[key] = self.vae.decoder(z, conv_cache=conv_caches.get(key))
+        return z
+
+    def _decode_tiled_latent_chunk(self, z, conv_caches, key):
+        # one temporal chunk of `AutoencoderKLCogVideoX.tiled_decode`; the blending is per frame, so it can be done
+        # chunk by chunk
+        vae = self.vae
+        height, width = z.shape[-2:]
+        overlap_height = int(vae.tile_latent_min_height * (1 - vae.tile_overlap_factor_height))
+        overlap_width = int(vae.tile_latent_min_width * (1 - vae.tile_overlap_factor_width))
+        blend_extent_height = int(vae.tile_sample_min_height * vae.tile_overlap_factor_height)
+        blend_extent_width = int(vae.tile_sample_min_width * vae.tile_overlap_factor_width)
+        row_limit_height = vae.tile_sample_min_height - blend_extent_height
+        row_limit_width = vae.tile_sample_min_width - blend_extent_width
+
+        rows = []
+        for i in range(0, height, overlap_height):
+            row = []
+            for j in range(0, width, overlap_width):
+                tile = z[:, :, :, i : i + vae.tile_latent_min_height, j : j + vae.tile_latent_min_width]
+                row.append(self._decode_latent_chunk(tile, conv_caches, (key, i, j)))
+            rows.append(row)
+
+        result_rows = []
+        for i, row in enumerate(rows):
+            result_row = []
+            for j, tile in enumerate(row):
+                if i > 0:
+                    tile = vae.blend_v(rows[i - 1][j], tile, blend_extent_height)
+                if j > 0:
+                    tile = vae.blend_h(row[j - 1], tile, blend_extent_width)
+                result_row.append(tile[:, :, :, :row_limit_height, :row_limit_width])
+            result_rows.append(torch.cat(result_row, dim=4))
+        return torch.cat(result_rows, dim=3)
+
     # Copied from diffusers.pipelines.animatediff.pipeline_animatediff_video2video.AnimateDiffVideoToVideoPipeline.get_timesteps
     def get_timesteps(self, num_inference_steps, timesteps, strength, device):
         # get the original timestep using init_timestep
@@ -582,7 +726,7 @@ class CogVideoXImageToVideoControlnetPipeline(DiffusionPipeline, CogVideoXLoraLo
     def __call__(
         self,
         image,
-        controlnet_frames: List[Image.Image] = None,
+        controlnet_frames: Optional[torch.FloatTensor] = None,
         prompt: Optional[Union[str, List[str]]] = None,
         negative_prompt: Optional[Union[str, List[str]]] = None,
         height: Optional[int] = None, # 480
@@ -597,6 +741,7 @@ class CogVideoXImageToVideoControlnetPipeline(DiffusionPipeline, CogVideoXLoraLo
         generator: Optional[Union[torch.Generator, List[torch.Generator]]] = None,
         latents: Optional[torch.FloatTensor] = None,
         controlnet_latents: Optional[torch.FloatTensor] = None,
+        image_latents: Optional[torch.FloatTensor] = None,
         prompt_embeds: Optional[torch.FloatTensor] = None,
         negative_prompt_embeds: Optional[torch.FloatTensor] = None,
         output_type: str = "pil",
@@ -607,9 +752,14 @@ class CogVideoXImageToVideoControlnetPipeline(DiffusionPipeline, CogVideoXLoraLo
         ] = None,
         callback_on_step_end_tensor_inputs: List[str] = ["latents"],
         max_sequence_length: int = 226,
-        controlnet_weights: Optional[Union[float, list, np.ndarray, torch.FloatTensor]] = 1.0,
+        controlnet_weights: Optional[Union[float, list, np.ndarray, torch.FloatTensor, Callable[[int, int], Any]]] = 1.0,
         controlnet_guidance_start: float = 0.0,
         controlnet_guidance_end: float = 1.0,
+        controlnet_cfg_mode: str = "full",
+        controlnet_residual_cache: Optional[ControlnetResidualCache] = None,
+        cfg_guidance_start: float = 0.0,
+        cfg_guidance_end: float = 1.0,
+        decoded_frames_callback: Optional[Callable[[np.ndarray], None]] = None,
     ) -> Union[CogVideoXPipelineOutput, Tuple]:
         """
         Function invoked when calling the pipeline for generation.
@@ -655,6 +805,9 @@ class CogVideoXImageToVideoControlnetPipeline(DiffusionPipeline, CogVideoXLoraLo
                 Pre-generated noisy latents, sampled from a Gaussian distribution, to be used as inputs for image
                 generation. Can be used to tweak the same generation with different prompts. If not provided, a latents
                 tensor will ge generated by sampling using the supplied random `generator`.
+            image_latents (`torch.FloatTensor`, *optional*):
+                Pre-encoded latents of the conditioning image, as returned by `prepare_image_latents`, with a batch size
+                of 1 or of the whole batch. `image` is not encoded then, see `InferenceSession.generate_sweep`.
             prompt_embeds (`torch.FloatTensor`, *optional*):
                 Pre-generated text embeddings. Can be used to easily tweak text inputs, *e.g.* prompt weighting. If not
                 provided, text embeddings will be generated from `prompt` input argument.
@@ -684,6 +837,29 @@ class CogVideoXImageToVideoControlnetPipeline(DiffusionPipeline, CogVideoXLoraLo
             max_sequence_length (`int`, defaults to `226`):
                 Maximum sequence length in encoded prompt. Must be consistent with
                 `self.transformer.config.max_text_seq_length` otherwise may lead to poor results.
+            controlnet_weights (`float`, `list`, `np.ndarray`, `torch.FloatTensor` or `Callable`, defaults to `1.0`):
+                The weights of the controlnet residuals, for all blocks, per block, per step and block, or as a
+                function of the step, see `get_controlnet_block_weights`. The controlnet stops after the last block
+                with a non-zero weight, and is not evaluated at all on steps where all weights are zero.
+            controlnet_cfg_mode (`str`, defaults to `"full"`):
+                How the controlnet is run when using classifier free guidance. `"full"` runs it on both the
+                unconditional and the conditional batch. `"shared"` runs it only on the conditional batch and adds the
+                same residuals to both halves. `"cond_only"` runs it only on the conditional batch and leaves the
+                unconditional half without controlnet residuals, so the guidance also pushes towards the control
+                signal. Both of the latter halve the controlnet compute per step.
+            controlnet_residual_cache (`ControlnetResidualCache`, *optional*):
+                Reuse the controlnet residuals across denoising steps according to the refresh policy of the cache,
+                instead of evaluating the controlnet at every step. The cache is reset at the start of the call.
+            cfg_guidance_start (`float`, defaults to `0.0`):
+                The fraction of the denoising steps at which classifier free guidance starts to be applied, like
+                `controlnet_guidance_start`. Outside of `[cfg_guidance_start, cfg_guidance_end)` only the conditional
+                batch is evaluated, which halves the cost of those steps.
+            cfg_guidance_end (`float`, defaults to `1.0`):
+                The fraction of the denoising steps at which classifier free guidance stops being applied.
+            decoded_frames_callback (`Callable`, *optional*):
+                If set, the video is decoded in temporal chunks (see `decode_latents_streaming`) and each chunk is
+                passed to this callable as float frames in [0, 1] of shape (B, f, H, W, 3), e.g. `MultiOutputVideoWriter.write`,
+                instead of being returned. `output_type` is ignored and the returned frames are `None`.
 
         Examples:
 
@@ -714,6 +890,8 @@ class CogVideoXImageToVideoControlnetPipeline(DiffusionPipeline, CogVideoXLoraLo
             prompt_embeds=prompt_embeds,
             negative_prompt_embeds=negative_prompt_embeds,
         )
+        if controlnet_cfg_mode not in CONTROLNET_CFG_MODES:
+            raise ValueError(f"`controlnet_cfg_mode` has to be one of {CONTROLNET_CFG_MODES}, but is {controlnet_cfg_mode}.")
         self._guidance_scale = guidance_scale
         self._attention_kwargs = attention_kwargs
         self._interrupt = False
@@ -761,14 +939,15 @@ class CogVideoXImageToVideoControlnetPipeline(DiffusionPipeline, CogVideoXLoraLo
             additional_frames = patch_size_t - latent_frames % patch_size_t
             num_frames += additional_frames * self.vae_scale_factor_temporal
 
-        image = self.video_processor.preprocess(image, height=height, width=width).to(
-            device, dtype=prompt_embeds.dtype
-        ) # outputs torch.Size(1, 3, 480, 720), dtype=torch.float16
+        if image_latents is None:
+            image = self.video_processor.preprocess(image, height=height, width=width).to(
+                device, dtype=prompt_embeds.dtype
+            ) # outputs torch.Size(1, 3, 480, 720), dtype=torch.float16
 
         latent_channels = self.transformer.config.in_channels // 2
         latents, image_latents = self.prepare_latents(
             image, batch_size * num_videos_per_prompt, latent_channels, num_frames,
-            height, width, prompt_embeds.dtype, device, generator, latents
+            height, width, prompt_embeds.dtype, device, generator, latents, image_latents
         ) # (1, 13, 16, 60, 90), (1, 13, 16, 60, 90)
 
         # 6. Encode controlnet frames
@@ -778,17 +957,22 @@ class CogVideoXImageToVideoControlnetPipeline(DiffusionPipeline, CogVideoXLoraLo
                 height, 
                 width, 
                 do_classifier_free_guidance,
+                device,
             ) # (2, 49, 3, 480, 720), doubles it cuz do_classifier_free_guidance
 
         # 7. Prepare extra step kwargs. TODO: Logic should ideally just be moved out of the pipeline
         extra_step_kwargs = self.prepare_extra_step_kwargs(generator, eta)
 
         # 8. Create rotary embeds if required
-        image_rotary_emb = (
-            self._prepare_rotary_positional_embeddings(height, width, latents.size(1), device)
-            if self.transformer.config.use_rotary_positional_embeddings
-            else None
-        ) # (17550, 64)
+        image_rotary_emb = None
+        if self.transformer.config.use_rotary_positional_embeddings:
+            rotary_key = (height, width, latents.size(1), device)
+            if self.rotary_embedding_cache is not None and rotary_key in self.rotary_embedding_cache:
+                image_rotary_emb = self.rotary_embedding_cache[rotary_key]
+            else:
+                image_rotary_emb = self._prepare_rotary_positional_embeddings(height, width, latents.size(1), device) # (17550, 64)
+                if self.rotary_embedding_cache is not None:
+                    self.rotary_embedding_cache[rotary_key] = image_rotary_emb
 
         # 9. Create ofs embeds if required
         ofs_emb = None if self.transformer.config.ofs_embed_dim is None else latents.new_full((1,), fill_value=2.0)
@@ -796,50 +980,108 @@ class CogVideoXImageToVideoControlnetPipeline(DiffusionPipeline, CogVideoXLoraLo
         # 10. Denoising loop
         num_warmup_steps = max(len(timesteps) - num_inference_steps * self.scheduler.order, 0)
 
+        if controlnet_residual_cache is not None:
+            controlnet_residual_cache.reset()
+        if getattr(self.transformer, "block_output_cache", None) is not None:
+            self.transformer.block_output_cache.reset()
+
         with self.progress_bar(total=num_inference_steps) as progress_bar:
             # for DPM-solver++
             old_pred_original_sample = None
+            previous_step_cfg = None
             for i, t in enumerate(timesteps):
                 if self.interrupt:
                     continue
 
-                latent_model_input = torch.cat([latents] * 2) if do_classifier_free_guidance else latents # (2, 13, 16, 60, 90)
+                current_sampling_percent = i / len(timesteps)
+
+                # outside of the CFG range only the conditional half of the batch is evaluated
+                do_classifier_free_guidance_step = do_classifier_free_guidance and (
+                    cfg_guidance_start <= current_sampling_percent < cfg_guidance_end
+                )
+                if do_classifier_free_guidance and not do_classifier_free_guidance_step:
+                    step_prompt_embeds = prompt_embeds[prompt_embeds.shape[0] // 2:]
+                    step_controlnet_latents = controlnet_latents[controlnet_latents.shape[0] // 2:]
+                else:
+                    step_prompt_embeds = prompt_embeds
+                    step_controlnet_latents = controlnet_latents
+                if previous_step_cfg is not None and previous_step_cfg != do_classifier_free_guidance_step:
+                    # the cached residuals have the batch size of the other branch
+                    if controlnet_residual_cache is not None:
+                        controlnet_residual_cache.reset()
+                previous_step_cfg = do_classifier_free_guidance_step
+
+                latent_model_input = torch.cat([latents] * 2) if do_classifier_free_guidance_step else latents # (2, 13, 16, 60, 90)
                 latent_model_input = self.scheduler.scale_model_input(latent_model_input, t) # (2, 13, 16, 60, 90)
 
-                latent_image_input = torch.cat([image_latents] * 2) if do_classifier_free_guidance else image_latents # (2, 13, 16, 60, 90)
+                latent_image_input = torch.cat([image_latents] * 2) if do_classifier_free_guidance_step else image_latents # (2, 13, 16, 60, 90)
                 latent_model_input = torch.cat([latent_model_input, latent_image_input], dim=2) # (2, 13, 32, 60, 90)
 
                 # broadcast to batch dimension in a way that's compatible with ONNX/Core ML
                 timestep = t.expand(latent_model_input.shape[0])
-
-                current_sampling_percent = i / len(timesteps)
                 
                 controlnet_states = []
-                if (controlnet_guidance_start <= current_sampling_percent < controlnet_guidance_end):
+                controlnet_block_weights = get_controlnet_block_weights(
+                    controlnet_weights, i, t, len(self.controlnet.transformer_blocks)
+                )
+                # the blocks after the last one with a non-zero weight don't contribute anything
+                num_controlnet_blocks = max(
+                    [block + 1 for block, weight in enumerate(controlnet_block_weights) if weight != 0], default=0
+                )
+                use_controlnet = controlnet_guidance_start <= current_sampling_percent < controlnet_guidance_end
+                use_controlnet = use_controlnet and num_controlnet_blocks > 0
+                use_cached_controlnet_states = False
+                controlnet_temb = None
+                if use_controlnet and controlnet_residual_cache is not None:
+                    if controlnet_residual_cache.temb_threshold is not None:
+                        controlnet_temb = self.controlnet.time_embedding(
+                            self.controlnet.time_proj(t[None]).to(dtype=self.controlnet.dtype)
+                        )
+                    use_cached_controlnet_states = not controlnet_residual_cache.should_refresh(
+                        controlnet_temb, num_blocks=num_controlnet_blocks
+                    )
+
+                if use_cached_controlnet_states:
+                    controlnet_states = controlnet_residual_cache.get()
+                elif use_controlnet:
+                    # with a shared controlnet branch, only the conditional half of the CFG batch goes through the controlnet
+                    share_controlnet = do_classifier_free_guidance_step and controlnet_cfg_mode != "full"
+                    cond = slice(latent_model_input.shape[0] // 2, None) if share_controlnet else slice(None)
                     # extract controlnet hidden state
                     controlnet_states = self.controlnet(
-                        hidden_states=latent_model_input,#[:, :, :16, :, :], # it only compiles if i make it all of them... is that wrong? seems right, see above...
-                        encoder_hidden_states=prompt_embeds,
+                        hidden_states=latent_model_input[cond],#[:, :, :16, :, :], # it only compiles if i make it all of them... is that wrong? seems right, see above...
+                        encoder_hidden_states=step_prompt_embeds[cond],
                         image_rotary_emb=image_rotary_emb,
-                        controlnet_states=controlnet_latents,
-                        timestep=timestep,
+                        controlnet_states=step_controlnet_latents[step_controlnet_latents.shape[0] // 2:] if share_controlnet else step_controlnet_latents,
+                        timestep=timestep[cond],
                         return_dict=False,
-                    )[0] # tuple, each entry of shape (2, 17550, 3072)
+                        num_blocks=num_controlnet_blocks,
+                    )[0] # tuple, each entry of shape (2, 17550, 3072), or (1, 17550, 3072) if shared
                     if isinstance(controlnet_states, (tuple, list)):
                         controlnet_states = [x.to(dtype=self.transformer.dtype) for x in controlnet_states]
                     else:
                         controlnet_states = controlnet_states.to(dtype=self.transformer.dtype)
 
+                    if share_controlnet and controlnet_cfg_mode == "shared":
+                        # a batch of 1 broadcasts against the (2, 17550, 3072) hidden states
+                        if latent_model_input.shape[0] > 2:
+                            controlnet_states = [torch.cat([x, x]) for x in controlnet_states]
+                    elif share_controlnet and controlnet_cfg_mode == "cond_only":
+                        controlnet_states = [torch.cat([torch.zeros_like(x), x]) for x in controlnet_states]
+
+                    if controlnet_residual_cache is not None:
+                        controlnet_residual_cache.update(controlnet_states, controlnet_temb)
+
                 # predict noise model_output
                 noise_pred = self.transformer(
                     hidden_states=latent_model_input,
-                    encoder_hidden_states=prompt_embeds,
+                    encoder_hidden_states=step_prompt_embeds,
                     timestep=timestep,
                     # ofs=ofs_emb,
                     image_rotary_emb=image_rotary_emb,
                     # attention_kwargs=attention_kwargs,
                     controlnet_states=controlnet_states,
-                    controlnet_weights=controlnet_weights,
+                    controlnet_weights=controlnet_block_weights,
                     return_dict=False,
                 )[0] # (2, 13, 16, 60, 90)
                 noise_pred = noise_pred.float()
@@ -849,7 +1091,7 @@ class CogVideoXImageToVideoControlnetPipeline(DiffusionPipeline, CogVideoXLoraLo
                     self._guidance_scale = 1 + guidance_scale * (
                         (1 - math.cos(math.pi * ((num_inference_steps - t.item()) / num_inference_steps) ** 5.0)) / 2
                     )
-                if do_classifier_free_guidance:
+                if do_classifier_free_guidance_step:
                     noise_pred_uncond, noise_pred_text = noise_pred.chunk(2) # each has shape (1, 13, 16, 60, 90)
                     noise_pred = noise_pred_uncond + self.guidance_scale * (noise_pred_text - noise_pred_uncond) # (1, 13, 16, 60, 90)
 
@@ -882,7 +1124,13 @@ class CogVideoXImageToVideoControlnetPipeline(DiffusionPipeline, CogVideoXLoraLo
                 if i == len(timesteps) - 1 or ((i + 1) > num_warmup_steps and (i + 1) % self.scheduler.order == 0):
                     progress_bar.update()
 
-        if not output_type == "latent":
+        if decoded_frames_callback is not None:
+            # stream the video out chunk by chunk instead of returning it
+            latents = latents[:, additional_frames:]
+            for video_chunk in self.decode_latents_streaming(latents):
+                decoded_frames_callback(video_chunk_to_frames(video_chunk))
+            video = None
+        elif not output_type == "latent":
             # Discard any padding frames that were added for CogVideoX 1.5
             latents = latents[:, additional_frames:]
             video = self.decode_latents(latents)
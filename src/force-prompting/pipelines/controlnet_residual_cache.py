@@ -0,0 +1,123 @@
+from typing import List, Optional
+
+import torch
+
+
+class ControlnetResidualCache:
+    r"""
+    Reuses the controlnet block outputs (`controlnet_states`) across denoising steps. The control signal is the same at
+    every step and the residuals change slowly between adjacent timesteps, so the controlnet only has to be
+    re-evaluated now and then.
+
+    A refresh happens on the first step of every pipeline call and then whenever one of the enabled policies asks for
+    it:
+
+    - `refresh_interval`: every k-th step (`refresh_interval=1` evaluates the controlnet at every step, which is exactly
+      what the pipeline does without a cache).
+    - `temb_threshold`: the relative change of the controlnet timestep embedding, accumulated over the skipped steps,
+      since the last refresh exceeds the threshold.
+    - `residual_threshold`: the relative change of the residual norm between the last two refreshes, extrapolated
+      linearly to the current step, exceeds the threshold.
+
+    `max_skip_steps` bounds the number of consecutive reused steps for the adaptive policies.
+
+    Pass it to the pipeline with `pipe(..., controlnet_residual_cache=cache)`. `num_evaluations` and `num_skipped`
+    count over all calls until `reset_stats` is called.
+    """
+
+    def __init__(
+        self,
+        refresh_interval: int = 1,
+        temb_threshold: Optional[float] = None,
+        residual_threshold: Optional[float] = None,
+        max_skip_steps: Optional[int] = None,
+    ):
+        if refresh_interval < 1:
+            raise ValueError(f"`refresh_interval` has to be at least 1, but is {refresh_interval}.")
+        self.refresh_interval = refresh_interval
+        self.temb_threshold = temb_threshold
+        self.residual_threshold = residual_threshold
+        self.max_skip_steps = max_skip_steps
+        self.reset_stats()
+        self.reset()
+
+    @property
+    def adaptive(self):
+        return self.temb_threshold is not None or self.residual_threshold is not None
+
+    def reset(self):
+        """
+        Forget the cached residuals, at the start of every pipeline call.
+        """
+        self.controlnet_states = None
+        self.steps_since_refresh = 0
+        self.accumulated_temb_change = 0.0
+        self.previous_temb = None
+        self.residual_norm = None
+        self.residual_change_per_step = None
+
+    def reset_stats(self):
+        self.num_evaluations = 0
+        self.num_skipped = 0
+
+    def should_refresh(self, temb: Optional[torch.Tensor] = None, num_blocks: Optional[int] = None) -> bool:
+        """
+        Whether the controlnet has to be evaluated at the current step. `temb` is the controlnet timestep embedding of
+        the step, only needed with `temb_threshold`. `num_blocks` is the number of controlnet blocks the step needs,
+        the cached residuals may cover fewer.
+        """
+        if self.controlnet_states is None:
+            return True
+        if num_blocks is not None and len(self.controlnet_states) < num_blocks:
+            return True
+        steps = self.steps_since_refresh + 1
+
+        if not self.adaptive:
+            return steps >= self.refresh_interval
+        if self.max_skip_steps is not None and steps > self.max_skip_steps:
+            return True
+
+        if self.temb_threshold is not None:
+            change = ((temb - self.previous_temb).norm() / self.previous_temb.norm().clamp_min(1e-12)).item()
+            self.accumulated_temb_change += change
+            self.previous_temb = temb
+            if self.accumulated_temb_change >= self.temb_threshold:
+                return True
+
+        if self.residual_threshold is not None:
+            # the rate of change is only known after two refreshes
+            if self.residual_change_per_step is None or self.residual_change_per_step * steps >= self.residual_threshold:
+                return True
+        return False
+
+    def update(self, controlnet_states: List[torch.Tensor], temb: Optional[torch.Tensor] = None):
+        """
+        Store freshly computed residuals.
+        """
+        if self.residual_threshold is not None:
+            residual_norm = torch.stack([x.float().norm() for x in controlnet_states]).norm().item()
+            if self.residual_norm is not None:
+                relative_change = abs(residual_norm - self.residual_norm) / max(self.residual_norm, 1e-12)
+                self.residual_change_per_step = relative_change / (self.steps_since_refresh + 1)
+            self.residual_norm = residual_norm
+
+        self.controlnet_states = controlnet_states
+        self.steps_since_refresh = 0
+        self.accumulated_temb_change = 0.0
+        self.previous_temb = temb
+        self.num_evaluations += 1
+
+    def get(self) -> List[torch.Tensor]:
+        """
+        The cached residuals, for a step on which the controlnet is skipped.
+        """
+        self.steps_since_refresh += 1
+        self.num_skipped += 1
+        return self.controlnet_states
+
+    def summary(self) -> str:
+        total = self.num_evaluations + self.num_skipped
+        return (
+            f"controlnet evaluated {self.num_evaluations}/{total} steps, skipped {self.num_skipped}"
+            f" ({100.0 * self.num_skipped / max(total, 1):.1f}%)"
+        )
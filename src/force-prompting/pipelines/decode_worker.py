@@ -0,0 +1,95 @@
+import contextlib
+import queue
+import threading
+from typing import Callable, Optional
+
+import torch
+
+from pipelines.controlnet_img2vid_pipeline import CogVideoXImageToVideoControlnetPipeline, video_chunk_to_frames
+
+
+class DecodeWorker:
+    r"""
+    Decodes the final latents of the pipeline (`output_type="latent"`) in a background thread, so that the denoising
+    loop of the next batch runs while the previous batch is decoded and, by the video writers, encoded.
+
+    `submit` queues the latents and returns right away; the worker decodes them with `decode_latents_streaming` and
+    passes every chunk to `frames_callback` as float frames (B, f, H, W, 3), e.g. `MultiOutputVideoWriter.write`, so
+    the frames are exactly those of the pipeline's own decode. On CUDA the decode runs on its own stream, after the
+    denoising of its latents has finished. At most `max_pending` latents wait for the worker, after that `submit`
+    blocks, which bounds the memory of the queued latents.
+
+    The worker uses the pipeline's own VAE, while the next pipeline call on the main thread encodes its conditioning
+    image with it. The pipeline holds `pipe.vae_lock` around every encode and every decoded chunk, so the two threads
+    take turns on the module and an encode can run between two chunks of a decode. That is safe because the VAE
+    keeps no state between calls: the context of the causal convolutions is carried from chunk to chunk in explicit
+    `conv_cache`s that belong to the decode (see `decode_latents_streaming`), and the weights are only read.
+
+    On CUDA the lock only orders the kernel launches of the two threads. The kernels of the worker run on its own
+    stream, so an encode of the main thread may run on the GPU at the same time; both only read the weights and write
+    to their own outputs. The worker's stream waits on an event that is recorded on the main thread's stream when
+    the latents are submitted, so the decode starts after the denoising that produced them, and `record_stream`
+    keeps the caching allocator from reusing the latents' memory before the worker is done with them.
+
+    The latents are expected without padding frames, which only CogVideoX 1.5 models (`patch_size_t`) add. The
+    pipeline must not use model CPU offload hooks, which move the VAE between devices from whichever thread calls it.
+    """
+
+    def __init__(self, pipe: CogVideoXImageToVideoControlnetPipeline, device: torch.device, max_pending: int = 1):
+        self.pipe = pipe
+        self.stream = torch.cuda.Stream(device) if torch.device(device).type == "cuda" else None
+        self.queue = queue.Queue(maxsize=max_pending)
+        self.errors = []
+        self.thread = threading.Thread(target=self._decode, daemon=True)
+        self.thread.start()
+
+    def _decode(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                self.queue.task_done()
+                break
+            latents, frames_callback, done_callback, denoised = item
+            try:
+                stream_context = torch.cuda.stream(self.stream) if self.stream is not None else contextlib.nullcontext()
+                with torch.no_grad(), stream_context:
+                    if denoised is not None:
+                        self.stream.wait_event(denoised)
+                    for video_chunk in self.pipe.decode_latents_streaming(latents):
+                        frames_callback(video_chunk_to_frames(video_chunk))
+                if done_callback is not None:
+                    done_callback()
+            except Exception as error:
+                self.errors.append(error)
+            finally:
+                self.queue.task_done()
+
+    def submit(
+        self, latents: torch.Tensor, frames_callback: Callable, done_callback: Optional[Callable] = None
+    ):
+        """
+        Queue `latents` (B, F, C, H, W) for decoding. `done_callback` is called once all their frames are passed to
+        `frames_callback`, e.g. to close the video writers.
+        """
+        if self.errors:
+            raise self.errors[0]
+        denoised = None
+        if self.stream is not None:
+            denoised = torch.cuda.Event()
+            denoised.record()
+            # the latents are freed by the worker, on its stream
+            latents.record_stream(self.stream)
+        self.queue.put((latents, frames_callback, done_callback, denoised))
+
+    def wait(self):
+        """
+        Block until all queued latents are decoded, and re-raise decode errors.
+        """
+        self.queue.join()
+        if self.errors:
+            raise self.errors[0]
+
+    def close(self):
+        self.wait()
+        self.queue.put(None)
+        self.thread.join()
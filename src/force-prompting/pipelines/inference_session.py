@@ -0,0 +1,180 @@
+from typing import Any, Dict, Optional
+
+import numpy as np
+import torch
+from diffusers import CogVideoXDPMScheduler
+from diffusers.utils.torch_utils import randn_tensor
+
+from pipelines.controlnet_img2vid_pipeline import CogVideoXImageToVideoControlnetPipeline
+
+
+class InferenceSession:
+    r"""
+    Keeps a `CogVideoXImageToVideoControlnetPipeline` warm between generations, so that generating a video only costs
+    the pipeline call itself:
+
+    - the DPM scheduler is configured and the pipeline moved to `device` once, in the constructor,
+    - precomputed text embeddings are loaded from `embedding_map` (prompt -> `.pt` path) the first time a prompt is
+      used and stay on `device`; the empty negative prompt is loaded right away,
+    - the rotary positional embeddings are computed once per (height, width, frames) and kept by the pipeline.
+
+    `pipeline_kwargs` are the defaults of every `generate` call, e.g. `guidance_scale` or `num_inference_steps`.
+    `generate_sweep` runs many control signals for the same image and prompt.
+    """
+
+    def __init__(
+        self,
+        pipe: CogVideoXImageToVideoControlnetPipeline,
+        device: torch.device,
+        embedding_map: Optional[Dict[str, str]] = None,
+        pipeline_kwargs: Optional[Dict[str, Any]] = None,
+    ):
+        # We train on the simplified learning objective. If we were previously predicting a variance, we need the scheduler to ignore it
+        scheduler_args = {}
+
+        if "variance_type" in pipe.scheduler.config:
+            variance_type = pipe.scheduler.config.variance_type
+
+            if variance_type in ["learned", "learned_range"]:
+                variance_type = "fixed_small"
+
+            scheduler_args["variance_type"] = variance_type
+
+        pipe.scheduler = CogVideoXDPMScheduler.from_config(pipe.scheduler.config, **scheduler_args)
+        if any(getattr(component, "block_streaming", None) is not None for component in pipe.components.values()):
+            # moving the whole pipeline would copy the streamed blocks to the device, the rest of those models is there
+            for component in pipe.components.values():
+                if isinstance(component, torch.nn.Module) and getattr(component, "block_streaming", None) is None:
+                    component.to(device)
+            self.pipe = pipe
+        else:
+            self.pipe = pipe.to(device)
+        self.pipe.rotary_embedding_cache = {}
+        self.device = device
+        self.pipeline_kwargs = pipeline_kwargs or {}
+
+        self.embedding_map = embedding_map or {}
+        self.prompt_embeds = {}
+        if "" in self.embedding_map:
+            self.get_prompt_embeds("")
+
+    def get_prompt_embeds(self, prompt: str) -> torch.Tensor:
+        """
+        The precomputed embedding of `prompt`, (1, 226, 4096), loaded from disk on first use.
+        """
+        if prompt not in self.prompt_embeds:
+            self.prompt_embeds[prompt] = torch.load(self.embedding_map[prompt], map_location=self.device, weights_only=True)
+        return self.prompt_embeds[prompt]
+
+    def generate(self, request: Dict[str, Any]):
+        """
+        Run the pipeline for one request: the pipeline arguments that differ from `pipeline_kwargs`, e.g. `image`,
+        `controlnet_frames` and `prompt` (a str or a list of str, one per sample). With an embedding map the prompts
+        are replaced by their cached embeddings. Instead of `generator`, the request can hold `seeds`, one per sample,
+        for which fresh generators are created.
+        """
+        kwargs = {**self.pipeline_kwargs, **request}
+
+        seeds = kwargs.pop("seeds", None)
+        if seeds is not None:
+            kwargs["generator"] = [torch.Generator(device=self.device).manual_seed(seed) for seed in seeds]
+
+        if len(self.embedding_map) > 0 and "prompt" in kwargs:
+            prompts = kwargs.pop("prompt")
+            prompts = [prompts] if isinstance(prompts, str) else prompts
+            kwargs["prompt_embeds"] = torch.cat([self.get_prompt_embeds(prompt) for prompt in prompts])
+            kwargs["negative_prompt_embeds"] = torch.cat([self.get_prompt_embeds("")] * len(prompts))
+
+        return self.pipe(**kwargs)
+
+    def generate_sweep(self, request: Dict[str, Any], batch_size: Optional[int] = None):
+        """
+        Run one image and prompt under many control signals, e.g. the force, angle and position settings of a benchmark
+        CSV. `request` holds a single `image`, a single `prompt`, a `seed` and either `controlnet_frames` with one
+        control signal per row, (N, 49, 3, 480, 720), or `controlnet_latents` in the pipeline's layout.
+
+        The image is encoded, the prompt embedded and the initial noise drawn once for all rows, and the rows go through
+        the denoising loop in batches of `batch_size` (all at once by default). Every row gets a generator in the state
+        the unbatched pipeline would be in after encoding the image and drawing the noise, so row i is the video that
+        `generate` gives for that control signal and seed.
+        """
+        kwargs = {**self.pipeline_kwargs, **request}
+        pipe = self.pipe
+
+        image = kwargs.pop("image")
+        prompt = kwargs.pop("prompt")
+        seed = kwargs.pop("seed", None)
+        controlnet_frames = kwargs.pop("controlnet_frames", None)
+        controlnet_latents = kwargs.pop("controlnet_latents", None)
+        height = kwargs.get("height") or pipe.transformer.config.sample_height * pipe.vae_scale_factor_spatial
+        width = kwargs.get("width") or pipe.transformer.config.sample_width * pipe.vae_scale_factor_spatial
+        num_frames = kwargs.get("num_frames", 49)
+        do_classifier_free_guidance = kwargs.get("guidance_scale", 6) > 1.0
+
+        if len(self.embedding_map) > 0:
+            prompt_embeds, negative_prompt_embeds = self.get_prompt_embeds(prompt), self.get_prompt_embeds("")
+        else:
+            prompt_embeds, negative_prompt_embeds = pipe.encode_prompt(
+                prompt=prompt, do_classifier_free_guidance=do_classifier_free_guidance, device=self.device
+            )
+        dtype = prompt_embeds.dtype
+
+        # the same order of random draws as in the pipeline: the VAE posterior, then the initial noise
+        generator = torch.Generator(device=self.device).manual_seed(seed) if seed is not None else None
+        image = pipe.video_processor.preprocess(image, height=height, width=width).to(self.device, dtype=dtype)
+        image_latents = pipe.prepare_image_latents(
+            image, 1, pipe.transformer.config.in_channels // 2, num_frames, height, width, dtype, self.device, generator
+        ) # (1, 13, 16, 60, 90)
+        latents = randn_tensor(image_latents.shape, generator=generator, device=self.device, dtype=dtype)
+        generator_state = generator.get_state() if generator is not None else None
+
+        if controlnet_frames is not None:
+            num_rows = len(controlnet_frames)
+        else:
+            num_rows = len(controlnet_latents) // (2 if do_classifier_free_guidance else 1)
+        batch_size = batch_size or num_rows
+        if "decoded_frames_callback" in kwargs and batch_size < num_rows:
+            raise ValueError("A sweep with `decoded_frames_callback` has to run all rows in one batch.")
+
+        videos = []
+        for start in range(0, num_rows, batch_size):
+            end = min(start + batch_size, num_rows)
+            rows = {}
+            if controlnet_frames is not None:
+                rows["controlnet_frames"] = controlnet_frames[start:end]
+            elif do_classifier_free_guidance:
+                # [uncond, cond] halves of the rows
+                rows["controlnet_latents"] = torch.cat(
+                    [controlnet_latents[start:end], controlnet_latents[num_rows + start:num_rows + end]]
+                )
+            else:
+                rows["controlnet_latents"] = controlnet_latents[start:end]
+
+            generators = None
+            if generator_state is not None:
+                generators = [torch.Generator(device=self.device) for _ in range(end - start)]
+                for row_generator in generators:
+                    row_generator.set_state(generator_state)
+
+            output = pipe(
+                image=image,
+                image_latents=image_latents,
+                latents=latents.expand(end - start, -1, -1, -1, -1),
+                prompt_embeds=prompt_embeds.expand(end - start, -1, -1),
+                negative_prompt_embeds=(
+                    negative_prompt_embeds.expand(end - start, -1, -1) if negative_prompt_embeds is not None else None
+                ),
+                generator=generators,
+                **rows,
+                **kwargs,
+            )
+            videos.append(output.frames)
+
+        if videos[0] is None:
+            # streamed to `decoded_frames_callback`
+            return None
+        if isinstance(videos[0], torch.Tensor):
+            return torch.cat(videos)
+        if isinstance(videos[0], list):
+            return [video for batch in videos for video in batch]
+        return np.concatenate(videos)
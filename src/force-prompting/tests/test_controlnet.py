@@ -0,0 +1,32 @@
+"""
+Shapes of the controlnet outputs, on the tiny benchmark controlnet.
+"""
+import pytest
+import torch
+
+from benchmarks.common import TINY_CONFIGS, build_controlnet, make_inputs
+
+
+# the tiny controlnet has 32 channels, the projections a different number
+@pytest.mark.parametrize("out_proj_dim", [None, 48])
+def test_zero_convs_take_the_projected_block_outputs(out_proj_dim):
+    cfg = TINY_CONFIGS["tiny"]
+    controlnet = build_controlnet(cfg, out_proj_dim=out_proj_dim)
+    inputs = make_inputs(cfg)
+    inner_dim = cfg["num_attention_heads"] * cfg["attention_head_dim"]
+    dim = out_proj_dim or inner_dim
+
+    for zero_conv in controlnet.controlnet_zero_convs_after:
+        assert zero_conv.weight.shape[:2] == (dim, dim)
+    with torch.no_grad():
+        controlnet_states = controlnet(
+            hidden_states=inputs["hidden_states"],
+            encoder_hidden_states=inputs["encoder_hidden_states"],
+            controlnet_states=inputs["controlnet_states"],
+            timestep=inputs["timestep"],
+            image_rotary_emb=inputs["image_rotary_emb"],
+            return_dict=False,
+        )[0]
+    assert len(controlnet_states) == cfg["controlnet_num_layers"]
+    for states in controlnet_states:
+        assert states.shape[0] == inputs["hidden_states"].shape[0] and states.shape[-1] == dim
@@ -0,0 +1,48 @@
+"""
+The controlnet residual cache has to leave the pipeline output unchanged whenever it evaluates the controlnet at every
+step, on the tiny benchmark pipeline.
+"""
+import pytest
+import torch
+
+from benchmarks.bench_pipeline import make_pipeline_inputs, run_pipeline
+from benchmarks.common import TINY_CONFIGS, build_pipeline
+from pipelines.controlnet_residual_cache import ControlnetResidualCache
+
+
+@pytest.fixture(scope="module")
+def pipe():
+    return build_pipeline(TINY_CONFIGS["tiny"])
+
+
+@pytest.mark.parametrize("guidance_scale", [6.0, 1.0])
+@pytest.mark.parametrize(
+    "policy",
+    [
+        {"refresh_interval": 1},
+        # every step changes the timestep embedding, so a threshold of 0 refreshes on all of them
+        {"temb_threshold": 0.0},
+        {"temb_threshold": 1.5, "max_skip_steps": 0},
+    ],
+)
+def test_cache_without_skips_matches_uncached(pipe, guidance_scale, policy):
+    cfg = TINY_CONFIGS["tiny"]
+    inputs = make_pipeline_inputs(cfg, guidance_scale=guidance_scale)
+    reference = run_pipeline(pipe, inputs)
+
+    cache = ControlnetResidualCache(**policy)
+    output = run_pipeline(pipe, inputs, controlnet_residual_cache=cache)
+    assert cache.num_skipped == 0
+    assert cache.num_evaluations == cfg["num_inference_steps"]
+    torch.testing.assert_close(output, reference, rtol=0.0, atol=0.0)
+
+
+def test_cache_is_reset_between_calls(pipe):
+    cfg = TINY_CONFIGS["tiny"]
+    inputs = make_pipeline_inputs(cfg)
+    cache = ControlnetResidualCache(refresh_interval=2)
+    first = run_pipeline(pipe, inputs, controlnet_residual_cache=cache)
+    # the residuals of the first call must not leak into the second
+    second = run_pipeline(pipe, inputs, controlnet_residual_cache=cache)
+    assert cache.num_skipped > 0
+    torch.testing.assert_close(second, first, rtol=0.0, atol=0.0)
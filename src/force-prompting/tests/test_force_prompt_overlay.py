@@ -0,0 +1,70 @@
+"""
+The force prompt overlays have to give exactly the pixels of the original drawing loops, which are kept verbatim in
+`benchmarks.reference_overlays`.
+"""
+import functools
+
+import numpy as np
+import pytest
+
+from benchmarks.bench_video import make_video
+from benchmarks.reference_overlays import (
+    add_aesthetic_point_force_prompt_to_video as original_point_force_prompt,
+    add_aesthetic_wind_force_prompt_to_video as original_wind_force_prompt,
+)
+from inference import (
+    add_aesthetic_point_force_prompt_to_video,
+    add_aesthetic_wind_force_prompt_to_video,
+    draw_point_force_prompt,
+    draw_wind_force_prompt,
+    force_prompt_overlay,
+)
+from utils.video_utils import frames_to_uint8
+
+
+POINT_PROMPTS = [
+    {"force": 0.5, "angle": 45.0, "x_pos": 0.4, "y_pos": 0.6},
+    {"force": 1.0, "angle": 200.0, "x_pos": 0.02, "y_pos": 0.97}, # partly outside of the frame
+    {"force": 0.0, "angle": 300.0, "x_pos": 0.9, "y_pos": 0.1},
+]
+WIND_PROMPTS = [{"force": 0.7, "angle": 135.0}, {"force": 0.0, "angle": 10.0}, {"force": 1.0, "angle": 270.0}]
+
+CASES = [
+    (original_point_force_prompt, add_aesthetic_point_force_prompt_to_video, draw_point_force_prompt, prompt, 4)
+    for prompt in POINT_PROMPTS
+] + [
+    (original_wind_force_prompt, add_aesthetic_wind_force_prompt_to_video, draw_wind_force_prompt, prompt, 10)
+    for prompt in WIND_PROMPTS
+]
+
+
+@pytest.fixture(scope="module")
+def video():
+    return make_video(num_frames=8, height=240, width=360)
+
+
+@pytest.mark.parametrize("original, add_force_prompt, draw_force_prompt, prompt, num_frames_with_signal", CASES)
+def test_float_overlay_matches_original(video, original, add_force_prompt, draw_force_prompt, prompt, num_frames_with_signal):
+    reference = original(video, num_frames_with_signal=num_frames_with_signal, **prompt)
+    result = add_force_prompt(video, num_frames_with_signal=num_frames_with_signal, **prompt)
+    assert result.dtype == reference.dtype
+    np.testing.assert_array_equal(result, reference)
+
+
+@pytest.mark.parametrize("render_once", [False, True])
+@pytest.mark.parametrize("original, add_force_prompt, draw_force_prompt, prompt, num_frames_with_signal", CASES)
+def test_video_writer_overlay_matches_original(
+    video, render_once, original, add_force_prompt, draw_force_prompt, prompt, num_frames_with_signal
+):
+    # the pixels of the original float video as `export_to_video` writes them
+    reference = frames_to_uint8(original(video, num_frames_with_signal=num_frames_with_signal, **prompt))
+    overlay = force_prompt_overlay(
+        functools.partial(draw_force_prompt, **prompt), num_frames_with_signal=num_frames_with_signal,
+        render_once=render_once,
+    )
+    for frames in [video, frames_to_uint8(video)]:
+        # in chunks, like from the streaming decode, which must not be modified
+        chunks = [frames[:3].copy(), frames[3:].copy()]
+        result = np.concatenate([overlay(chunks[0], 0), overlay(chunks[1], 3)])
+        np.testing.assert_array_equal(result, reference)
+        np.testing.assert_array_equal(np.concatenate(chunks), frames)
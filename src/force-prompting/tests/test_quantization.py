@@ -0,0 +1,52 @@
+"""
+The weight-only quantized linears, on the tiny benchmark transformer.
+"""
+import pytest
+import torch
+import torch.nn.functional as F
+
+from benchmarks.common import TINY_CONFIGS, build_transformer
+from models.quantization import QuantizedLinear, quantize_block_linears
+
+
+def quantized_linears(model):
+    return [module for module in model.modules() if isinstance(module, QuantizedLinear)]
+
+
+@pytest.mark.parametrize("quantization", ["int8", "int4"])
+def test_scale_stays_float32_when_cast(quantization):
+    transformer = quantize_block_linears(build_transformer(TINY_CONFIGS["tiny"]), quantization)
+    scales = [module.scale.clone() for module in quantized_linears(transformer)]
+
+    transformer.to(torch.bfloat16)
+    for module, scale in zip(quantized_linears(transformer), scales):
+        assert module.scale.dtype == torch.float32
+        torch.testing.assert_close(module.scale, scale, rtol=0.0, atol=0.0)
+        assert module.bias is None or module.bias.dtype == torch.bfloat16
+    assert transformer.patch_embed.proj.weight.dtype == torch.bfloat16
+
+
+def test_int8_is_weight_only_by_default():
+    generator = torch.Generator().manual_seed(0)
+    linear = torch.nn.Linear(64, 96)
+    hidden_states = torch.randn((2, 5, 64), generator=generator)
+    module = QuantizedLinear.from_linear(linear, bits=8)
+
+    with torch.no_grad():
+        output = module(hidden_states)
+        # the activations are used as they are, only the weights are quantized
+        expected = F.linear(hidden_states, module.dequantize(), module.bias)
+    torch.testing.assert_close(output, expected, rtol=0.0, atol=1e-6)
+
+
+def test_int8_weights_in_bfloat16():
+    generator = torch.Generator().manual_seed(0)
+    linear = torch.nn.Linear(64, 96)
+    hidden_states = torch.randn((2, 5, 64), generator=generator)
+    module = QuantizedLinear.from_linear(linear, bits=8).to(torch.bfloat16)
+
+    with torch.no_grad():
+        output = module(hidden_states.bfloat16())
+        expected = F.linear(hidden_states, module.qweight.float() * module.scale[:, None], module.bias.float())
+    assert output.dtype == torch.bfloat16
+    torch.testing.assert_close(output.float(), expected, rtol=2e-2, atol=2e-2)
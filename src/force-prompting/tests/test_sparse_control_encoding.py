@@ -0,0 +1,56 @@
+"""
+Parity of the sparse control signal encoder with the dense one, on the tiny benchmark controlnet. Run from
+`src/force-prompting` with `python -m pytest tests`.
+"""
+import torch
+
+from benchmarks.common import TINY_CONFIGS, build_controlnet, make_point_force_frames
+
+
+def encode(controlnet, controlnet_states, sparse_atol=None):
+    if sparse_atol is None:
+        controlnet.disable_sparse_control_encoding()
+    else:
+        controlnet.enable_sparse_control_encoding(atol=sparse_atol, max_active_fraction=1.0)
+    with torch.no_grad():
+        return controlnet.encode_controlnet_states(controlnet_states)
+
+
+def test_sparse_encoding_matches_dense():
+    cfg = TINY_CONFIGS["tiny"]
+    controlnet = build_controlnet(cfg)
+    controlnet_states = make_point_force_frames(cfg, batch_size=2)
+
+    dense = encode(controlnet, controlnet_states)
+    # atol=0 only leaves out the cells that are exactly background
+    sparse = encode(controlnet, controlnet_states, sparse_atol=0.0)
+    assert sparse.shape == dense.shape
+    torch.testing.assert_close(sparse, dense, rtol=0.0, atol=1e-4)
+
+
+def test_sparse_encoding_runs_sparse():
+    cfg = TINY_CONFIGS["tiny"]
+    controlnet = build_controlnet(cfg)
+    controlnet_states = make_point_force_frames(cfg)
+
+    with torch.no_grad():
+        encoded = controlnet._encode_controlnet_states_sparse(
+            controlnet_states, background_value=0.0, atol=1e-4, max_active_fraction=1.0
+        )
+    # the blob covers a few cells, so the sparse path is taken instead of falling back to the dense encoder
+    assert encoded is not None
+    torch.testing.assert_close(encoded, encode(controlnet, controlnet_states), rtol=0.0, atol=1e-2)
+
+
+def test_sparse_encoding_falls_back_to_dense():
+    cfg = TINY_CONFIGS["tiny"]
+    controlnet = build_controlnet(cfg)
+    controlnet_states = make_point_force_frames(cfg)
+    controlnet_states = controlnet_states + torch.rand_like(controlnet_states)
+
+    dense = encode(controlnet, controlnet_states)
+    controlnet.enable_sparse_control_encoding(atol=1e-4, max_active_fraction=0.5)
+    with torch.no_grad():
+        assert controlnet._encode_controlnet_states_sparse(controlnet_states, **controlnet.sparse_control_encoding) is None
+        encoded = controlnet.encode_controlnet_states(controlnet_states)
+    torch.testing.assert_close(encoded, dense, rtol=0.0, atol=0.0)
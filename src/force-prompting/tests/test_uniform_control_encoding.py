@@ -0,0 +1,52 @@
+"""
+Parity of the single-position encoding of spatially uniform control signals with the full encoder, on the tiny
+benchmark controlnet.
+"""
+import torch
+
+from benchmarks.common import TINY_CONFIGS, build_controlnet, make_point_force_frames, make_wind_force_frames
+
+
+def encode(controlnet, controlnet_states, uniform):
+    if uniform:
+        controlnet.enable_uniform_control_encoding()
+    else:
+        controlnet.disable_uniform_control_encoding()
+    with torch.no_grad():
+        return controlnet.encode_controlnet_states(controlnet_states)
+
+
+def test_uniform_encoding_matches_full():
+    cfg = TINY_CONFIGS["tiny"]
+    controlnet = build_controlnet(cfg)
+    controlnet_states = torch.cat([make_wind_force_frames(cfg), make_wind_force_frames(cfg, force=0.9, angle=200.0)])
+    # the signal changes over time, but is constant over space in every frame
+    controlnet_states = controlnet_states * torch.linspace(0.5, 1.0, controlnet_states.shape[1])[None, :, None, None, None]
+
+    with torch.no_grad():
+        assert controlnet._encode_controlnet_states_uniform(controlnet_states) is not None
+    full = encode(controlnet, controlnet_states, uniform=False)
+    uniform = encode(controlnet, controlnet_states, uniform=True)
+    assert uniform.shape == full.shape
+    torch.testing.assert_close(uniform, full, rtol=0.0, atol=1e-5)
+
+
+def test_non_uniform_signal_uses_full_encoding():
+    cfg = TINY_CONFIGS["tiny"]
+    controlnet = build_controlnet(cfg)
+    controlnet_states = make_point_force_frames(cfg)
+
+    with torch.no_grad():
+        assert controlnet._encode_controlnet_states_uniform(controlnet_states) is None
+    torch.testing.assert_close(
+        encode(controlnet, controlnet_states, uniform=True), encode(controlnet, controlnet_states, uniform=False),
+        rtol=0.0, atol=0.0,
+    )
+
+
+def test_uniform_encoding_is_opt_in():
+    cfg = TINY_CONFIGS["tiny"]
+    controlnet = build_controlnet(cfg)
+    assert not controlnet.uniform_control_encoding
+    controlnet.enable_uniform_control_encoding()
+    assert controlnet.uniform_control_encoding
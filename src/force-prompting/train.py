@@ -14,6 +14,7 @@
 # limitations under the License.
 
 import os
+import hashlib
 import shutil
 import logging
 import math
@@ -47,6 +48,8 @@ from utils.video_utils import prepare_rotary_positional_embeddings, encode_video
 from data.controlnet_datasets import (
     ForcePromptingDataset_PointForce,
     ForcePromptingDataset_WindForce,
+    MultiCSVDataset,
+    expand_val_csv_paths,
 )
 from data.data_utils import (
     collate_fn_ForcePromptingDataset_PointForce,
@@ -89,10 +92,12 @@ import json
 
 def precompute_text_embeddings(
         args, tokenizer, text_encoder, device, weight_dtype, max_text_seq_length, 
-        split="train", embeddings_dirname="precomputed_embeddings"
+        split="train", embeddings_dirname="precomputed_embeddings", csv_paths=None
     ):
     """
-    Precompute text embeddings for all prompts in the CSV and save them to disk.
+    Precompute text embeddings for all prompts in the CSV and save them to disk. For the val split, `csv_paths` can
+    list several CSVs, whose prompts are then embedded in one pass. The prompts without an embedding on disk are run
+    through T5 in batches of `args.train_batch_size`.
     
     Returns:
         dict: Mapping from prompt text to file path containing the embedding
@@ -104,13 +109,22 @@ def precompute_text_embeddings(
     elif split == "val":
         csv_path = args.csv_path_val
         video_root_dir = args.image_root_dir_val
+    csv_paths = csv_paths or [csv_path]
+    if len(csv_paths) == 1:
+        csv_path = csv_paths[0]
+    else:
+        # the embedding files are named by prompt, so CSVs of different objects can share one directory
+        csv_path = os.path.join(
+            os.path.commonpath([os.path.dirname(path) for path in csv_paths]),
+            f"{len(csv_paths)}_csvs_{hashlib.md5(':'.join(sorted(csv_paths)).encode('utf-8')).hexdigest()[:8]}.csv",
+        )
 
     dirname = os.path.dirname(csv_path)
     embeddings_dir = os.path.join(dirname, embeddings_dirname)
     os.makedirs(embeddings_dir, exist_ok=True)
 
     import pandas as pd
-    train_df = pd.read_csv(csv_path)
+    train_df = pd.concat([pd.read_csv(path) for path in csv_paths], ignore_index=True)
 
     # Conditional logic for if OpenVid is there; so that we only consider text prompts which have videos...
     if "OpenVid-1M" in csv_path:
@@ -163,35 +177,38 @@ def precompute_text_embeddings(
     
     # Create mapping from prompt to filepath
     embedding_map = {}
-    
-    # Process each unique prompt
-    for idx, prompt in tqdm(enumerate(all_prompts)):
+    missing_prompts = []
+    for prompt in sorted(all_prompts):
         # Create a unique filename based on a hash of the prompt
-        import hashlib 
         prompt_hash = str(hashlib.md5(prompt.encode('utf-8')).hexdigest())
         embedding_path = os.path.join(embeddings_dir, f"embedding_{prompt_hash}.pt")
         embedding_map[prompt] = embedding_path
-        
-        # Skip if already computed
-        if os.path.exists(embedding_path):
-            print(f"Embedding for prompt {idx+1}/{len(all_prompts)} already exists, skipping")
-            continue
 
-        prompt_embeds = compute_prompt_embeddings( # [1, 226, 4096]
+        # Skip if already computed
+        if not os.path.exists(embedding_path):
+            missing_prompts.append(prompt)
+    print(f"{len(all_prompts) - len(missing_prompts)}/{len(all_prompts)} embeddings already exist, computing the rest...")
+
+    # the prompts are padded to max_text_seq_length anyway, so T5 runs on full batches of them
+    batch_size = args.train_batch_size
+    for start in tqdm(range(0, len(missing_prompts), batch_size)):
+        prompts = missing_prompts[start : start + batch_size]
+        prompt_embeds = compute_prompt_embeddings( # [B, 226, 4096]
             tokenizer,
             text_encoder,
-            [prompt],
+            prompts,
             max_text_seq_length,
             device,
             weight_dtype,
             requires_grad=False,
         )
-        
-        # Save embedding to disk
-        torch.save(prompt_embeds.detach().to(weight_dtype), embedding_path)
-        if idx % 1000 == 0:
-            print(f"Periodic printout--saved embedding {idx+1}/{len(all_prompts)}: {prompt}")
-    
+
+        # Save each embedding to disk, cloned so that the file only holds its own row
+        for i, prompt in enumerate(prompts):
+            torch.save(prompt_embeds[i : i + 1].detach().to(weight_dtype).clone(), embedding_map[prompt])
+        if start // 1000 != (start + len(prompts)) // 1000:
+            print(f"Periodic printout--saved embedding {start+len(prompts)}/{len(missing_prompts)}: {prompts[-1]}")
+
     # Save the mapping as JSON
     with open(embedding_map_json_path, "w") as f:
         # Convert to a dict with string keys (prompts) and string values (filepaths)
@@ -360,6 +377,14 @@ def main(args):
             weight_dtype = torch.bfloat16
 
 
+    if not args.skip_training_and_only_generate_val_videos:
+        if args.low_memory_mode:
+            raise ValueError("--low_memory_mode streams the block weights for inference and cannot be used for training.")
+        if args.weight_quantization is not None:
+            raise ValueError("--weight_quantization is for inference and cannot be used for training.")
+        if args.uniform_control_encoding:
+            raise ValueError("--uniform_control_encoding is for inference and cannot be used for training.")
+
     # Load models
     models = load_models(args)
     tokenizer = models["tokenizer"]
@@ -370,9 +395,14 @@ def main(args):
     scheduler = models["scheduler"]
 
     text_encoder.to(accelerator.device, dtype=weight_dtype)
-    transformer.to(accelerator.device, dtype=weight_dtype)
     vae.to(accelerator.device, dtype=weight_dtype)
-    controlnet.to(accelerator.device, dtype=weight_dtype)
+    if args.low_memory_mode:
+        # the blocks stay in host memory and are streamed to the device one at a time
+        transformer.enable_block_streaming(accelerator.device, dtype=weight_dtype)
+        controlnet.enable_block_streaming(accelerator.device, dtype=weight_dtype)
+    else:
+        transformer.to(accelerator.device, dtype=weight_dtype)
+        controlnet.to(accelerator.device, dtype=weight_dtype)
 
     # For DeepSpeed training
     model_config = transformer.module.config if hasattr(transformer, "module") else transformer.config
@@ -460,18 +490,33 @@ def main(args):
     DatasetConstructor, collate_fn = get_dataloader_constructors(args.controlnet_type)
 
     if args.skip_training_and_only_generate_val_videos:
-        val_dataset = DatasetConstructor(
-            video_root_dir=args.image_root_dir_val,
-            csv_path=args.csv_path_val,
-            image_size=(args.height, args.width), 
-            stride=(args.stride_min, args.stride_max),
-            sample_n_frames=args.max_num_frames,
-            controlnet_type=args.controlnet_type,
-            is_validation_dataset=True
-        )
-        # need to overwrite to values in the training dataset
-        val_dataset.min_force = 0.0
-        val_dataset.max_force = 1.0
+        if args.csv_paths_val:
+            # several CSVs, each with the images next to it, streamed through one run
+            val_csvs = [
+                (csv_path_val, os.path.join(os.path.dirname(csv_path_val), "images"))
+                for csv_path_val in expand_val_csv_paths(args.csv_paths_val)
+            ]
+            print(f"Generating the conditions of {len(val_csvs)} CSVs in one run.")
+        else:
+            val_csvs = [(args.csv_path_val, args.image_root_dir_val)]
+
+        val_datasets = []
+        for csv_path_val, image_root_dir_val in val_csvs:
+            val_dataset = DatasetConstructor(
+                video_root_dir=image_root_dir_val,
+                csv_path=csv_path_val,
+                image_size=(args.height, args.width), 
+                stride=(args.stride_min, args.stride_max),
+                sample_n_frames=args.max_num_frames,
+                controlnet_type=args.controlnet_type,
+                is_validation_dataset=True
+            )
+            # need to overwrite to values in the training dataset
+            val_dataset.min_force = 0.0
+            val_dataset.max_force = 1.0
+            val_datasets.append(val_dataset)
+        # with --csv_paths_val the image root differs per CSV, even if they expand to a single one
+        val_dataset = MultiCSVDataset(val_datasets) if args.csv_paths_val else val_datasets[0]
 
         val_dataloader = DataLoader(
             val_dataset,
@@ -504,9 +549,12 @@ def main(args):
 
     if args.skip_training_and_only_generate_val_videos:
 
-        embedding_map = precompute_text_embeddings(
-            args, tokenizer, text_encoder, accelerator.device, weight_dtype, model_config.max_text_seq_length, split="val"
-        )
+        # the main process computes and saves the embeddings, the others then find them on disk
+        with accelerator.main_process_first():
+            embedding_map = precompute_text_embeddings(
+                args, tokenizer, text_encoder, accelerator.device, weight_dtype, model_config.max_text_seq_length, split="val",
+                csv_paths=[csv_path_val for csv_path_val, _ in val_csvs],
+            )
 
         del models["text_encoder"]
         del text_encoder
@@ -1,9 +1,13 @@
+import os
 import torch
 from typing import List, Optional, Tuple, Union
 from transformers import AutoTokenizer, T5EncoderModel, T5Tokenizer
 
 from models.cogvideo_controlnet import CogVideoXControlnet
 from models.cogvideo_transformer import CustomCogVideoXTransformer3DModel
+from models.chunked_attention import enable_chunked_attention
+from models.quantization import load_quantized_weights, quantize_block_linears, save_quantized_weights
+from utils.result_index import checkpoint_digest
 from diffusers import AutoencoderKLCogVideoX, CogVideoXDPMScheduler
 from diffusers.utils.torch_utils import is_compiled_module
 
@@ -210,11 +214,12 @@ def load_models(args):
         local_files_only=False,
     )
 
-    if args.low_memory_mode:
-        # a hack. use the first few transformer layers. Corrupts outputs visually, but allows you to run on smaller GPU.
-        transformer.low_memory_mode = True
-    else:
-        transformer.low_memory_mode = False
+    if args.transformer_cache_threshold is not None:
+        transformer.enable_block_output_cache(
+            threshold=args.transformer_cache_threshold,
+            indicator=args.transformer_cache_indicator,
+            max_skip_steps=args.transformer_cache_max_skip_steps,
+        )
 
     vae = AutoencoderKLCogVideoX.from_pretrained(
         args.pretrained_model_name_or_path, subfolder="vae", revision=args.revision, variant=args.variant, local_files_only=False,
@@ -251,6 +256,24 @@ def load_models(args):
         m, u = controlnet.load_state_dict(controlnet_state_dict, strict=False)
         print(f'[ Weights from pretrained controlnet was loaded into controlnet ] [# missing keys:: {len(m)} | # unexpected keys: {len(u)}]')
 
+    if args.sparse_control_encoding:
+        controlnet.enable_sparse_control_encoding(atol=args.sparse_control_encoding_atol)
+    if args.uniform_control_encoding:
+        controlnet.enable_uniform_control_encoding()
+
+    if args.attention_memory_budget_mb is not None:
+        enable_chunked_attention(transformer, int(args.attention_memory_budget_mb * 2**20))
+        enable_chunked_attention(controlnet, int(args.attention_memory_budget_mb * 2**20))
+
+    if args.weight_quantization is not None:
+        base_model = {"model": args.pretrained_model_name_or_path, "revision": args.revision, "variant": args.variant}
+        quantize_model_weights(args, "transformer", transformer, source=base_model)
+        quantize_model_weights(args, "controlnet", controlnet, source={
+            **base_model,
+            "controlnet": checkpoint_digest(args.pretrained_controlnet_path),
+            "init_from_transformer": args.init_from_transformer,
+        })
+
     scheduler = CogVideoXDPMScheduler.from_pretrained(args.pretrained_model_name_or_path, subfolder="scheduler", local_files_only=False)
 
     return {
@@ -262,6 +285,30 @@ def load_models(args):
         "scheduler": scheduler,
     }
 
+def quantize_model_weights(args, name, model, source):
+    """
+    Quantize the block linears of `model` (`args.weight_quantization`), with the weights from
+    `args.quantized_weights_dir` if they were saved there for the same `source` weights, else quantizing them and
+    saving them there.
+    """
+    settings = {"quantization": args.weight_quantization, "group_size": args.weight_quantization_group_size}
+    source = {**source, **settings}
+    path = None
+    if args.quantized_weights_dir is not None:
+        path = os.path.join(args.quantized_weights_dir, f"{name}_{args.weight_quantization}.pt")
+        if os.path.isfile(path) and load_quantized_weights(
+            model, path, source=source, int8_matmul=args.weight_quantization_int8_matmul
+        ):
+            print(f"[ Quantized {name} weights were loaded from {path} ]")
+            return
+    quantize_block_linears(
+        model, args.weight_quantization, group_size=args.weight_quantization_group_size,
+        int8_matmul=args.weight_quantization_int8_matmul,
+    )
+    if path is not None:
+        save_quantized_weights(model, path, source=source)
+        print(f"[ Quantized {name} weights were saved to {path} ]")
+
 def unwrap_model(accelerator, model):
     model = accelerator.unwrap_model(model)
     model = model._orig_mod if is_compiled_module(model) else model
@@ -0,0 +1,132 @@
+import glob
+import hashlib
+import json
+import os
+from typing import Any, Dict, Optional
+
+import numpy as np
+import torch
+
+
+def tensor_digest(tensor: torch.Tensor) -> str:
+    """
+    sha256 of the dtype, shape and bytes of a tensor, e.g. a conditioning image.
+    """
+    array = np.ascontiguousarray(tensor.detach().cpu().numpy())
+    digest = hashlib.sha256(f"{array.dtype}{array.shape}".encode("utf-8"))
+    digest.update(array.tobytes())
+    return digest.hexdigest()
+
+
+_checkpoint_digests = {}
+
+
+def checkpoint_digest(path: Optional[str]) -> Optional[str]:
+    """
+    sha256 of the content of a checkpoint file, computed once per process. Directories and hub model ids are
+    identified by their name, hashing a full base model would take longer than the generation it saves.
+    """
+    if path is None or not os.path.isfile(path):
+        return path
+    if path not in _checkpoint_digests:
+        digest = hashlib.sha256()
+        with open(path, "rb") as f:
+            for block in iter(lambda: f.read(1 << 24), b""):
+                digest.update(block)
+        _checkpoint_digests[path] = digest.hexdigest()
+    return _checkpoint_digests[path]
+
+
+def result_key(**components: Any) -> str:
+    """
+    The key of one generated result: a hash of everything it depends on, e.g. the image digest, the prompt, the
+    control parameters, the seed and the generation settings. The components have to be JSON serializable.
+    """
+    return hashlib.sha256(json.dumps(components, sort_keys=True, default=str).encode("utf-8")).hexdigest()
+
+
+class ResultIndex:
+    r"""
+    A content-addressed index of generated results, so that an interrupted run can be resumed without regenerating
+    what is already on disk. Every result is stored under its `result_key` with the paths of its output files; a
+    lookup only hits when all of them still exist.
+
+    Every process writes its own `<index_name>__process_<i>.json` in `index_dir`, and reads the results of all
+    processes and of earlier runs when it is created. `merge` folds the per-process files into `<index_name>.json`.
+    """
+
+    def __init__(self, index_dir: str, process_index: int = 0, index_name: str = "results_index"):
+        self.index_dir = index_dir
+        self.index_name = index_name
+        self.path = os.path.join(index_dir, f"{index_name}__process_{process_index}.json")
+
+        self.entries = {}
+        for path in self._index_paths():
+            with open(path, "r") as f:
+                self.entries.update(json.load(f))
+        # this process's file keeps what it held before, in case the run is interrupted again before a merge
+        self.process_entries = {}
+        if os.path.isfile(self.path):
+            with open(self.path, "r") as f:
+                self.process_entries = json.load(f)
+
+        self.num_hits = 0
+        self.num_misses = 0
+
+    def _index_paths(self):
+        merged_path = os.path.join(self.index_dir, f"{self.index_name}.json")
+        paths = glob.glob(os.path.join(self.index_dir, f"{self.index_name}__process_*.json"))
+        return ([merged_path] if os.path.isfile(merged_path) else []) + sorted(paths)
+
+    def lookup(self, key: str) -> Optional[Dict[str, Any]]:
+        """
+        The stored record of `key` if all its output files exist, else `None`.
+        """
+        record = self.entries.get(key)
+        if record is not None and all(os.path.isfile(path) for path in record["videos"]):
+            self.num_hits += 1
+            return record
+        self.num_misses += 1
+        return None
+
+    def add(self, key: str, record: Dict[str, Any]):
+        """
+        Store a finished result; `record["videos"]` lists its output files.
+        """
+        self.entries[key] = record
+        self.process_entries[key] = record
+
+    def save(self):
+        os.makedirs(self.index_dir, exist_ok=True)
+        # written to a temporary file first, so that a preemption never leaves a truncated index
+        temp_path = f"{self.path}.tmp"
+        with open(temp_path, "w") as f:
+            json.dump(self.process_entries, f, indent=4)
+        os.replace(temp_path, self.path)
+
+    def merge(self):
+        """
+        Fold the files of all processes into `<index_name>.json`. Run it on one process once all have saved.
+        """
+        entries = {}
+        paths = self._index_paths()
+        for path in paths:
+            with open(path, "r") as f:
+                entries.update(json.load(f))
+        merged_path = os.path.join(self.index_dir, f"{self.index_name}.json")
+        temp_path = f"{merged_path}.tmp"
+        with open(temp_path, "w") as f:
+            json.dump(entries, f, indent=4)
+        os.replace(temp_path, merged_path)
+        for path in paths:
+            if path != merged_path:
+                os.remove(path)
+        self.entries = entries
+        self.process_entries = {}
+
+    def summary(self) -> str:
+        total = self.num_hits + self.num_misses
+        return (
+            f"result index: {self.num_hits}/{total} results already generated, {self.num_misses} to generate"
+            f" ({100.0 * self.num_hits / max(total, 1):.1f}% cache hits)"
+        )
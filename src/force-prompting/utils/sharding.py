@@ -0,0 +1,86 @@
+import heapq
+import json
+import os
+from typing import List, Optional
+
+
+def balance_shards(costs: List[float], num_shards: int) -> List[List[int]]:
+    """
+    Split work items over `num_shards` shards with the longest-processing-time rule: the items are assigned in order of
+    decreasing cost, each to the shard with the least work so far. Ties go to the lower item and shard index, so every
+    process computes the same assignment.
+
+    Returns:
+        list: the item indices of every shard, in increasing order
+    """
+    shards = [[] for _ in range(num_shards)]
+    loads = [(0.0, shard) for shard in range(num_shards)]
+    heapq.heapify(loads)
+    for item in sorted(range(len(costs)), key=lambda item: (-costs[item], item)):
+        load, shard = heapq.heappop(loads)
+        shards[shard].append(item)
+        heapq.heappush(loads, (load + costs[item], shard))
+    return [sorted(shard) for shard in shards]
+
+
+def group_dataset_samples(dataset, max_group_size: Optional[int] = None) -> List[List[int]]:
+    """
+    The dataset indices grouped by their conditioning image (the `media_type` column of the dataset CSV), in dataset
+    order, so that a force/angle sweep over one image stays on one process and can be batched. Groups are split into
+    chunks of at most `max_group_size` samples. Datasets without a CSV get one group per sample.
+    """
+    if hasattr(dataset, "df") and hasattr(dataset, "media_type"):
+        keys = list(dataset.df[dataset.media_type])
+    else:
+        keys = list(range(len(dataset)))
+
+    groups = {}
+    for index, key in enumerate(keys):
+        groups.setdefault(key, []).append(index)
+
+    max_group_size = max_group_size or len(keys)
+    return [group[start:start + max_group_size] for group in groups.values() for start in range(0, len(group), max_group_size)]
+
+
+def shard_dataset_indices(
+    dataset, num_shards: int, shard_index: int, sample_cost: float = 1.0, max_group_size: Optional[int] = None
+) -> List[int]:
+    """
+    The dataset indices that process `shard_index` out of `num_shards` generates. The groups of
+    `group_dataset_samples` are balanced by their estimated cost, `sample_cost` per sample, e.g. the number of videos
+    generated for it. The indices of a group stay next to each other.
+    """
+    groups = group_dataset_samples(dataset, max_group_size=max_group_size)
+    shards = balance_shards([len(group) * sample_cost for group in groups], num_shards)
+    return [index for group_index in shards[shard_index] for index in groups[group_index]]
+
+
+def get_manifest_shard_path(output_dir: str, shard_index: int, manifest_name: str = "inference_manifest") -> str:
+    return os.path.join(output_dir, f"{manifest_name}__shard_{shard_index}.json")
+
+
+def write_manifest_shard(output_dir: str, shard_index: int, records: List[dict], manifest_name: str = "inference_manifest"):
+    """
+    Save the records of the videos generated by one process, to be merged by `merge_manifest_shards`.
+    """
+    os.makedirs(output_dir, exist_ok=True)
+    with open(get_manifest_shard_path(output_dir, shard_index, manifest_name), "w") as f:
+        json.dump(records, f, indent=4)
+
+
+def merge_manifest_shards(output_dir: str, num_shards: int, manifest_name: str = "inference_manifest") -> List[dict]:
+    """
+    Merge the manifest shards of all processes into `<manifest_name>.json`, sorted by dataset index and video index,
+    and remove the shards. Run it on one process once all of them have written their shard.
+    """
+    records = []
+    for shard_index in range(num_shards):
+        shard_path = get_manifest_shard_path(output_dir, shard_index, manifest_name)
+        with open(shard_path, "r") as f:
+            records += json.load(f)
+        os.remove(shard_path)
+
+    records.sort(key=lambda record: (record["dataset_index"], record["video_index"]))
+    with open(os.path.join(output_dir, f"{manifest_name}.json"), "w") as f:
+        json.dump(records, f, indent=4)
+    return records
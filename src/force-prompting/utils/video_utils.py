@@ -5,6 +5,8 @@ from diffusers.models.embeddings import get_3d_rotary_pos_embed
 import subprocess, tempfile, cv2
 import numpy as np
 import os
+import queue
+import threading
 
 
 def prepare_rotary_positional_embeddings(
@@ -41,69 +43,170 @@ def encode_video(vae, accelerator, video):
     latent_dist = vae.encode(video).latent_dist.sample() * vae.config.scaling_factor
     return latent_dist.permute(0, 2, 1, 3, 4).to(memory_format=torch.contiguous_format)
 
-def tensor_to_video_ffmpeg(tensor, output_filename, fps=8):
+def get_ffmpeg_exe():
+    """
+    The `ffmpeg` on the PATH, or else the binary that comes with `imageio-ffmpeg`.
+    """
+    import shutil
+
+    if shutil.which("ffmpeg") is not None:
+        return "ffmpeg"
+    try:
+        import imageio_ffmpeg
+    except ImportError:
+        return "ffmpeg"
+    return imageio_ffmpeg.get_ffmpeg_exe()
+
+def tensor_to_video_ffmpeg(tensor, output_filename, fps=8, max_value=1.0, background=False):
     """
     Convert a PyTorch tensor to an MP4 video file using FFmpeg.
+
+    The frames are streamed as raw RGB24 into the stdin of FFmpeg, no intermediate image files are written.
     
     Args:
         tensor (torch.Tensor): Tensor of shape (num_frames, channels, height, width)
-                              with values in range [0, 1] or [0, 255]
+                              with values in range [0, max_value], or uint8 in [0, 255]
         output_filename (str): Output filename ending with .mp4
-        fps (int, optional): Frames per second. Defaults to 30.
+        fps (int, optional): Frames per second. Defaults to 8.
+        max_value (float, optional): The value that maps to 255, 1.0 for [0, 1] and 255.0 for [0, 255] float inputs.
+                                     Defaults to 1.0.
+        background (bool, optional): Feed FFmpeg from a background thread and return that thread right away; join it
+                                     to wait for the video.
     """
-    # Check if tensor is on GPU and move to CPU if necessary
-    if tensor.is_cuda:
-        tensor = tensor.cpu()
-    
     # Get tensor dimensions
     num_frames, channels, height, width = tensor.shape
-    
-    # Ensure tensor values are within [0, 255] range
-    if tensor.max() <= 1.0:
-        tensor = tensor * 255
-    
-    # Convert to numpy and ensure uint8 format
-    frames = tensor.numpy().astype(np.uint8)
-    
-    # Create a temporary directory to store the frames
-    with tempfile.TemporaryDirectory() as temp_dir:
-        # Save each frame as a PNG file
-        for i in range(num_frames):
-            if channels == 3:
-                # Convert from (C, H, W) to (H, W, C)
-                frame = frames[i].transpose(1, 2, 0)
-                # Convert from RGB to BGR for OpenCV
-                frame = frame[:, :, ::-1]
-            elif channels == 1:
-                frame = frames[i].squeeze(0)
-                frame = np.stack([frame, frame, frame], axis=2)
-            else:
-                raise ValueError(f"Unsupported number of channels: {channels}. Expected 1 or 3.")
-            
-            frame_path = os.path.join(temp_dir, f"frame_{i:04d}.png")
-            cv2.imwrite(frame_path, frame)
-        
-        # Ensure output directory exists
-        os.makedirs(os.path.dirname(os.path.abspath(output_filename)), exist_ok=True)
-        
-        # Use FFmpeg to convert the frames to a video
-        ffmpeg_cmd = [
-            'ffmpeg',
-            '-y',  # Overwrite output file if it exists
-            '-framerate', str(fps),
-            '-i', os.path.join(temp_dir, 'frame_%04d.png'),
-            '-c:v', 'libx264',
-            '-profile:v', 'high',
-            '-crf', '20',  # Quality factor (lower is better)
-            '-pix_fmt', 'yuv420p',  # Standard pixel format for compatibility
-            output_filename
-        ]
-        
+    if channels not in [1, 3]:
+        raise ValueError(f"Unsupported number of channels: {channels}. Expected 1 or 3.")
+
+    # Convert to uint8, (num_frames, height, width, 3)
+    tensor = tensor.detach()
+    if tensor.dtype != torch.uint8:
+        tensor = (tensor * (255.0 / max_value)).clamp(0, 255).to(torch.uint8)
+    if channels == 1:
+        tensor = tensor.expand(-1, 3, -1, -1)
+    frames = tensor.permute(0, 2, 3, 1).contiguous().cpu().numpy()
+
+    # Ensure output directory exists
+    os.makedirs(os.path.dirname(os.path.abspath(output_filename)), exist_ok=True)
+
+    # Use FFmpeg to convert the raw frames to a video
+    ffmpeg_cmd = [
+        get_ffmpeg_exe(),
+        '-y',  # Overwrite output file if it exists
+        '-loglevel', 'error',
+        '-f', 'rawvideo',
+        '-pix_fmt', 'rgb24',
+        '-s', f'{width}x{height}',
+        '-framerate', str(fps),
+        '-i', '-',  # frames from stdin
+        '-c:v', 'libx264',
+        '-profile:v', 'high',
+        '-crf', '20',  # Quality factor (lower is better)
+        '-pix_fmt', 'yuv420p',  # Standard pixel format for compatibility
+        output_filename
+    ]
+
+    def encode():
         try:
-            subprocess.run(ffmpeg_cmd, check=True)
-            print(f"Video saved to {output_filename}")
-            print(f"Video dimensions: {width}x{height}, {num_frames} frames at {fps} FPS")
-        except subprocess.CalledProcessError as e:
-            print(f"Error creating video: {e}")
+            process = subprocess.Popen(ffmpeg_cmd, stdin=subprocess.PIPE)
         except FileNotFoundError:
-            print("FFmpeg is not installed or not in the PATH. Please install FFmpeg.")
\ No newline at end of file
+            print("FFmpeg is not installed or not in the PATH. Please install FFmpeg.")
+            return
+        try:
+            process.stdin.write(frames.data)
+        except BrokenPipeError:
+            pass
+        process.stdin.close()
+        if process.wait() != 0:
+            print(f"Error creating video: ffmpeg exited with status {process.returncode}")
+            return
+        print(f"Video saved to {output_filename}")
+        print(f"Video dimensions: {width}x{height}, {num_frames} frames at {fps} FPS")
+
+    if background:
+        thread = threading.Thread(target=encode, daemon=True)
+        thread.start()
+        return thread
+    encode()
+
+
+def frames_to_uint8(frames):
+    """
+    Float frames in [0, 1] to uint8 frames, truncated like `diffusers.utils.export_to_video`; uint8 frames as they are.
+    """
+    return frames if frames.dtype == np.uint8 else (frames * 255).astype(np.uint8)
+
+
+class MultiOutputVideoWriter:
+    """
+    Encodes several variants of one video from a single stream of frames (f, H, W, 3), e.g. the raw video and its
+    overlays. The frames are uint8, or floats in [0, 1] like the output of the pipeline, which are converted to uint8
+    like `export_to_video` does. `outputs` maps each output path to an overlay, `overlay(frames, start_frame) -> uint8
+    frames`, or to `None` for the frames as they are. Overlays get the frames as written, so that they can work on the
+    float frames like the float videos they replace, and must not modify them in place.
+
+    Every output has its own worker thread, which composites the overlay and feeds the frames through a pipe into its
+    own ffmpeg process (with the encoder settings of `diffusers.utils.export_to_video`). `write` only queues the
+    frames, so the caller, e.g. the decode of the next video, doesn't wait on encoding. `close(wait=False)` finishes
+    the videos in the background; `wait` blocks until they are written and re-raises encoder errors.
+
+    Every video is encoded into a temporary file next to its path and only moved to the path once it is complete, so
+    that a run that is interrupted never leaves a truncated video that a resumed run would take for a finished one.
+    """
+
+    def __init__(self, outputs, fps=8, quality=5.0):
+        self.num_frames = 0
+        self.errors = []
+        self.queues = []
+        self.threads = []
+        for path, overlay in outputs.items():
+            frame_queue = queue.Queue()
+            thread = threading.Thread(target=self._encode, args=(path, overlay, frame_queue, fps, quality), daemon=True)
+            thread.start()
+            self.queues.append(frame_queue)
+            self.threads.append(thread)
+
+    def _encode(self, path, overlay, frame_queue, fps, quality):
+        import imageio
+
+        # same extension, which tells imageio the format
+        temp_path = "{}.tmp{}".format(*os.path.splitext(path))
+        try:
+            with imageio.get_writer(temp_path, fps=fps, quality=quality, macro_block_size=16) as writer:
+                while True:
+                    item = frame_queue.get()
+                    if item is None:
+                        break
+                    start_frame, frames = item
+                    frames = overlay(frames, start_frame) if overlay is not None else frames_to_uint8(frames)
+                    for frame in frames:
+                        writer.append_data(frame)
+            os.replace(temp_path, path)
+        except Exception as error:
+            self.errors.append(error)
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+
+    def write(self, frames):
+        for frame_queue in self.queues:
+            frame_queue.put((self.num_frames, frames))
+        self.num_frames += len(frames)
+
+    def close(self, wait=True):
+        for frame_queue in self.queues:
+            frame_queue.put(None)
+        if wait:
+            self.wait()
+
+    def wait(self):
+        for thread in self.threads:
+            thread.join()
+        if self.errors:
+            raise self.errors[0]
+
+    @property
+    def done(self):
+        """
+        Whether all outputs are written (or have failed), without blocking.
+        """
+        return all(not thread.is_alive() for thread in self.threads)